@@ -1,32 +1,63 @@
 from pathlib import Path
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, timezone, time as dtime
 import random
 import json
+import os
 import uuid
 from typing import Optional
 import re
+import sys
 import time as _t
 import json as _json
 import uuid as _uuid
 import base64
+import bisect
+import hashlib
+import hmac
+import zlib
+import lzma
 import html as _html
+import math
+import unicodedata
 import time
+import threading
+import importlib
+import heapq
+import itertools
+from collections import Counter, deque, OrderedDict
 
 import streamlit as st
 import streamlit.components.v1 as components
-from streamlit_autorefresh import st_autorefresh
 
 
-# ====== Third-party for Mongo Auth ======
-try:
-    import bcrypt
-except Exception:
-    bcrypt = None
+# ====== Lazy imports (khởi động nhanh) ======
+class _LazyModule:
+    """Import module ở lần truy cập thuộc tính đầu tiên → trang đăng nhập không phải chờ pymongo/numpy."""
+    def __init__(self, name: str):
+        self._name = name
+        self._mod = None
+
+    def __getattr__(self, attr):
+        if self._mod is None:
+            self._mod = importlib.import_module(self._name)
+        return getattr(self._mod, attr)
+
+np = _LazyModule("numpy")
+pymongo = _LazyModule("pymongo")
+
+def _bcrypt():
+    """bcrypt chỉ cần khi đăng ký/đăng nhập; thiếu thư viện → None."""
+    try:
+        import bcrypt
+        return bcrypt
+    except Exception:
+        return None
 
 # ====== App config ======
 APP_TITLE = "🌱 Healingizz 2.1.0"
 APP_TAGLINE = "Hỗ trợ cân bằng tâm lý học sinh"
-DATA_DIR = Path("healing_data"); DATA_DIR.mkdir(exist_ok=True)
+WEEKDAYS_VI = ["T2", "T3", "T4", "T5", "T6", "T7", "CN"]   # 0 = thứ Hai (như date.weekday())
+DATA_DIR = Path(os.environ.get("HEALINGIZZ_DATA_DIR", "healing_data")); DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 # ---------------- UI Lock helpers ----------------
 def _lock_ui(on: bool = True):
@@ -43,41 +74,431 @@ def _sync_ui_lock_with_timers():
     )
     _lock_ui(running)
 
+# ---------------- Shared session state (multi-replica) ----------------
+# Timer (br_* / tm_*), khóa UI, quest đang chạy và toast chỉ sống trong st.session_state của 1 tiến trình.
+# Đồng bộ các key này ra 1 store theo user → replica khác / worker vừa restart tiếp tục được bài đang làm.
+# user_data không cần đưa vào đây: nó đã nằm ở storage engine và được load lại khi phiên mới mở.
+SHARED_STATE_PREFIXES = ("br_", "tm_")
+SHARED_STATE_KEYS = ("_ui_locked", "active_quest_id", "_hz_toasts")
+SESSION_TTL_S = 6 * 3600
+
+def _is_shared_key(k: str) -> bool:
+    return k in SHARED_STATE_KEYS or k.startswith(SHARED_STATE_PREFIXES)
+
+class SessionStore:
+    """Key-value theo user: giá trị là dict trạng thái (JSON được), có hạn dùng `ttl_s`."""
+    name = "base"
+
+    def get(self, user_key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def put(self, user_key: str, state: dict, ttl_s: float = SESSION_TTL_S):
+        raise NotImplementedError
+
+    def delete(self, user_key: str):
+        raise NotImplementedError
+
+class MemorySessionStore(SessionStore):
+    """Mặc định: dict trong tiến trình — đủ cho 1 replica, sống qua rerun/đóng tab nhưng không qua restart."""
+    name = "memory"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items: dict = {}   # user_key -> (expires_at, json)
+
+    def get(self, user_key):
+        with self.lock:
+            item = self.items.get(user_key)
+            if item and item[0] > time.time():
+                return json.loads(item[1])
+            self.items.pop(user_key, None)
+            return None
+
+    def put(self, user_key, state, ttl_s=SESSION_TTL_S):
+        raw = json.dumps(state, ensure_ascii=False, default=str)   # chụp bản sao, không giữ tham chiếu session_state
+        with self.lock:
+            self.items[user_key] = (time.time() + ttl_s, raw)
+
+    def delete(self, user_key):
+        with self.lock:
+            self.items.pop(user_key, None)
+
+class SqliteSessionStore(SessionStore):
+    """File SQLite (WAL) dùng chung giữa các replica trên cùng máy / volume chia sẻ."""
+    name = "sqlite"
+
+    def __init__(self, path: Path):
+        import sqlite3
+        self.path = Path(path); self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA busy_timeout=2000")
+        self.db.execute("CREATE TABLE IF NOT EXISTS session_state (user_key TEXT PRIMARY KEY, "
+                        "state TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def get(self, user_key):
+        with self.lock:
+            row = self.db.execute("SELECT state FROM session_state WHERE user_key=? AND expires_at>?",
+                                  (user_key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, user_key, state, ttl_s=SESSION_TTL_S):
+        now = time.time()
+        raw = json.dumps(state, ensure_ascii=False, default=str)
+        with self.lock:
+            self.db.execute("INSERT INTO session_state (user_key, state, expires_at) VALUES (?,?,?) "
+                            "ON CONFLICT(user_key) DO UPDATE SET state=excluded.state, expires_at=excluded.expires_at",
+                            (user_key, raw, now + ttl_s))
+            self.db.execute("DELETE FROM session_state WHERE expires_at<=?", (now,))
+
+    def delete(self, user_key):
+        with self.lock:
+            self.db.execute("DELETE FROM session_state WHERE user_key=?", (user_key,))
+
+class RedisSessionStore(SessionStore):
+    """Redis (hoặc server nói giao thức Redis: KeyDB, Valkey…); cần gói `redis` — tùy chọn."""
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "healingizz:session:"):
+        import redis   # chỉ cần khi chọn backend này
+        self.r = redis.Redis.from_url(url, socket_timeout=1.0, socket_connect_timeout=1.0)
+        self.prefix = prefix
+
+    def get(self, user_key):
+        raw = self.r.get(self.prefix + user_key)
+        return json.loads(raw) if raw else None
+
+    def put(self, user_key, state, ttl_s=SESSION_TTL_S):
+        self.r.set(self.prefix + user_key, json.dumps(state, ensure_ascii=False, default=str), ex=int(ttl_s))
+
+    def delete(self, user_key):
+        self.r.delete(self.prefix + user_key)
+
+def session_store_name() -> str:
+    return (os.environ.get("HEALINGIZZ_SESSION") or _secrets_section("session").get("backend") or "memory").lower()
+
+def make_session_store(name: Optional[str] = None) -> SessionStore:
+    name = name or session_store_name()
+    cfg = _secrets_section("session")
+    if name == "memory":
+        return MemorySessionStore()
+    if name == "sqlite":
+        return SqliteSessionStore(Path(os.environ.get("HEALINGIZZ_SESSION_PATH") or cfg.get("sqlite_path")
+                                       or DATA_DIR / "sessions.db"))
+    if name == "redis":
+        return RedisSessionStore(os.environ.get("HEALINGIZZ_REDIS_URL") or cfg.get("redis_url")
+                                 or "redis://localhost:6379/0")
+    raise ValueError(f"Session store không hỗ trợ: {name!r} (memory | sqlite | redis)")
+
+@st.cache_resource(show_spinner=False)
+def _session_store_singleton(name: str) -> SessionStore:
+    return make_session_store(name)
+
+def get_session_store() -> SessionStore:
+    return _session_store_singleton(session_store_name())
+
+def _session_user_key() -> str:
+    return str(st.session_state.get("auth_user_id") or st.session_state.get("username") or "")
+
+def _shared_state_json(state: dict) -> str:
+    return json.dumps(state, sort_keys=True, ensure_ascii=False, default=str)
+
+def session_restore():
+    """Sau khi biết user: kéo trạng thái bài tập từ store về phiên này (1 lần/phiên/user)."""
+    user_key = _session_user_key()
+    if not user_key or st.session_state.get("_shared_restored") == user_key:
+        return
+    st.session_state["_shared_restored"] = user_key
+    try:
+        saved = get_session_store().get(user_key) or {}
+    except Exception:
+        perf_inc("session.store_error"); saved = {}
+    for k, v in saved.items():
+        if _is_shared_key(k):
+            st.session_state[k] = v
+    if saved:
+        perf_inc("session.restored")
+    st.session_state["_shared_digest"] = _shared_state_json(saved)
+
+def session_sync():
+    """Đẩy các key chia sẻ lên store nếu đổi so với lần trước (gọi cuối mỗi lượt chạy, kể cả khi st.rerun)."""
+    user_key = _session_user_key()
+    if not user_key or st.session_state.get("_shared_restored") != user_key:
+        return
+    state = {k: v for k, v in st.session_state.items() if _is_shared_key(k)}
+    digest = _shared_state_json(state)
+    if digest == st.session_state.get("_shared_digest"):
+        return
+    try:
+        get_session_store().put(user_key, state)
+        st.session_state["_shared_digest"] = digest
+        perf_inc("session.sync")
+    except Exception:
+        perf_inc("session.store_error")
+
+def session_forget():
+    """Đăng xuất: xóa trạng thái chia sẻ để phiên sau không khôi phục bài cũ."""
+    user_key = _session_user_key()
+    if user_key:
+        try:
+            get_session_store().delete(user_key)
+        except Exception:
+            perf_inc("session.store_error")
+    for k in [k for k in st.session_state.keys() if _is_shared_key(k)] + ["_shared_restored", "_shared_digest"]:
+        st.session_state.pop(k, None)
+
 # ---------------- Local storage (always-on) ----------------
+# Khóa file = auth user_id (không đổi khi đổi nickname); chưa đăng nhập → "user-<tên đăng nhập>".
+# File nằm ở users/<h[0:2]>/<h[2:4]>/<khóa>.json (h = sha1(khóa)) → mỗi thư mục chỉ vài trăm file.
+# users/index.json: khóa → {"path", "nickname", "created_at"} (dựng lại được bằng rebuild_local_index()).
+LOCAL_USERS_DIR = DATA_DIR / "users"
+LOCAL_INDEX_FILE = LOCAL_USERS_DIR / "index.json"
+LEGACY_DIR = DATA_DIR / "legacy"   # file phẳng cũ (user-<nickname>.json) sau khi đã gộp
+
+def _slug(name: str) -> str:
+    return name.strip().lower().replace(" ", "_")
+
+def local_key_for(auth_user_id: str = "", username: str = "") -> str:
+    if auth_user_id:
+        return auth_user_id
+    return f"user-{_slug(username)}" if username.strip() else "user-local"
+
 def user_file(local_key: str) -> Path:
-    return DATA_DIR / f"{local_key}.json"
+    h = hashlib.sha1(local_key.encode("utf-8")).hexdigest()
+    return LOCAL_USERS_DIR / h[:2] / h[2:4] / f"{_safe_name(local_key)}.json"
+
+@st.cache_resource(show_spinner=False)
+def _local_index() -> dict:
+    try:
+        entries = json.loads(LOCAL_INDEX_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        entries = {}
+    return {"lock": threading.Lock(), "entries": entries}
+
+def _local_index_write(entries: dict):
+    LOCAL_USERS_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = LOCAL_INDEX_FILE.with_name(LOCAL_INDEX_FILE.name + ".tmp")
+    tmp.write_text(json.dumps(entries, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp, LOCAL_INDEX_FILE)
+
+def _local_index_touch(local_key: str, data: dict):
+    """Chỉ ghi index khi có khóa mới hoặc nickname đổi (không ghi lại mỗi lần lưu)."""
+    idx = _local_index()
+    nickname = data.get("profile", {}).get("nickname", "")
+    with idx["lock"]:
+        cur = idx["entries"].get(local_key)
+        if cur and cur.get("nickname") == nickname:
+            return
+        idx["entries"][local_key] = {"path": user_file(local_key).relative_to(LOCAL_USERS_DIR).as_posix(),
+                                     "nickname": nickname,
+                                     "created_at": (cur or {}).get("created_at") or data.get("created_at")}
+        _local_index_write(idx["entries"])
+
+def iter_local_user_files():
+    """Mọi file user trong cây shard (bỏ bản backup / tmp)."""
+    for f in sorted(LOCAL_USERS_DIR.glob("*/*/*.json")):
+        if not f.name.endswith(".backup.json"):
+            yield f
+
+def rebuild_local_index() -> int:
+    entries = {}
+    for f in iter_local_user_files():
+        try:
+            data = read_snapshot(f)
+        except Exception:
+            continue
+        key = data.get("user_id") or f.stem
+        entries[key] = {"path": f.relative_to(LOCAL_USERS_DIR).as_posix(),
+                        "nickname": data.get("profile", {}).get("nickname", ""), "created_at": data.get("created_at")}
+    idx = _local_index()
+    with idx["lock"]:
+        idx["entries"] = entries
+        _local_index_write(entries)
+    return len(entries)
+
+def _legacy_key(stem: str, by_slug: dict) -> str:
+    """user-local-<id> → id; user-<slug> khớp tên đăng nhập trong auth cache → user_id; còn lại giữ nguyên."""
+    if stem.startswith("user-local-"):
+        return stem[len("user-local-"):]
+    return by_slug.get(stem[len("user-"):], stem) if stem.startswith("user-") else stem
+
+def consolidate_local_files() -> int:
+    """
+    Migration 1 lần: gộp file phẳng DATA_DIR/user-<nickname>.json vào cây shard theo khóa ổn định.
+    Nhiều file cùng về 1 user → _merge_user_docs. File gốc chuyển sang legacy/ (không xóa).
+    """
+    flat = [f for f in DATA_DIR.glob("user-*.json")
+            if not f.name.endswith(".backup.json") and f != AUTH_CACHE_FILE]
+    if not flat:
+        return 0
+    by_slug = {_slug(u): rec.get("user_id") for u, rec in _auth_cache_load(include_expired=True).items()
+               if rec.get("user_id")}
+    LEGACY_DIR.mkdir(parents=True, exist_ok=True)
+    moved = 0
+    for f in sorted(flat):
+        try:
+            doc = read_snapshot(f)
+        except Exception:
+            continue
+        key = _legacy_key(f.stem, by_slug)
+        target = user_file(key)
+        if target.exists():
+            doc = _merge_user_docs(read_snapshot(target), doc)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        doc["user_id"] = key
+        write_snapshot(target, doc)
+        _local_index_touch(key, doc)
+        os.replace(f, LEGACY_DIR / f.name)
+        moved += 1
+    perf_inc("local.consolidated", moved)
+    return moved
+
+@st.cache_resource(show_spinner=False)
+def _local_layout_ready() -> int:
+    """Chạy consolidate_local_files đúng 1 lần mỗi process, trước lần đọc/ghi local đầu tiên."""
+    return consolidate_local_files()
 
 def init_user_state(local_key: str, nickname_hint: str = ""):
     return {
         "user_id": local_key,
+        "schema_version": SCHEMA_VERSION,
         "created_at": datetime.utcnow().isoformat(),
         "profile": {"nickname": nickname_hint or local_key.replace("user-",""), "bio": ""},
         "game": {
             "streak": 0,
             "last_checkin_date": None,
             "badges": [],
+            "badge_ids": [],
             "quests": {},
             "moods": [],
             "journal": [],
             "reminders": [],
             "quest_counts": {},
             "garden": [],
+            "week_summary": {},
         }
     }
 
+# ---------------- Compression (field + snapshot) ----------------
+# [storage] compress = "zlib" | "lzma" | "none", text_threshold (byte), snapshot_threshold (byte)
+# Blob nén luôn mở đầu bằng b"HZ" + tag thuật toán → đọc được bất kể cấu hình hiện tại.
+_Z_CODECS = {b"z": (lambda b: zlib.compress(b, 1), zlib.decompress),
+             b"x": (lambda b: lzma.compress(b, preset=0), lzma.decompress)}
+_Z_TAGS = {"zlib": b"z", "lzma": b"x"}
+
+@st.cache_resource(show_spinner=False)
+def _compression_config() -> dict:
+    cfg = _secrets_section("storage")
+    return {"algo": str(os.environ.get("HEALINGIZZ_COMPRESS") or cfg.get("compress", "zlib")).lower(),
+            "text_threshold": int(cfg.get("text_threshold", 512)),
+            "snapshot_threshold": int(cfg.get("snapshot_threshold", 32 * 1024))}
+
+def z_pack(raw: bytes, algo: Optional[str] = None) -> bytes:
+    tag = _Z_TAGS.get(algo or _compression_config()["algo"])
+    if tag is None:
+        return raw
+    return b"HZ" + tag + _Z_CODECS[tag][0](raw)
+
+def z_unpack(blob: bytes) -> bytes:
+    if blob[:2] == b"HZ" and blob[2:3] in _Z_CODECS:
+        return _Z_CODECS[blob[2:3]][1](blob[3:])
+    return blob
+
+def _text_packer():
+    """Hàm nén chuỗi dài → bytes (Mongo lưu thành Binary); ngắn hoặc nén không lợi → giữ nguyên."""
+    cfg = _compression_config()
+    algo, threshold = cfg["algo"], cfg["text_threshold"]
+    if algo not in _Z_TAGS:
+        return lambda s: s
+    def pack(s):
+        if not isinstance(s, str) or len(s) < threshold:
+            return s
+        raw = s.encode("utf-8")
+        packed = z_pack(raw, algo)
+        return packed if len(packed) < len(raw) else s
+    return pack
+
+def _z_untext(v):
+    return z_unpack(bytes(v)).decode("utf-8") if isinstance(v, (bytes, bytearray)) else v
+
+def _map_entity_text(kind: str, e: dict, fn) -> dict:
+    if kind == "journal" and "content" in e:
+        return {**e, "content": fn(e["content"])}
+    if kind == "garden" and "affirmation" in e:
+        return {**e, "affirmation": fn(e["affirmation"])}
+    grat = (e.get("payload") or {}).get("gratitude") if kind == "quests" else None
+    if grat:
+        return {**e, "payload": {**e["payload"], "gratitude": [fn(x) for x in grat]}}
+    return e
+
+def _map_text_fields(data: dict, fn) -> dict:
+    """Bản sao nông của doc với `fn` áp lên các trường văn bản lớn (journal, biết ơn, lời gieo cây)."""
+    game = data.get("game")
+    if not game:
+        return data
+    g = dict(game)
+    for kind in ("journal", "garden"):
+        if game.get(kind):
+            g[kind] = [_map_entity_text(kind, e, fn) for e in game[kind]]
+    if game.get("quests"):
+        g["quests"] = {qid: _map_entity_text("quests", q, fn) for qid, q in game["quests"].items()}
+    return {**data, "game": g}
+
+def encode_text_fields(data: dict) -> dict:
+    return _map_text_fields(data, _text_packer())
+
+def decode_text_fields(data: dict) -> dict:
+    return _map_text_fields(data, _z_untext)
+
+def write_snapshot(path: Path, data: dict):
+    """Ghi doc ra file; lớn hơn snapshot_threshold thì nén cả file. Ghi tmp rồi replace để không hỏng file."""
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(raw) >= _compression_config()["snapshot_threshold"]:
+        raw = z_pack(raw)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(raw)
+    os.replace(tmp, path)
+
+def read_snapshot(path: Path) -> dict:
+    return json.loads(z_unpack(path.read_bytes()).decode("utf-8"))
+
 def _save_local(data: dict):
+    _local_layout_ready()
     f = user_file(data["user_id"])
-    f.write_text(json.dumps(data, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    f.parent.mkdir(parents=True, exist_ok=True)
+    game = data.get("game")
+    pending = getattr(game, "pending", ())
+    if pending:
+        # Mục chưa nạp (mới đọc lát cắt) → giữ bản của snapshot trước, không kéo cả mục về chỉ để sao lưu.
+        # Chưa có snapshot (máy/replica mới, DATA_DIR trống) → nạp mục đó 1 lần, nếu không bản offline sẽ trống
+        # lịch sử khi breaker mở; cloud lỗi → ghi tạm lát cắt preview (merge lúc cloud sống lại chỉ cộng thêm).
+        prev = (read_snapshot(f) if f.exists() else {}).get("game", {})
+        fill = {}
+        for k in pending:
+            if k in prev:
+                fill[k] = prev[k]
+                continue
+            try:
+                game._load(k)
+            except Exception:
+                pv = game.preview(k)
+                if pv is not None:
+                    fill[k] = pv["items"]
+        data = {**data, "game": {**dict(dict.items(game)), **fill}}
+    write_snapshot(f, data)
+    _local_index_touch(data["user_id"], data)
 
 def _load_local(local_key: str, nickname_hint: str = ""):
+    _local_layout_ready()
     f = user_file(local_key)
     if f.exists():
         try:
-            return json.loads(f.read_text(encoding="utf-8"))
+            return read_snapshot(f)
         except Exception:
-            backup = DATA_DIR / f"{local_key}.backup.json"
+            backup = f.with_name(f"{f.stem}.backup.json")
             try:
-                backup.write_text(f.read_text(encoding="utf-8"), encoding="utf-8")
+                backup.write_bytes(f.read_bytes())
             except Exception:
                 pass
             data = init_user_state(local_key, nickname_hint)
@@ -85,21 +506,418 @@ def _load_local(local_key: str, nickname_hint: str = ""):
     data = init_user_state(local_key, nickname_hint)
     _save_local(data); return data
 
+# ---------------- Schema migrations ----------------
+# Mỗi migration nhận nguyên doc user (dict) và sửa tại chỗ; `schema_version` ghi lại bản đã áp dụng.
+# Thêm migration mới: viết hàm + @migration(<version kế tiếp>, "mô tả"). Không sửa migration cũ.
+MIGRATIONS: dict[int, tuple[str, object]] = {}
+
+def migration(version: int, desc: str):
+    def deco(fn):
+        if version in MIGRATIONS:
+            raise ValueError(f"Migration {version} đã tồn tại")
+        MIGRATIONS[version] = (desc, fn)
+        return fn
+    return deco
+
+@migration(1, "Chuẩn hóa khung game (thêm khóa thiếu, longest_streak)")
+def _m001_baseline(data: dict):
+    game = data.setdefault("game", {})
+    for k, v in init_user_state("", "")["game"].items():
+        game.setdefault(k, v)
+    data.setdefault("profile", {}).setdefault("bio", "")
+    if "longest_streak" not in game:
+        game["longest_streak"] = max(int(game.get("streak", 0)),
+                                     compute_streaks([m.get("date") for m in game.get("moods", [])])["longest_streak"])
+
+@migration(2, "Bỏ ảnh base64 trong garden — ảnh lấy lại từ tree_file khi hiển thị")
+def _m002_drop_garden_img(data: dict):
+    for p in data.get("game", {}).get("garden", []):
+        if p.pop("img", None) is not None and not p.get("tree_file"):
+            rare = (p.get("rarity") == "hiem") or p.get("rare")
+            p["tree_file"] = (RARE_FILES if rare else NORMAL_FILES)[-1]
+
+@migration(3, "Huy hiệu theo id cố định: game.badge_ids dựng từ tên trong game.badges")
+def _m003_badge_ids(data: dict):
+    game = data.setdefault("game", {})
+    by_title = _badge_catalogue()["by_title"]
+    ids = [by_title.get(_clean_badge_title(str(t))) for t in game.get("badges", [])]
+    game["badge_ids"] = list(dict.fromkeys([*game.get("badge_ids", []), *filter(None, ids)]))
+
+@migration(4, "Tóm tắt tuần materialized: game.week_summary dựng từ moods/quests/garden/journal")
+def _m004_week_summary(data: dict):
+    data.setdefault("game", {})["week_summary"] = week_summary_build(data)
+
+SCHEMA_VERSION = max(MIGRATIONS)
+
+def migrate_user_doc(data: dict, to: Optional[int] = None) -> bool:
+    """Áp các migration còn thiếu (theo thứ tự version). Trả về True nếu doc đã thay đổi."""
+    target = SCHEMA_VERSION if to is None else to
+    cur = int(data.get("schema_version", 0) or 0)
+    for ver in sorted(v for v in MIGRATIONS if cur < v <= target):
+        MIGRATIONS[ver][1](data)
+        data["schema_version"] = ver
+    return int(data.get("schema_version", 0) or 0) != cur
+
+# ---------------- Perf counters (process-wide) ----------------
+@st.cache_resource(show_spinner=False)
+def _perf_registry() -> dict:
+    """Bộ đếm/độ trễ dùng chung cho cả process (sống qua các lần rerun)."""
+    return {"lock": threading.Lock(), "counters": {}, "timings": {}}
+
+def perf_inc(name: str, n: int = 1):
+    reg = _perf_registry()
+    with reg["lock"]:
+        reg["counters"][name] = reg["counters"].get(name, 0) + n
+
+def perf_observe(name: str, ms: float):
+    reg = _perf_registry()
+    with reg["lock"]:
+        reg["timings"].setdefault(name, deque(maxlen=512)).append(float(ms))
+
+def perf_snapshot() -> dict:
+    reg = _perf_registry()
+    with reg["lock"]:
+        timings = {}
+        for k, arr in reg["timings"].items():
+            vals = sorted(arr)
+            if vals:
+                timings[k] = {"n": len(vals), "p50": vals[len(vals)//2],
+                              "p95": vals[min(len(vals)-1, int(len(vals)*0.95))], "max": vals[-1]}
+        return {"counters": dict(reg["counters"]), "timings": timings}
+
+# ---------------- Memory accounting (phiên + process) ----------------
+MEMORY_REPORT_EVERY_S = 60   # mỗi phiên đo lại deep size tối đa 1 lần/phút
+MEMORY_TOP_KEYS = 15
+
+def deep_sizeof(obj, seen: Optional[set] = None) -> int:
+    """
+    Tổng sys.getsizeof của obj và mọi thứ nó chứa (dict/list/tuple/set/__dict__/__slots__), mỗi object đếm 1 lần.
+    Đi bằng stack (doc sâu không tràn đệ quy); dict duyệt bằng dict.items → không kích hoạt LazyGame.
+    """
+    seen = set() if seen is None else seen
+    total, stack = 0, [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (type, type(sys), type(deep_sizeof), threading.Thread)):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o, 0)
+        if isinstance(o, dict):
+            for k, v in dict.items(o):
+                stack.append(k); stack.append(v)
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            stack.extend(o)
+        elif hasattr(o, "__dict__") and not isinstance(o, (str, bytes)):
+            stack.append(vars(o))
+        elif hasattr(type(o), "__slots__"):
+            stack.extend(getattr(o, a) for a in type(o).__slots__ if hasattr(o, a))
+    return total
+
+@st.cache_resource(show_spinner=False)
+def _memory_registry() -> dict:
+    """Bản báo cáo gần nhất của từng phiên (process-wide) → tổng hợp cho toàn process."""
+    return {"lock": threading.Lock(), "sessions": {}}
+
+def session_memory_report() -> dict:
+    """Deep size của user_data (theo từng mục game) và của từng key trong session_state."""
+    seen: set = set()
+    data = st.session_state.get("user_data") or {}
+    game = data.get("game", {})
+    sections = {k: deep_sizeof(v, seen) for k, v in dict.items(game)}
+    user_data = sum(sections.values()) + deep_sizeof(data, seen)
+    keys = {str(k): deep_sizeof(v, seen) for k, v in st.session_state.items() if k != "user_data"}
+    top = dict(sorted(keys.items(), key=lambda kv: -kv[1])[:MEMORY_TOP_KEYS])
+    return {"user_data": user_data, "sections": sections, "pending": list(getattr(game, "pending", ())),
+            "keys": top, "total": user_data + sum(keys.values())}
+
+def memory_publish(force: bool = False):
+    """Gọi cuối mỗi lượt chạy: cứ MEMORY_REPORT_EVERY_S giây đo lại phiên này và đẩy vào registry."""
+    now = _t.time()
+    if not force and now - st.session_state.get("_mem_at", 0) < MEMORY_REPORT_EVERY_S:
+        return
+    st.session_state["_mem_at"] = now
+    sid = st.session_state.setdefault("_mem_sid", uuid.uuid4().hex[:12])
+    t0 = _t.perf_counter()
+    rep = session_memory_report()
+    perf_observe("memory.report_ms", (_t.perf_counter() - t0) * 1000)
+    reg = _memory_registry()
+    with reg["lock"]:
+        reg["sessions"][sid] = {"at": now, "user": st.session_state.get("username") or "guest",
+                                "user_data": rep["user_data"], "total": rep["total"]}
+        for old in [k for k, v in reg["sessions"].items() if now - v["at"] > SESSION_TTL_S]:
+            del reg["sessions"][old]
+
+# --------- Profiler theo phiên (admin bật cho N lượt chạy tới của 1 phiên) ----------
+# Admin chọn phiên trong registry bộ nhớ → phiên đó tự bật cProfile + bộ lấy mẫu stack ở đầu các lượt kế tiếp.
+# Mỗi lượt ra 3 file trong healing_data/profiles/: .prof (pstats/snakeviz), .collapsed (flamegraph.pl/speedscope)
+# và .json (kích thước doc lúc đo: số moods/journal/garden/quests, byte) để đọc đường nóng theo dữ liệu thật.
+PROFILE_DIR = DATA_DIR / "profiles"
+PROFILE_MAX_RUNS = 20
+PROFILE_SAMPLE_MS = 5
+
+@st.cache_resource(show_spinner=False)
+def _profile_requests() -> dict:
+    return {"lock": threading.Lock(), "armed": {}}   # sid -> {"runs", "by", "at", "captured": [...]}
+
+def profile_arm(sid: str, runs: int, by: str):
+    req = _profile_requests()
+    with req["lock"]:
+        req["armed"][sid] = {"runs": max(1, min(int(runs), PROFILE_MAX_RUNS)), "by": by, "at": _t.time(),
+                             "captured": []}
+
+def profile_disarm(sid: str):
+    req = _profile_requests()
+    with req["lock"]:
+        req["armed"].pop(sid, None)
+
+class _StackSampler:
+    """Lấy mẫu stack của 1 luồng mỗi `interval_s` → đếm theo stack gộp (định dạng collapsed)."""
+    def __init__(self, thread_id: int, interval_s: float):
+        self.thread_id, self.interval_s = thread_id, interval_s
+        self.counts: Counter = Counter()
+        self.stop_evt = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="hz-prof-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_evt.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                co = frame.f_code
+                stack.append(f"{co.co_name} ({Path(co.co_filename).name}:{co.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stop_evt.set(); self.thread.join(timeout=1)
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.counts.most_common())
+
+def profile_doc_sizes(data: dict) -> dict:
+    """Cỡ doc lúc đo, không nạp thêm mục nào (mục chờ có lát cắt → tổng số từ engine; không có → None)."""
+    game = data.get("game", {})
+    pending = getattr(game, "pending", ())
+    counts = {}
+    for kind in ENTITY_KINDS:
+        if kind in pending:
+            pv = game.preview(kind)
+            counts[kind] = pv["n"] if pv else None
+        else:
+            counts[kind] = len(dict.get(game, kind) or ())
+    loaded = {**data, "game": dict(dict.items(game))}
+    return {"counts": counts, "pending": list(pending),
+            "archived": {k: sum(m.get("n", 0) for m in v.values())
+                         for k, v in dict.get(game, "archive_index", {}).items()},
+            "json_bytes": len(json.dumps(loaded, ensure_ascii=False, default=str).encode("utf-8")),
+            "memory_bytes": deep_sizeof(data)}
+
+def profile_begin():
+    """Đầu lượt chạy: phiên đang được admin hẹn đo → bật cProfile + bộ lấy mẫu cho riêng lượt này."""
+    sid = st.session_state.get("_mem_sid")
+    if not sid:
+        return
+    req = _profile_requests()
+    with req["lock"]:
+        job = req["armed"].get(sid)
+        if not job or job["runs"] <= 0:
+            return
+        job["runs"] -= 1
+        run_no = len(job["captured"]) + 1
+    import cProfile
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:   # phiên khác đang giữ profiler (3.12+: 1 profiler/process) → chỉ lấy mẫu
+        prof = None
+    sampler = _StackSampler(threading.get_ident(), PROFILE_SAMPLE_MS / 1000)
+    sampler.start()
+    st.session_state["_prof_run"] = {"prof": prof, "sampler": sampler, "t0": _t.perf_counter(),
+                                     "sid": sid, "run": run_no}
+
+def profile_end():
+    """Cuối lượt (khối finally của __main__): dừng đo và ghi .prof / .collapsed / .json."""
+    run = st.session_state.pop("_prof_run", None)
+    if not run:
+        return
+    if run["prof"] is not None:
+        run["prof"].disable()
+    run["sampler"].stop()
+    wall_ms = (_t.perf_counter() - run["t0"]) * 1000
+    user = st.session_state.get("username") or "guest"
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    base = PROFILE_DIR / f"{datetime.utcnow():%Y%m%d-%H%M%S}_{_safe_name(user)}_{run['sid']}_r{run['run']}"
+    if run["prof"] is not None:
+        run["prof"].dump_stats(str(base) + ".prof")
+    Path(str(base) + ".collapsed").write_text(run["sampler"].collapsed(), encoding="utf-8")
+    meta = {"session": run["sid"], "user": user, "run": run["run"], "wall_ms": round(wall_ms, 1),
+            "samples": sum(run["sampler"].counts.values()), "sample_ms": PROFILE_SAMPLE_MS,
+            "cprofile": run["prof"] is not None, "at": datetime.utcnow().isoformat(),
+            "doc": profile_doc_sizes(st.session_state.get("user_data") or {})}
+    Path(str(base) + ".json").write_text(json.dumps(meta, ensure_ascii=False, indent=1), encoding="utf-8")
+    req = _profile_requests()
+    with req["lock"]:
+        job = req["armed"].get(run["sid"])
+        if job is not None:
+            job["captured"].append(base.name)
+    perf_inc("profile.captures")
+    perf_observe("profile.wall_ms", wall_ms)
+
+# --------- Ghi vết thao tác (record & replay) ----------
+# Bật bằng [trace] record = true hoặc HEALINGIZZ_TRACE=1. Mỗi phiên ghi 1 file NDJSON trong healing_data/traces/:
+# dòng đầu "meta", sau đó mỗi lượt chạy 1 dòng "step" gồm các widget đổi giá trị so với cuối lượt trước (tức là
+# thao tác của người dùng — giữa 2 lượt script không chạy), thời gian nghĩ, thời gian chạy và số lần ghi storage.
+# Ẩn danh: chữ nhập vào chỉ giữ độ dài, id/ngày trong key được thay bằng <id>/<day>, bỏ hẳn ô mật khẩu/PIN/thẻ.
+# `python healing_jobs.py replay-traces` phát lại các file này bằng AppTest trên storage local.
+TRACE_DIR = DATA_DIR / "traces"
+TRACE_VERSION = 1
+_TRACE_SKIP_RE = re.compile(r"password|pin|login_|signup_|scan")
+_TRACE_ID_RE = re.compile(r"[0-9a-f]{12,}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+_TRACE_DAY_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_trace_run: Optional[dict] = None   # = st.session_state["_trace"] của lượt đang chạy (script chạy lại → reset)
+
+@st.cache_resource(show_spinner=False)
+def _trace_enabled() -> bool:
+    raw = os.environ.get("HEALINGIZZ_TRACE") or _secrets_section("trace").get("record", False)
+    return str(raw).lower() in ("1", "true", "yes")
+
+def _trace_value(v):
+    """Giá trị widget → dạng JSON ẩn danh; None = không ghi (kiểu lạ)."""
+    if isinstance(v, bool) or isinstance(v, (int, float)):
+        return v
+    if isinstance(v, str):
+        return {"$text": len(v)}
+    if isinstance(v, dtime):
+        return {"$time": v.isoformat()}
+    if isinstance(v, date):
+        return {"$date": v.isoformat()}
+    if isinstance(v, (list, tuple)) and all(isinstance(x, (bool, int, float)) for x in v):
+        return list(v)
+    return None
+
+def _trace_state() -> dict:
+    out = {}
+    for k, v in st.session_state.items():
+        k = str(k)
+        if k.startswith("_") or _TRACE_SKIP_RE.search(k):
+            continue
+        tv = _trace_value(v)
+        if tv is not None:
+            out[k] = tv
+    return out
+
+def _trace_key(k: str) -> str:
+    return _TRACE_DAY_RE.sub("<day>", _TRACE_ID_RE.sub("<id>", k))
+
+def trace_begin():
+    """Đầu lượt chạy: so widget với cuối lượt trước → các thao tác vừa xảy ra."""
+    global _trace_run
+    if not _trace_enabled():
+        return
+    now = _t.perf_counter()
+    if "_trace" not in st.session_state:
+        TRACE_DIR.mkdir(parents=True, exist_ok=True)
+        f = TRACE_DIR / f"{datetime.utcnow():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}.ndjson"
+        st.session_state["_trace"] = {"file": str(f), "step": 0, "prev": {}, "end": now}
+        with open(f, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps({"type": "meta", "v": TRACE_VERSION, "app": APP_TITLE,
+                                 "engine": storage_engine_name(), "at": datetime.utcnow().isoformat()}) + "\n")
+    tr = _trace_run = st.session_state["_trace"]
+    cur = _trace_state()
+    events = [{"key": _trace_key(k), "value": v} for k, v in cur.items() if tr["prev"].get(k, None) != v]
+    tr.update(t0=now, events=events, writes0=perf_snapshot()["counters"].get("save.writes", 0),
+              gap_ms=round((now - tr["end"]) * 1000, 1), logged_in=bool(st.session_state.get("auth_user_id")))
+
+def trace_end():
+    """Cuối lượt (finally của __main__): ghi 1 dòng step, chụp lại giá trị widget cho lượt sau."""
+    tr = _trace_run
+    if not tr or "t0" not in tr:
+        return
+    end = _t.perf_counter()
+    # Sau st.stop() mọi lần đọc st.session_state đều ném StopException → chỉ dùng `tr` (đã giữ tham chiếu ở
+    # trace_begin); chụp widget thất bại thì giữ snapshot cũ, thao tác của lượt này dồn sang step sau.
+    try:
+        tr["logged_in"] = bool(st.session_state.get("auth_user_id"))
+        tr["prev"] = _trace_state()
+    except BaseException:
+        pass
+    tr["step"] += 1
+    step = {"type": "step", "i": tr["step"], "gap_ms": tr.pop("gap_ms"), "run_ms": round((end - tr.pop("t0")) * 1000, 1),
+            "writes": perf_snapshot()["counters"].get("save.writes", 0) - tr.pop("writes0"),
+            "logged_in": tr.pop("logged_in"), "events": tr.pop("events")}
+    try:
+        with open(tr["file"], "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(step, ensure_ascii=False) + "\n")
+    except OSError:
+        perf_inc("trace.write_errors")
+    tr["end"] = end
+
+def _process_rss() -> dict:
+    out = {}
+    try:
+        import resource
+        out["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linux: KB
+    except ImportError:
+        pass
+    try:
+        pages = int(Path("/proc/self/statm").read_text().split()[1])
+        out["rss"] = pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    return out
+
+def process_memory_report() -> dict:
+    """RSS của process, tổng các phiên (theo báo cáo gần nhất) và kích thước các cache dùng chung."""
+    reg = _memory_registry()
+    with reg["lock"]:
+        sessions = dict(reg["sessions"])
+    plans, trends, perf, sch = _quest_plan_cache(), _trend_cache(), _perf_registry(), _reminder_scheduler()
+    caches = {  # tên → (lock, object); đo trong lock để không duyệt dict đang bị luồng khác sửa
+        "quest_plans": (plans["lock"], plans["plans"]),
+        "trend_series": (trends["lock"], trends["series"]),
+        "reminders": (sch.cond, [sch.heap, sch.live, sch.sigs, sch.inbox]),
+        "perf": (perf["lock"], [perf["counters"], perf["timings"]]),
+    }
+    store = get_session_store()
+    if isinstance(store, MemorySessionStore):
+        caches["session_store"] = (store.lock, store.items)
+    sizes = {}
+    for name, (lock, obj) in caches.items():
+        with lock:
+            sizes[name] = deep_sizeof(obj)
+    return {**_process_rss(), "sessions": len(sessions),
+            "sessions_bytes": sum(v["total"] for v in sessions.values()),
+            "top_sessions": sorted(sessions.values(), key=lambda v: -v["total"])[:MEMORY_TOP_KEYS],
+            "caches": sizes}
+
 # =====================================================
 # 🧠 MongoDB Cloud Integration (Atlas)
 # =====================================================
-from pymongo import MongoClient, ASCENDING
-from pymongo.errors import PyMongoError
+ASCENDING = 1  # = pymongo.ASCENDING, khai báo sẵn để khỏi import pymongo lúc khởi động
+
+def _wire_compressors() -> list[str]:
+    """Nén đường truyền Mongo: zstd/snappy nếu có thư viện, luôn có zlib (stdlib)."""
+    out = []
+    for name, mod in (("zstd", "zstandard"), ("snappy", "snappy")):
+        try:
+            __import__(mod); out.append(name)
+        except ImportError:
+            pass
+    return out + ["zlib"]
 
 @st.cache_resource(show_spinner=False)
-def get_mongo_client() -> MongoClient:
+def get_mongo_client() -> "pymongo.MongoClient":
     """Tạo client MongoDB Atlas từ [mongo] trong .streamlit/secrets.toml"""
     import certifi
     mongo = st.secrets["mongo"]  # 🔹 Lấy section [mongo]
     uri = mongo["uri"]
 
     try:
-        client = MongoClient(
+        client = pymongo.MongoClient(
             uri,
             tls=True,
             tlsCAFile=certifi.where(),
@@ -109,8 +927,10 @@ def get_mongo_client() -> MongoClient:
             retryWrites=True,
             retryReads=True,
             appname="healingizz",
+            compressors=_wire_compressors(),
+            zlibCompressionLevel=6,
         )
-        client.admin.command("ping")  # test ping
+        # Không ping chặn ở đây: MongoClient tự kết nối ở nền, lệnh đầu tiên đi qua cloud_call có timeout riêng
         return client
     except Exception as e:
         st.error(
@@ -139,108 +959,1326 @@ def _mongo_col_auth():
         pass
     return col
 
+def _mongo_col_archive():
+    """Tầng lạnh: {user_id, kind, month, n, blob (JSON nén)} — 1 doc / user / loại / tháng."""
+    client = get_mongo_client()
+    mongo = st.secrets["mongo"]
+    col = client[mongo.get("db", "healingizz")][mongo.get("archive_col", "healing_archive")]
+    col.create_index([("user_id", ASCENDING), ("kind", ASCENDING), ("month", ASCENDING)], unique=True, background=True)
+    return col
+
+# --------- Circuit breaker cho cloud ----------
+class CloudUnavailable(RuntimeError):
+    """Cloud đang bị ngắt (breaker mở) — gọi lại sau, dùng local trong lúc chờ."""
+
+class _CloudBreaker:
+    """
+    Circuit breaker + timeout thích nghi cho mọi lệnh gọi Mongo.
+    - closed: gọi bình thường, đo độ trễ (SRTT/RTTVAR kiểu TCP) để tính timeout.
+    - open: sau `fail_threshold` lỗi liên tiếp → trả lỗi ngay, không chờ mạng.
+    - half_open: hết cooldown → 1 luồng nền ping thử; ok → closed, lỗi → open (cooldown x2).
+    """
+    def __init__(self, fail_threshold: int = 2, cooldown_s: float = 10.0, max_cooldown_s: float = 120.0,
+                 min_timeout_s: float = 1.0, max_timeout_s: float = 12.0):
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.fail_threshold = max(1, int(fail_threshold))
+        self.base_cooldown_s = float(cooldown_s)
+        self.cooldown_s = float(cooldown_s)
+        self.max_cooldown_s = float(max_cooldown_s)
+        self.opened_at = 0.0
+        self.min_timeout_s = float(min_timeout_s)
+        self.max_timeout_s = float(max_timeout_s)
+        self.srtt = None
+        self.rttvar = 0.0
+
+    def timeout_s(self) -> float:
+        """RTO = SRTT + 4·RTTVAR (RFC 6298), kẹp trong [min, max]. Chưa đo được → max."""
+        with self.lock:
+            if self.srtt is None:
+                return self.max_timeout_s
+            rto = self.srtt + 4 * self.rttvar
+        return min(self.max_timeout_s, max(self.min_timeout_s, rto))
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and (_t.time() - self.opened_at) >= self.cooldown_s:
+                self.state = "half_open"
+                threading.Thread(target=self._probe, name="hz-cloud-probe", daemon=True).start()
+            return False
+
+    def record_success(self, elapsed_s: float):
+        with self.lock:
+            if self.srtt is None:
+                self.srtt, self.rttvar = elapsed_s, elapsed_s / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - elapsed_s)
+                self.srtt = 0.875 * self.srtt + 0.125 * elapsed_s
+            self.failures = 0
+            if self.state != "closed":
+                self.state = "closed"
+                self.cooldown_s = self.base_cooldown_s
+        perf_observe("cloud.call_ms", elapsed_s * 1000)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open":
+                self.cooldown_s = min(self.max_cooldown_s, self.cooldown_s * 2)
+            if self.state == "half_open" or self.failures >= self.fail_threshold:
+                if self.state != "open":
+                    perf_inc("cloud.breaker_open")
+                self.state = "open"
+                self.opened_at = _t.time()
+        perf_inc("cloud.failures")
+
+    def _probe(self):
+        t0 = _t.perf_counter()
+        try:
+            with pymongo.timeout(self.timeout_s()):
+                get_mongo_client().admin.command("ping")
+        except Exception:
+            self.record_failure()
+            return
+        self.record_success(_t.perf_counter() - t0)
+
+    def is_open(self) -> bool:
+        with self.lock:
+            return self.state != "closed"
+
+def _secrets_section(name: str) -> dict:
+    """Đọc 1 section trong secrets.toml; không có file/section → {}."""
+    try:
+        return dict(st.secrets.get(name, {}) or {})
+    except Exception:
+        return {}
+
+@st.cache_resource(show_spinner=False)
+def _cloud_breaker() -> _CloudBreaker:
+    cfg = _secrets_section("cloud")
+    return _CloudBreaker(
+        fail_threshold=int(cfg.get("breaker_failures", 2)),
+        cooldown_s=float(cfg.get("breaker_cooldown_s", 10.0)),
+        min_timeout_s=float(cfg.get("min_timeout_s", 1.0)),
+        max_timeout_s=float(cfg.get("max_timeout_s", 12.0)),
+    )
+
+def _is_outage_error(e: Exception) -> bool:
+    """Lỗi mạng/timeout mới tính cho breaker; lỗi logic (trùng khóa...) thì không."""
+    if isinstance(e, pymongo.errors.ConnectionFailure) or getattr(e, "timeout", False):
+        return True
+    return not isinstance(e, pymongo.errors.PyMongoError)  # lỗi tạo client (URI/secrets/DNS) cũng coi là sập
+
+def cloud_call(fn, *args, **kwargs):
+    """Gọi `fn` qua breaker với timeout thích nghi. Breaker mở → raise CloudUnavailable ngay."""
+    br = _cloud_breaker()
+    if not br.allow():
+        perf_inc("cloud.short_circuit")
+        raise CloudUnavailable("Cloud tạm thời không khả dụng.")
+    t0 = _t.perf_counter()
+    try:
+        with pymongo.timeout(br.timeout_s()):
+            res = fn(*args, **kwargs)
+    except Exception as e:
+        if _is_outage_error(e):
+            br.record_failure()
+        raise
+    br.record_success(_t.perf_counter() - t0)
+    return res
+
+def cloud_available() -> bool:
+    return not _cloud_breaker().is_open()
+
 # --------- Cloud CRUD for user data ----------
+def _mongo_data_sets(user_id: str, data: dict) -> dict:
+    """
+    $set cho 1 lần lưu. Doc nạp đủ → thay cả `data`. Doc còn mục chờ (mới đọc lát cắt $slice) → chỉ $set
+    từng trường đã có trong bộ nhớ, mục chờ trên server giữ nguyên.
+    """
+    now = datetime.utcnow().isoformat()
+    game = data.get("game")
+    pending = getattr(game, "pending", ())
+    if not pending:
+        return {"user_id": user_id, "data": encode_text_fields(data), "updated_at": now}
+    enc = encode_text_fields({**data, "game": dict(dict.items(game))})
+    sets = {f"data.{k}": v for k, v in enc.items() if k != "game"}
+    sets.update({f"data.game.{k}": v for k, v in enc["game"].items()})
+    sets.update({"user_id": user_id, "updated_at": now})
+    return sets
+
 def _cloud_upsert_mongo(user_id: str, data: dict):
-    try:
+    def _op():
         col = _mongo_col_data()
-        col.update_one(
-            {"user_id": user_id},
-            {"$set": {
-                "user_id": user_id,
-                "data": data,
-                "updated_at": datetime.utcnow().isoformat()
-            }},
-            upsert=True
-        )
-    except PyMongoError as e:
+        col.update_one({"user_id": user_id}, {"$set": _mongo_data_sets(user_id, data)}, upsert=True)
+    try:
+        cloud_call(_op)
+    except CloudUnavailable:
+        pass  # đã lưu local, breaker sẽ tự thử lại ở nền
+    except pymongo.errors.PyMongoError as e:
         st.warning(f"⚠️ Không lưu được lên cloud Mongo: {e}")
 
+# Mục nặng chỉ đọc phần đuôi lúc đăng nhập (số bản ghi). Đủ cho trang hôm nay: 50 nhật ký của "Lịch sử nhật ký",
+# vườn vài tuần gần nhất. moods/quests nhỏ và cần trọn cho streak/xu hướng → đọc đủ.
+MONGO_TAILS = {"journal": 50, "garden": 60}
+
+def _mongo_partial_pipeline(user_id: str, tails: dict) -> list[dict]:
+    sets = {}
+    for kind, n in tails.items():
+        arr = {"$ifNull": [f"$data.game.{kind}", []]}
+        sets[f"data.game.{kind}"] = {"$slice": [arr, -n]}
+        sets[f"_part.{kind}.n"] = {"$size": arr}
+        sets[f"_part.{kind}.first"] = {"$arrayElemAt": [f"$data.game.{kind}.date", 0]}
+        if kind == "garden":   # rare_total của huy hiệu đọc từ đây, không cần nạp cả vườn
+            sets["_part.garden.rare"] = {"$size": {"$filter": {"input": arr, "cond": {
+                "$or": [{"$eq": ["$$this.rarity", "hiem"]}, {"$eq": ["$$this.rare", True]}]}}}}
+    return [{"$match": {"user_id": user_id}}, {"$limit": 1}, {"$set": sets}, {"$project": {"_id": 0}}]
+
+def _bson_size(doc: Optional[dict]) -> int:
+    """Số byte BSON của kết quả đọc (≈ byte truyền qua mạng, chưa tính nén wire)."""
+    if not doc:
+        return 0
+    return len(importlib.import_module("bson").encode(doc))
+
 def _cloud_load_mongo(user_id: str) -> Optional[dict]:
-    try:
+    def _op():
         col = _mongo_col_data()
-        doc = col.find_one({"user_id": user_id}, {"_id": 0})
-        return (doc or {}).get("data")
-    except PyMongoError as e:
+        return col.find_one({"user_id": user_id}, {"_id": 0})
+    try:
+        doc = cloud_call(_op)
+        perf_inc("mongo.bytes_in", _bson_size(doc))
+        data = (doc or {}).get("data")
+        return decode_text_fields(data) if data else data
+    except CloudUnavailable:
+        return None
+    except pymongo.errors.PyMongoError as e:
         st.warning(f"⚠️ Không tải được từ cloud Mongo: {e}")
         return None
 
-# --------- Auth on Mongo (username/password) ----------
-def _username_exists_mongo(username: str) -> bool:
+# --------- Local auth cache (dùng khi cloud bị ngắt) ----------
+# Đánh đổi bảo mật: file giữ bcrypt hash của người từng đăng nhập trên máy chủ này để vẫn đăng nhập được khi
+# Mongo ngắt. Ai đọc được DATA_DIR là dò mật khẩu offline được (bcrypt chỉ làm chậm) → chỉ cache khi engine
+# ở xa (sqlite/json đã có hash ngay trên máy), file quyền 0600, mỗi mục hết hạn sau AUTH_CACHE_TTL_S: đổi
+# mật khẩu / xóa tài khoản trên cloud vẫn dùng được offline tối đa chừng đó. Tài khoản không còn trên cloud
+# bị xóa khỏi cache ngay lần tra kế tiếp.
+AUTH_CACHE_FILE = DATA_DIR / "auth_cache.json"
+AUTH_CACHE_TTL_S = 7 * 86400
+
+@st.cache_resource(show_spinner=False)
+def _auth_cache_lock() -> threading.Lock:
+    return threading.Lock()
+
+def _auth_cache_load(include_expired: bool = False) -> dict:
+    try:
+        cache = json.loads(AUTH_CACHE_FILE.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+    if include_expired:
+        return cache
+    now = _t.time()
+    return {u: rec for u, rec in cache.items() if now - rec.get("at", 0) < AUTH_CACHE_TTL_S}
+
+def _auth_cache_write(cache: dict):
+    """tmp (0600) rồi os.replace: phiên đọc song song không thấy file ghi dở."""
+    tmp = AUTH_CACHE_FILE.with_name(AUTH_CACHE_FILE.name + ".tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as fh:
+        fh.write(json.dumps(cache, ensure_ascii=False))
+    os.replace(tmp, AUTH_CACHE_FILE)
+
+def _auth_cache_put(username: str, user_id: Optional[str] = None, pass_hash: Optional[str] = None):
+    """Ghi/làm mới 1 mục (đọc-sửa-ghi trong lock của process); user_id None → xóa mục. Mục hết hạn bị dọn luôn."""
+    with _auth_cache_lock():
+        cache = _auth_cache_load()
+        if user_id is None:
+            if username not in cache:
+                return
+            cache.pop(username)
+        else:
+            cache[username] = {"user_id": user_id, "pass_hash": pass_hash, "at": _t.time()}
+        try:
+            _auth_cache_write(cache)
+        except OSError:
+            perf_inc("auth_cache.write_errors")
+
+# --------- Auth (username/password) qua storage engine ----------
+def _username_exists(username: str) -> bool:
     try:
-        col = _mongo_col_auth()
-        doc = col.find_one({"username": username}, {"_id": 1})
-        return bool(doc)
+        return get_storage().find_account(username) is not None
     except Exception:
         return False
 
-def _create_user_mongo(username: str, password: str):
+def _create_user(username: str, password: str):
+    bcrypt = _bcrypt()
     if bcrypt is None:
         raise RuntimeError("Thiếu thư viện bcrypt. Hãy `pip install bcrypt` để dùng đăng ký/đăng nhập.")
     if len(username.strip()) < 3:
         raise RuntimeError("Tên người dùng tối thiểu 3 ký tự.")
     if len(password) < 6:
         raise RuntimeError("Mật khẩu tối thiểu 6 ký tự.")
-    if _username_exists_mongo(username.strip()):
+    if not cloud_available():
+        raise RuntimeError("Máy chủ cloud đang gián đoạn, vui lòng thử đăng ký lại sau ít phút.")
+    if _username_exists(username.strip()):
         raise RuntimeError("Tên người dùng đã tồn tại, vui lòng chọn tên khác.")
-    col = _mongo_col_auth()
     pass_hash = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-    res = col.insert_one({
-        "username": username.strip(),
-        "pass_hash": pass_hash,
-        "created_at": datetime.utcnow().isoformat()
-    })
-    # user_id = string of inserted id
-    return str(res.inserted_id)
+    return get_storage().create_account(username.strip(), pass_hash)
 
-def _login_user_mongo(username: str, password: str):
+def _login_user(username: str, password: str):
+    bcrypt = _bcrypt()
     if bcrypt is None:
         return None, "Thiếu thư viện bcrypt. Hãy `pip install bcrypt`."
-    col = _mongo_col_auth()
-    row = col.find_one({"username": username.strip()})
+    username = username.strip()
+    store, online = get_storage(), True
+    try:
+        row = store.find_account(username)
+    except Exception:
+        # Cloud ngắt → xác thực bằng hash đã cache từ lần đăng nhập thành công trước (chưa hết hạn)
+        row, online = (_auth_cache_load().get(username) if store.remote else None), False
+        if not row:
+            return None, "Máy chủ cloud đang gián đoạn, chưa thể đăng nhập tài khoản này."
     if not row:
+        if store.remote:
+            _auth_cache_put(username)   # tài khoản đã bị xóa trên cloud → bỏ hash cũ
         return None, "Sai username hoặc password."
     ok = bcrypt.checkpw(password.encode("utf-8"), row["pass_hash"].encode("utf-8"))
     if not ok:
         return None, "Sai username hoặc password."
-    return str(row["_id"]), None  # dùng _id làm auth_user_id
+    if store.remote and online:
+        _auth_cache_put(username, row["user_id"], row["pass_hash"])
+    return row["user_id"], None  # Mongo: _id của tài khoản; engine khác: uuid
+
+# ====== Storage engines (pluggable) ======
+# Chọn engine trong secrets.toml:
+#   [storage]
+#   engine = "mongo"          # mongo (mặc định) | sqlite | json
+#   sqlite_path = "healing_data/healingizz.db"
+# hoặc biến môi trường HEALINGIZZ_STORAGE (ưu tiên hơn secrets).
+ENTITY_KINDS = ("moods", "journal", "garden", "quests")
+
+def _safe_name(user_id: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', user_id)
+
+def _entity_date(kind: str, e: dict) -> str:
+    return e.get("completed_at", "") if kind == "quests" else e.get("date", "")
+
+def _split_entities(data: dict) -> tuple[dict, dict]:
+    """Tách doc thành (phần khung nhỏ, các list bản ghi lớn). Mục nạp trễ chưa được chạm thì bỏ qua."""
+    game = data.get("game", {})
+    pending = getattr(game, "pending", ())
+    ents = {k: game.get(k, {} if k == "quests" else []) for k in ENTITY_KINDS if k not in pending}
+    shell = {**data, "game": {k: v for k, v in dict.items(game) if k not in ENTITY_KINDS}}
+    return shell, ents
+
+LAZY_SECTIONS = ("journal", "garden", "quests")  # moods nhỏ + cần ngay cho check-in/streak → nạp luôn
+
+class LazyGame(dict):
+    """
+    `data["game"]` nạp trễ: mục nào có trong `loaders` chỉ đọc từ engine khi được chạm lần đầu
+    (game["journal"], .get, .setdefault, ...). Duyệt / serialize cả dict (items, json.dumps, copy, {**game})
+    sẽ nạp hết → code cũ dùng như dict thường vẫn đúng.
+    `previews`: lát cắt gần nhất engine đã đọc sẵn cho mục còn chờ ({"items", "n", "first"}, garden thêm "rare")
+    — xem game_recent, _section_total.
+    """
+    def __init__(self, base: dict, loaders: dict, previews: Optional[dict] = None):
+        super().__init__(base)
+        self._loaders = {k: fn for k, fn in loaders.items() if not dict.__contains__(self, k)}
+        self._previews = {k: v for k, v in (previews or {}).items() if k in self._loaders}
+
+    @property
+    def pending(self) -> tuple:
+        return tuple(self._loaders)
+
+    def preview(self, key) -> Optional[dict]:
+        return self._previews.get(key) if key in self._loaders else None
+
+    def peek(self, key, default=None):
+        """Như get, nhưng mục còn chờ mà có lát cắt sẵn thì trả lát cắt (không đọc engine)."""
+        pv = self.preview(key)
+        return pv["items"] if pv is not None else self.get(key, default)
+
+    def _load(self, key):
+        fn = self._loaders.get(key)
+        if fn is not None:
+            t0 = _t.perf_counter()
+            value = fn()   # lỗi (cloud ngắt) → mục vẫn chờ, không để lại list rỗng đè mất lịch sử khi lưu
+            self._loaders.pop(key, None); self._previews.pop(key, None)
+            dict.__setitem__(self, key, value)
+            perf_inc("lazy.section_loads")
+            perf_observe(f"lazy.load_{key}_ms", (_t.perf_counter() - t0) * 1000)
+
+    def _load_all(self):
+        for key in list(self._loaders):
+            self._load(key)
+
+    def __getitem__(self, key):
+        self._load(key); return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self._load(key); return dict.get(self, key, default)
+
+    def setdefault(self, key, default=None):
+        self._load(key); return dict.setdefault(self, key, default)
+
+    def pop(self, key, *default):
+        self._load(key); return dict.pop(self, key, *default)
+
+    def __setitem__(self, key, value):
+        self._loaders.pop(key, None); self._previews.pop(key, None); dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._loaders.pop(key, None); self._previews.pop(key, None); dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        for key in other:
+            self._loaders.pop(key, None); self._previews.pop(key, None)
+        dict.update(self, other)
+
+    def __contains__(self, key):
+        return key in self._loaders or dict.__contains__(self, key)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._loaders)
+
+    def __iter__(self):
+        self._load_all(); return dict.__iter__(self)
+
+    def keys(self):
+        self._load_all(); return dict.keys(self)
+
+    def values(self):
+        self._load_all(); return dict.values(self)
+
+    def items(self):
+        self._load_all(); return dict.items(self)
+
+    def copy(self):
+        self._load_all(); return dict(dict.items(self))
+
+    def __eq__(self, other):
+        self._load_all(); return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+def game_recent(data: dict, kind: str, default=None):
+    """Bản ghi gần đây của 1 mục: cả mục nếu đã nạp, lát cắt nếu engine mới đọc phần đuôi — không đọc thêm."""
+    game = data.get("game", {})
+    return game.peek(kind, default) if isinstance(game, LazyGame) else game.get(kind, default)
+
+class StorageEngine:
+    """
+    Giao diện lưu trữ chung:
+    - load/save nguyên doc user
+    - append_entity: thêm 1 bản ghi (moods/journal/garden/quests) không cần ghi lại cả doc
+    - query_range: lấy bản ghi trong khoảng ngày [start, end)
+    - tài khoản (auth) và rollup lớp cho trang tư vấn
+    """
+    name = "base"
+    remote = False  # True → có thể rớt mạng, cần bản sao local
+
+    def load(self, user_id: str) -> Optional[dict]: raise NotImplementedError
+    def save(self, user_id: str, data: dict): raise NotImplementedError
+    def iter_user_ids(self): raise NotImplementedError
+
+    def load_lazy(self, user_id: str, sections: tuple = LAZY_SECTIONS) -> Optional[dict]:
+        """Như load nhưng `sections` có thể nạp trễ (LazyGame). Engine 1-doc đọc cả doc một lần nên nạp luôn."""
+        return self.load(user_id)
+
+    _delta_lock = threading.Lock()
+
+    def apply_delta(self, user_id: str, delta: dict) -> dict:
+        """
+        Gộp thay đổi của 1 bên ghi giữ doc lâu (kiosk): delta = {"game": bản ghi mới + streak/badge/quest_counts,
+        "profile": trường đổi}. Đọc bản mới nhất → _merge_user_docs → ghi, nên không đè thay đổi từ nơi khác.
+        Gửi lại cùng delta không nhân đôi bản ghi. Trả về doc sau gộp (cho bản sao local).
+        """
+        with self._delta_lock:   # chỉ trong 1 process; engine local chỉ có 1 process ghi
+            data = self.load(user_id) or init_user_state(user_id)
+            _merge_user_docs(data, delta)
+            data.setdefault("profile", {}).update(delta.get("profile") or {})
+            data["user_id"] = user_id
+            self.save(user_id, data)
+            return data
+
+    def apply_deltas(self, items: list[tuple[str, dict]]):
+        """apply_delta cho nhiều user (ingest). Mặc định lần lượt; lỗi được ném ra để bên gọi báo lại cả nhóm."""
+        for user_id, delta in items:
+            self.apply_delta(user_id, delta)
+
+    def append_entity(self, user_id: str, kind: str, entity: dict):
+        data = self.load(user_id) or init_user_state(user_id)
+        game = data.setdefault("game", {})
+        if kind == "quests":
+            game.setdefault("quests", {})[entity["quest_id"]] = entity
+        else:
+            game.setdefault(kind, []).append(entity)
+        self.save(user_id, data)
+
+    def query_range(self, user_id: str, kind: str, start: str, end: str) -> list[dict]:
+        data = self.load(user_id) or {}
+        items = data.get("game", {}).get(kind, [])
+        items = list(items.values()) if isinstance(items, dict) else items
+        return [e for e in items if start <= _entity_date(kind, e) < end]
+
+    # --- tầng lưu trữ lạnh: mỗi (user, kind, tháng) 1 khối nén; mặc định là file trong DATA_DIR/archive/<user>/
+    def _archive_dir(self, user_id: str) -> Path:
+        return DATA_DIR / "archive" / _safe_name(user_id)
+
+    def archive_put(self, user_id: str, kind: str, month: str, items: list[dict]) -> list[dict]:
+        """Gộp `items` vào khối tháng (bỏ trùng) rồi ghi lại; trả về toàn bộ bản ghi của tháng."""
+        d = self._archive_dir(user_id); d.mkdir(parents=True, exist_ok=True)
+        merged = _archive_merge(self.archive_get(user_id, kind, month), items, kind)
+        f = d / f"{kind}-{month}.json"
+        tmp = f.with_name(f.name + ".tmp")
+        tmp.write_bytes(_archive_pack(merged))
+        os.replace(tmp, f)
+        return merged
+
+    def archive_get(self, user_id: str, kind: str, month: str) -> list[dict]:
+        f = self._archive_dir(user_id) / f"{kind}-{month}.json"
+        return _archive_unpack(f.read_bytes()) if f.exists() else []
+
+    # --- auth
+    def find_account(self, username: str) -> Optional[dict]: raise NotImplementedError
+    def create_account(self, username: str, pass_hash: str) -> str: raise NotImplementedError
+
+    # --- rollup cho trang tư vấn (engine không hỗ trợ → NotImplementedError)
+    def rollup_inc(self, cohort: str, day: str, mood: int, user_id: str): raise NotImplementedError
+    def rollup_range(self, cohort: str, since: str) -> list[dict]: raise NotImplementedError
+    def cohort_set_member(self, cohort: str, user_id: str, nickname: str, old_cohort: Optional[str] = None):
+        raise NotImplementedError
+    def cohorts(self) -> list[dict]: raise NotImplementedError
+
+
+class JsonFileEngine(StorageEngine):
+    """Mỗi user 1 file JSON trong `root` (giống lưu local cũ, nhưng đặt tên theo user_id)."""
+    name = "json"
+
+    def __init__(self, root: Path):
+        self.root = Path(root); self.root.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def _path(self, user_id: str) -> Path:
+        return self.root / f"{_safe_name(user_id)}.json"
+
+    def _archive_dir(self, user_id: str) -> Path:
+        return self.root / "archive" / _safe_name(user_id)
+
+    def load(self, user_id: str) -> Optional[dict]:
+        f = self._path(user_id)
+        if not f.exists():
+            return None
+        return read_snapshot(f)
+
+    def save(self, user_id: str, data: dict):
+        write_snapshot(self._path(user_id), data)
+
+    def iter_user_ids(self):
+        for f in sorted(self.root.glob("*.json")):
+            if f.name != "accounts.json":
+                yield f.stem
+
+    def _accounts(self) -> dict:
+        f = self.root / "accounts.json"
+        return json.loads(f.read_text(encoding="utf-8")) if f.exists() else {}
+
+    def find_account(self, username: str) -> Optional[dict]:
+        return self._accounts().get(username)
+
+    def create_account(self, username: str, pass_hash: str) -> str:
+        with self.lock:
+            acc = self._accounts()
+            if username in acc:
+                raise RuntimeError("Tên người dùng đã tồn tại, vui lòng chọn tên khác.")
+            uid = uuid.uuid4().hex
+            acc[username] = {"user_id": uid, "pass_hash": pass_hash, "created_at": datetime.utcnow().isoformat()}
+            (self.root / "accounts.json").write_text(json.dumps(acc, ensure_ascii=False), encoding="utf-8")
+            return uid
+
+
+class MongoEngine(StorageEngine):
+    """Mongo Atlas (mặc định). Mọi lệnh đi qua circuit breaker."""
+    name = "mongo"
+    remote = True
+
+    def load(self, user_id: str) -> Optional[dict]:
+        return _cloud_load_mongo(user_id)
+
+    def save(self, user_id: str, data: dict):
+        _cloud_upsert_mongo(user_id, data)
+
+    def iter_user_ids(self):
+        for d in _mongo_col_data().find({}, {"_id": 0, "user_id": 1}).sort("user_id", ASCENDING):
+            yield d["user_id"]
+
+    def load_lazy(self, user_id: str, sections: tuple = LAZY_SECTIONS) -> Optional[dict]:
+        """
+        1 aggregate: cả doc trừ các mục nặng trong MONGO_TAILS chỉ lấy phần đuôi ($slice) kèm tổng số bản ghi.
+        Mục bị cắt thành mục chờ của LazyGame (lát cắt làm preview) → đọc đủ khi người dùng lùi về lịch sử.
+        """
+        tails = {k: n for k, n in MONGO_TAILS.items() if k in sections}
+        if not tails:
+            return self.load(user_id)
+        try:
+            doc = cloud_call(lambda: next(_mongo_col_data().aggregate(_mongo_partial_pipeline(user_id, tails)), None))
+        except CloudUnavailable:
+            return None
+        except pymongo.errors.PyMongoError as e:
+            st.warning(f"⚠️ Không tải được từ cloud Mongo: {e}")
+            return None
+        nbytes = _bson_size(doc)
+        perf_inc("mongo.bytes_in", nbytes)
+        perf_observe("login.doc_bytes", nbytes)
+        if not doc or not doc.get("data"):
+            return None
+        data = decode_text_fields(doc["data"])
+        game = data.setdefault("game", {})
+        loaders, previews = {}, {}
+        for kind in tails:
+            meta = (doc.get("_part") or {}).get(kind) or {}
+            items = game.get(kind) or []
+            if int(meta.get("n", 0)) > len(items):
+                previews[kind] = {"items": game.pop(kind), "n": int(meta["n"]), "first": meta.get("first")}
+                if "rare" in meta:
+                    previews[kind]["rare"] = int(meta["rare"])
+                loaders[kind] = (lambda k=kind: self._load_section(user_id, k))
+        if loaders:
+            data["game"] = LazyGame(game, loaders, previews)
+        return data
+
+    def _load_section(self, user_id: str, kind: str):
+        doc = cloud_call(lambda: _mongo_col_data().find_one({"user_id": user_id},
+                                                            {"_id": 0, f"data.game.{kind}": 1}))
+        nbytes = _bson_size(doc)
+        perf_inc("mongo.bytes_in", nbytes)
+        perf_observe(f"mongo.section_{kind}_bytes", nbytes)
+        items = ((doc or {}).get("data") or {}).get("game", {}).get(kind) or []
+        return [_map_entity_text(kind, e, _z_untext) for e in items]
+
+    def append_entity(self, user_id: str, kind: str, entity: dict):
+        entity = _map_entity_text(kind, entity, _text_packer())
+        if kind == "quests":
+            update = {"$set": {f"data.game.quests.{entity['quest_id']}": entity}}
+        else:
+            update = {"$push": {f"data.game.{kind}": entity}}
+        update.setdefault("$set", {})["updated_at"] = datetime.utcnow().isoformat()
+        cloud_call(lambda: _mongo_col_data().update_one({"user_id": user_id}, update, upsert=True))
+
+    def apply_delta(self, user_id: str, delta: dict) -> dict:
+        """
+        Bản ghi/badge gộp bằng $addToSet (gửi lại không nhân đôi), quest_counts bằng $max, quest/profile bằng $set
+        — 1 lệnh nguyên tử, trả về bản trước khi ghi. Trường suy ra (streak, week_summary) tính từ bản đó + delta
+        rồi $set ở lệnh thứ 2. Lỗi cloud được ném ra để bên gọi giữ delta và gửi lại.
+        """
+        g, pack = delta.get("game", {}), _text_packer()
+        ops = {"$set": {"user_id": user_id, "updated_at": datetime.utcnow().isoformat()}}
+        add = {f"data.game.{k}": {"$each": [_map_entity_text(k, e, pack) for e in g[k]]}
+               for k in ("moods", "journal", "garden") if g.get(k)}
+        add.update({f"data.game.{k}": {"$each": g[k]} for k in ("badges", "badge_ids") if g.get(k)})
+        if add:
+            ops["$addToSet"] = add
+        if g.get("quest_counts"):
+            ops["$max"] = {f"data.game.quest_counts.{t}": n for t, n in g["quest_counts"].items()}
+        ops["$set"].update({f"data.game.quests.{qid}": _map_entity_text("quests", rec, pack)
+                            for qid, rec in (g.get("quests") or {}).items()})
+        ops["$set"].update({f"data.profile.{k}": v for k, v in (delta.get("profile") or {}).items()})
+        before = cloud_call(lambda: _mongo_col_data().find_one_and_update(
+            {"user_id": user_id}, ops, projection={"_id": 0, "data": 1}, upsert=True))
+        data = decode_text_fields(before["data"]) if before and before.get("data") else init_user_state(user_id)
+        _merge_user_docs(data, delta)
+        data.setdefault("profile", {}).update(delta.get("profile") or {})
+        data["user_id"] = user_id
+        derived = {f"data.game.{k}": data["game"].get(k) for k in ("streak", "last_checkin_date", "longest_streak",
+                                                                  "streak_history", "quest_plan", "week_summary")}
+        cloud_call(lambda: _mongo_col_data().update_one({"user_id": user_id}, {"$set": derived}))
+        return data
+
+    def apply_deltas(self, items: list[tuple[str, dict]]):
+        """Mỗi user 2 lệnh (xem apply_delta) → chạy song song trên pool luồng prefetch; đợi hết rồi ném lỗi đầu tiên."""
+        futures = [_prefetch_pool().submit(self.apply_delta, uid, delta) for uid, delta in items]
+        errors = [f.exception() for f in futures]
+        first = next((e for e in errors if e is not None), None)
+        if first is not None:
+            raise first
+
+    def query_range(self, user_id: str, kind: str, start: str, end: str) -> list[dict]:
+        if kind == "quests":
+            return super().query_range(user_id, kind, start, end)
+        pipeline = [
+            {"$match": {"user_id": user_id}},
+            {"$project": {"_id": 0, "items": {"$filter": {
+                "input": f"$data.game.{kind}", "as": "e",
+                "cond": {"$and": [{"$gte": ["$$e.date", start]}, {"$lt": ["$$e.date", end]}]}}}}},
+        ]
+        rows = cloud_call(lambda: list(_mongo_col_data().aggregate(pipeline)))
+        items = rows[0]["items"] if rows and rows[0].get("items") else []
+        return [_map_entity_text(kind, e, _z_untext) for e in items]
+
+    def archive_put(self, user_id: str, kind: str, month: str, items: list[dict]) -> list[dict]:
+        merged = _archive_merge(self.archive_get(user_id, kind, month), items, kind)
+        cloud_call(lambda: _mongo_col_archive().update_one(
+            {"user_id": user_id, "kind": kind, "month": month},
+            {"$set": {"n": len(merged), "blob": _archive_pack(merged), "updated_at": datetime.utcnow().isoformat()}},
+            upsert=True))
+        return merged
+
+    def archive_get(self, user_id: str, kind: str, month: str) -> list[dict]:
+        row = cloud_call(lambda: _mongo_col_archive().find_one({"user_id": user_id, "kind": kind, "month": month},
+                                                               {"_id": 0, "blob": 1}))
+        return _archive_unpack(bytes(row["blob"])) if row else []
+
+    def find_account(self, username: str) -> Optional[dict]:
+        row = cloud_call(lambda: _mongo_col_auth().find_one({"username": username}))
+        return {"user_id": str(row["_id"]), "pass_hash": row["pass_hash"]} if row else None
+
+    def create_account(self, username: str, pass_hash: str) -> str:
+        res = cloud_call(lambda: _mongo_col_auth().insert_one({
+            "username": username,
+            "pass_hash": pass_hash,
+            "created_at": datetime.utcnow().isoformat()
+        }))
+        # user_id = string of inserted id
+        return str(res.inserted_id)
+
+    def rollup_inc(self, cohort: str, day: str, mood: int, user_id: str):
+        update = {"$inc": {"count": 1, "sum": mood, f"hist.{mood}": 1}}
+        if mood <= LOW_MOOD_MAX:
+            update["$addToSet"] = {"low_users": user_id}
+        cloud_call(lambda: _mongo_col_rollups().update_one({"cohort": cohort, "day": day}, update, upsert=True))
+
+    def rollup_range(self, cohort: str, since: str) -> list[dict]:
+        return cloud_call(lambda: list(_mongo_col_rollups().find(
+            {"cohort": cohort, "day": {"$gte": since}}, {"_id": 0}).sort("day", ASCENDING)))
+
+    def cohort_set_member(self, cohort: str, user_id: str, nickname: str, old_cohort: Optional[str] = None):
+        def _op():
+            col = _mongo_col_cohorts()
+            if old_cohort and old_cohort != cohort:
+                col.update_one({"cohort": old_cohort}, {"$unset": {f"members.{user_id}": ""}})
+            col.update_one({"cohort": cohort}, {"$set": {f"members.{user_id}": nickname}}, upsert=True)
+        cloud_call(_op)
+
+    def cohorts(self) -> list[dict]:
+        return cloud_call(lambda: list(_mongo_col_cohorts().find({}, {"_id": 0})))
+
+
+class SqliteEngine(StorageEngine):
+    """
+    SQLite ở chế độ WAL cho triển khai 1 máy chủ / chạy thử không cần Atlas.
+    Khung doc nằm ở `users`, còn moods/journal/garden/quests là bảng riêng có index (user_id, date)
+    → lưu lại chỉ ghi dòng mới / dòng đổi nội dung (so hash `h`), truy vấn theo ngày không phải đọc cả doc.
+    """
+    name = "sqlite"
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, doc TEXT NOT NULL, updated_at TEXT);
+    CREATE TABLE IF NOT EXISTS moods (user_id TEXT NOT NULL, seq INTEGER NOT NULL, date TEXT NOT NULL,
+        mood INTEGER NOT NULL, doc TEXT NOT NULL, h TEXT, PRIMARY KEY (user_id, seq));
+    CREATE INDEX IF NOT EXISTS moods_user_date ON moods (user_id, date);
+    CREATE TABLE IF NOT EXISTS journal (user_id TEXT NOT NULL, seq INTEGER NOT NULL, date TEXT NOT NULL,
+        title TEXT, doc TEXT NOT NULL, h TEXT, PRIMARY KEY (user_id, seq));
+    CREATE INDEX IF NOT EXISTS journal_user_date ON journal (user_id, date);
+    CREATE TABLE IF NOT EXISTS garden (user_id TEXT NOT NULL, seq INTEGER NOT NULL, date TEXT NOT NULL,
+        doc TEXT NOT NULL, h TEXT, PRIMARY KEY (user_id, seq));
+    CREATE INDEX IF NOT EXISTS garden_user_date ON garden (user_id, date);
+    CREATE TABLE IF NOT EXISTS quests (user_id TEXT NOT NULL, quest_id TEXT NOT NULL, seq INTEGER NOT NULL,
+        type TEXT, date TEXT NOT NULL, doc TEXT NOT NULL, h TEXT, PRIMARY KEY (user_id, quest_id));
+    CREATE INDEX IF NOT EXISTS quests_user_date ON quests (user_id, date);
+    CREATE TABLE IF NOT EXISTS accounts (username TEXT PRIMARY KEY, user_id TEXT UNIQUE NOT NULL,
+        pass_hash TEXT NOT NULL, created_at TEXT);
+    CREATE TABLE IF NOT EXISTS rollups (cohort TEXT NOT NULL, day TEXT NOT NULL, count INTEGER NOT NULL,
+        sum INTEGER NOT NULL, hist TEXT NOT NULL, low_users TEXT NOT NULL, PRIMARY KEY (cohort, day));
+    CREATE TABLE IF NOT EXISTS cohorts (cohort TEXT NOT NULL, user_id TEXT NOT NULL, nickname TEXT,
+        PRIMARY KEY (cohort, user_id));
+    CREATE TABLE IF NOT EXISTS archive (user_id TEXT NOT NULL, kind TEXT NOT NULL, month TEXT NOT NULL,
+        n INTEGER NOT NULL, blob BLOB NOT NULL, PRIMARY KEY (user_id, kind, month));
+    """
+
+    def __init__(self, path: Path):
+        import sqlite3
+        self.path = Path(path); self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.executescript(self.SCHEMA)
+        for kind in ENTITY_KINDS:   # DB tạo trước khi có cột h: dòng h NULL được ghi lại 1 lần ở lần lưu sau
+            if "h" not in {r[1] for r in self.db.execute(f"PRAGMA table_info({kind})")}:
+                self.db.execute(f"ALTER TABLE {kind} ADD COLUMN h TEXT")
+
+    @staticmethod
+    def _json(obj: dict) -> tuple[str, str]:
+        """(JSON của 1 dòng, hash nội dung) — hash để biết dòng nào đổi mà không phải đọc lại doc trong DB."""
+        raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+        return raw, hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest()
+
+    @staticmethod
+    def _pack(raw: str):
+        """JSON của 1 dòng; dài hơn text_threshold thì lưu BLOB nén."""
+        if len(raw) < _compression_config()["text_threshold"]:
+            return raw
+        packed = z_pack(raw.encode("utf-8"))
+        return packed if len(packed) < len(raw.encode("utf-8")) else raw
+
+    @staticmethod
+    def _unpack(v) -> dict:
+        return json.loads(z_unpack(v).decode("utf-8") if isinstance(v, bytes) else v)
+
+    @classmethod
+    def _row(cls, kind: str, user_id: str, seq: int, e: dict, js: Optional[tuple] = None) -> tuple:
+        raw, h = js or cls._json(e)
+        doc = cls._pack(raw)
+        if kind == "moods":
+            return (user_id, seq, e.get("date", ""), int(e.get("mood", 0)), doc, h)
+        if kind == "journal":
+            return (user_id, seq, e.get("date", ""), e.get("title", ""), doc, h)
+        if kind == "quests":
+            return (user_id, e["quest_id"], seq, e.get("type"), e.get("completed_at", ""), doc, h)
+        return (user_id, seq, e.get("date", ""), doc, h)
+
+    _INSERT = {
+        "moods": "INSERT OR REPLACE INTO moods (user_id, seq, date, mood, doc, h) VALUES (?,?,?,?,?,?)",
+        "journal": "INSERT OR REPLACE INTO journal (user_id, seq, date, title, doc, h) VALUES (?,?,?,?,?,?)",
+        "garden": "INSERT OR REPLACE INTO garden (user_id, seq, date, doc, h) VALUES (?,?,?,?,?)",
+        "quests": "INSERT OR REPLACE INTO quests (user_id, quest_id, seq, type, date, doc, h) VALUES (?,?,?,?,?,?,?)",
+    }
+
+    def _load_kind(self, user_id: str, kind: str):
+        with self.lock:
+            rows = self.db.execute(f"SELECT doc FROM {kind} WHERE user_id=? ORDER BY seq", (user_id,)).fetchall()
+        items = [self._unpack(r[0]) for r in rows]
+        return {q["quest_id"]: q for q in items} if kind == "quests" else items
+
+    def load(self, user_id: str) -> Optional[dict]:
+        return self.load_lazy(user_id, sections=())
+
+    def load_lazy(self, user_id: str, sections: tuple = LAZY_SECTIONS) -> Optional[dict]:
+        with self.lock:
+            row = self.db.execute("SELECT doc FROM users WHERE user_id=?", (user_id,)).fetchone()
+            if not row:
+                return None
+            data = self._unpack(row[0])
+            game = data.setdefault("game", {})
+            for kind in ENTITY_KINDS:
+                if kind not in sections:
+                    game[kind] = self._load_kind(user_id, kind)
+        if sections:
+            data["game"] = LazyGame(game, {k: (lambda k=k: self._load_kind(user_id, k))
+                                           for k in sections if k in ENTITY_KINDS})
+        return data
+
+    def _sync_kind(self, user_id: str, kind: str, items: list[dict]):
+        """
+        So hash từng dòng với DB (chỉ đọc cột h): ghi dòng mới + dòng đổi nội dung (sửa tại chỗ, migration),
+        xóa dòng không còn trong doc. Quests khớp theo quest_id, list khớp theo vị trí (seq).
+        """
+        rows = []
+        if kind == "quests":
+            have = {q: (seq, h) for q, seq, h in
+                    self.db.execute("SELECT quest_id, seq, h FROM quests WHERE user_id=?", (user_id,))}
+            next_seq = max((seq for seq, _ in have.values()), default=-1) + 1
+            for e in items:
+                js, old = self._json(e), have.pop(e["quest_id"], None)
+                if old is None:
+                    rows.append(self._row(kind, user_id, next_seq, e, js)); next_seq += 1
+                elif old[1] != js[1]:
+                    rows.append(self._row(kind, user_id, old[0], e, js))   # giữ thứ tự cũ
+            if have:
+                self.db.executemany("DELETE FROM quests WHERE user_id=? AND quest_id=?", [(user_id, q) for q in have])
+        else:
+            have = dict(self.db.execute(f"SELECT seq, h FROM {kind} WHERE user_id=?", (user_id,)).fetchall())
+            for i, e in enumerate(items):
+                js = self._json(e)
+                if have.get(i) != js[1]:
+                    rows.append(self._row(kind, user_id, i, e, js))
+            if any(seq >= len(items) for seq in have):
+                self.db.execute(f"DELETE FROM {kind} WHERE user_id=? AND seq>=?", (user_id, len(items)))
+        if rows:
+            self.db.executemany(self._INSERT[kind], rows)
+
+    def save(self, user_id: str, data: dict):
+        shell, ents = _split_entities(data)
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("INSERT INTO users (user_id, doc, updated_at) VALUES (?,?,?) "
+                                "ON CONFLICT(user_id) DO UPDATE SET doc=excluded.doc, updated_at=excluded.updated_at",
+                                # khung doc giữ dạng JSON thuần để json_extract() (rebuild_rollups) đọc được
+                                (user_id, json.dumps(shell, ensure_ascii=False, separators=(",", ":")),
+                                 datetime.utcnow().isoformat()))
+                for kind, items in ents.items():
+                    self._sync_kind(user_id, kind, list(items.values()) if kind == "quests" else items)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def iter_user_ids(self):
+        with self.lock:
+            ids = [r[0] for r in self.db.execute("SELECT user_id FROM users ORDER BY user_id")]
+        yield from ids
+
+    def append_entity(self, user_id: str, kind: str, entity: dict):
+        with self.lock:
+            if not self.db.execute("SELECT 1 FROM users WHERE user_id=?", (user_id,)).fetchone():
+                return super().append_entity(user_id, kind, entity)
+            seq = self.db.execute(f"SELECT COALESCE(MAX(seq) + 1, 0) FROM {kind} WHERE user_id=?",
+                                  (user_id,)).fetchone()[0]
+            self.db.execute(self._INSERT[kind], self._row(kind, user_id, seq, entity))
+
+    def query_range(self, user_id: str, kind: str, start: str, end: str) -> list[dict]:
+        with self.lock:
+            rows = self.db.execute(f"SELECT doc FROM {kind} WHERE user_id=? AND date>=? AND date<? ORDER BY date",
+                                   (user_id, start, end)).fetchall()
+        return [self._unpack(r[0]) for r in rows]
+
+    def archive_put(self, user_id: str, kind: str, month: str, items: list[dict]) -> list[dict]:
+        with self.lock:
+            merged = _archive_merge(self.archive_get(user_id, kind, month), items, kind)
+            self.db.execute("INSERT OR REPLACE INTO archive VALUES (?,?,?,?,?)",
+                            (user_id, kind, month, len(merged), _archive_pack(merged)))
+        return merged
+
+    def archive_get(self, user_id: str, kind: str, month: str) -> list[dict]:
+        with self.lock:
+            row = self.db.execute("SELECT blob FROM archive WHERE user_id=? AND kind=? AND month=?",
+                                  (user_id, kind, month)).fetchone()
+        return _archive_unpack(row[0]) if row else []
+
+    def find_account(self, username: str) -> Optional[dict]:
+        with self.lock:
+            row = self.db.execute("SELECT user_id, pass_hash FROM accounts WHERE username=?", (username,)).fetchone()
+        return {"user_id": row[0], "pass_hash": row[1]} if row else None
+
+    def create_account(self, username: str, pass_hash: str) -> str:
+        import sqlite3
+        uid = uuid.uuid4().hex
+        try:
+            with self.lock:
+                self.db.execute("INSERT INTO accounts (username, user_id, pass_hash, created_at) VALUES (?,?,?,?)",
+                                (username, uid, pass_hash, datetime.utcnow().isoformat()))
+        except sqlite3.IntegrityError:
+            raise RuntimeError("Tên người dùng đã tồn tại, vui lòng chọn tên khác.")
+        return uid
+
+    def rollup_inc(self, cohort: str, day: str, mood: int, user_id: str):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT count, sum, hist, low_users FROM rollups WHERE cohort=? AND day=?",
+                                      (cohort, day)).fetchone()
+                count, total, hist, low = (row[0], row[1], json.loads(row[2]), json.loads(row[3])) if row \
+                    else (0, 0, {}, [])
+                hist[str(mood)] = hist.get(str(mood), 0) + 1
+                if mood <= LOW_MOOD_MAX and user_id not in low:
+                    low.append(user_id)
+                self.db.execute("INSERT OR REPLACE INTO rollups VALUES (?,?,?,?,?,?)",
+                                (cohort, day, count + 1, total + mood, json.dumps(hist), json.dumps(low)))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def rollup_range(self, cohort: str, since: str) -> list[dict]:
+        with self.lock:
+            rows = self.db.execute("SELECT day, count, sum, hist, low_users FROM rollups "
+                                   "WHERE cohort=? AND day>=? ORDER BY day", (cohort, since)).fetchall()
+        return [{"cohort": cohort, "day": d, "count": c, "sum": s, "hist": json.loads(h), "low_users": json.loads(l)}
+                for d, c, s, h, l in rows]
+
+    def rebuild_rollups(self, since: str = "") -> int:
+        """Dựng lại rollup bằng SQL (tương đương pipeline backfill của Mongo)."""
+        cohort_expr = f"COALESCE(NULLIF(json_extract(u.doc, '$.profile.cohort'), ''), '{NO_COHORT}')"
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {cohort_expr} AS cohort, substr(m.date, 1, 10) AS day, m.mood, COUNT(*), "
+                f"group_concat(DISTINCT m.user_id) FROM moods m JOIN users u ON u.user_id = m.user_id "
+                f"WHERE m.date >= ? GROUP BY cohort, day, m.mood", (since,)).fetchall()
+            agg: dict[tuple, dict] = {}
+            for cohort, day, mood, n, users in rows:
+                r = agg.setdefault((cohort, day), {"count": 0, "sum": 0, "hist": {}, "low": set()})
+                r["count"] += n; r["sum"] += mood * n; r["hist"][str(mood)] = n
+                if mood <= LOW_MOOD_MAX:
+                    r["low"].update(users.split(","))
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("DELETE FROM rollups WHERE day >= ?", (since,))
+            self.db.executemany("INSERT INTO rollups VALUES (?,?,?,?,?,?)",
+                                [(c, d, r["count"], r["sum"], json.dumps(r["hist"]), json.dumps(sorted(r["low"])))
+                                 for (c, d), r in agg.items()])
+            self.db.execute("DELETE FROM cohorts")
+            self.db.execute(f"INSERT INTO cohorts SELECT {cohort_expr}, u.user_id, "
+                            f"COALESCE(json_extract(u.doc, '$.profile.nickname'), u.user_id) FROM users u")
+            self.db.execute("COMMIT")
+        return len(agg)
+
+    def cohort_set_member(self, cohort: str, user_id: str, nickname: str, old_cohort: Optional[str] = None):
+        with self.lock:
+            if old_cohort and old_cohort != cohort:
+                self.db.execute("DELETE FROM cohorts WHERE cohort=? AND user_id=?", (old_cohort, user_id))
+            self.db.execute("INSERT OR REPLACE INTO cohorts VALUES (?,?,?)", (cohort, user_id, nickname))
+
+    def cohorts(self) -> list[dict]:
+        with self.lock:
+            rows = self.db.execute("SELECT cohort, user_id, nickname FROM cohorts").fetchall()
+        out: dict[str, dict] = {}
+        for cohort, uid, nick in rows:
+            out.setdefault(cohort, {"cohort": cohort, "members": {}})["members"][uid] = nick
+        return list(out.values())
+
+
+def storage_engine_name() -> str:
+    return (os.environ.get("HEALINGIZZ_STORAGE") or _secrets_section("storage").get("engine") or "mongo").lower()
+
+def make_storage(name: Optional[str] = None) -> StorageEngine:
+    name = name or storage_engine_name()
+    cfg = _secrets_section("storage")
+    if name == "sqlite":
+        return SqliteEngine(Path(os.environ.get("HEALINGIZZ_SQLITE_PATH") or cfg.get("sqlite_path")
+                                 or DATA_DIR / "healingizz.db"))
+    if name == "json":
+        return JsonFileEngine(Path(cfg.get("json_dir") or DATA_DIR / "store"))
+    if name == "mongo":
+        return MongoEngine()
+    raise ValueError(f"Engine lưu trữ không hỗ trợ: {name!r} (mongo | sqlite | json)")
+
+@st.cache_resource(show_spinner=False)
+def _storage_singleton(name: str) -> StorageEngine:
+    return make_storage(name)
+
+def get_storage() -> StorageEngine:
+    return _storage_singleton(storage_engine_name())
+
+# --------- Warm-up khi khởi động ----------
+def _warm_backend():
+    """Luồng nền: import thư viện nặng và mở kết nối Mongo trong lúc học sinh còn đang gõ form đăng nhập."""
+    t0 = _t.perf_counter()
+    try:
+        _bcrypt()
+        if get_storage().remote:
+            cloud_call(lambda: get_mongo_client().admin.command("ping"))
+    except Exception:
+        pass  # breaker đã ghi nhận; lần gọi thật sẽ tự xử lý / báo lỗi
+    perf_observe("startup.warm_backend_ms", (_t.perf_counter() - t0) * 1000)
+
+@st.cache_resource(show_spinner=False)
+def _startup_warmup() -> threading.Thread:
+    """Chỉ 1 lần mỗi tiến trình, không chặn lượt render đầu tiên."""
+    th = threading.Thread(target=_warm_backend, name="hz-warmup", daemon=True)
+    th.start()
+    return th
+
+def _warm_asset_caches():
+    """Nạp sẵn nhạc mindful, ảnh cây và catalogue quest vào cache (gọi sau khi form đăng nhập đã hiện)."""
+    _load_audio_base64(MINDFUL_30S_FILE)
+    _load_tree_asset_base64()
+    _cache_first_existing(tuple(NORMAL_FILES))
+    _cache_first_existing(tuple(RARE_FILES))
+    _quest_catalogue()
+
+# --------- Tầng nóng / lạnh (archive theo tháng) ----------
+# [storage] hot_days = 180 (0 = tắt), archive_kinds = ["journal", "garden", "quests"]
+# Bản ghi cũ hơn hot_days (tính theo tháng trọn vẹn) rời doc làm việc sang khối nén theo tháng của engine.
+# game["archive_index"] = {kind: {"YYYY-MM": {"n": ..., "rare": ...}}} → UI biết tháng nào có để tải khi cần.
+ARCHIVE_KINDS_DEFAULT = ("journal", "garden", "quests")  # moods nhỏ và là nguồn của streak/rollup → bật khi cần
+ARCHIVE_CACHE_MONTHS = 6  # số khối tháng giữ trong 1 phiên
+
+@st.cache_resource(show_spinner=False)
+def _tiering_config() -> dict:
+    cfg = _secrets_section("storage")
+    return {"hot_days": int(os.environ.get("HEALINGIZZ_HOT_DAYS") or cfg.get("hot_days", 180)),
+            "kinds": tuple(k for k in cfg.get("archive_kinds", ARCHIVE_KINDS_DEFAULT) if k in ENTITY_KINDS)}
+
+def _archive_pack(items: list[dict]) -> bytes:
+    raw = json.dumps(items, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    algo = _compression_config()["algo"]
+    return z_pack(raw, algo if algo in _Z_TAGS else "zlib")  # tầng lạnh luôn nén
+
+def _archive_unpack(blob: bytes) -> list[dict]:
+    return json.loads(z_unpack(blob).decode("utf-8"))
+
+def _archive_key(kind: str, e: dict):
+    return e.get("quest_id") if kind == "quests" else (e.get("date"), e.get("id"))
+
+def _archive_merge(old: list[dict], new: list[dict], kind: str) -> list[dict]:
+    seen = {_archive_key(kind, e) for e in old}
+    return sorted(old + [e for e in new if _archive_key(kind, e) not in seen], key=lambda e: _entity_date(kind, e))
+
+def _archive_stats(kind: str, items: list[dict]) -> dict:
+    out = {"n": len(items)}
+    if kind == "garden":
+        out["rare"] = sum(1 for p in items if _is_rare_plant(p))
+    return out
+
+def _archive_target(data: dict) -> tuple[StorageEngine, str]:
+    """Đã đăng nhập → engine đang dùng; khách → file nén trong DATA_DIR/archive/<local_key>/."""
+    auth_user_id = st.session_state.get("auth_user_id")
+    if auth_user_id:
+        return get_storage(), auth_user_id
+    return StorageEngine(), data.get("user_id") or "local"
+
+def archive_cold_records(data: dict, store: StorageEngine, user_id: str, hot_days: Optional[int] = None) -> int:
+    """
+    Chuyển bản ghi thuộc các tháng trước (hôm nay - hot_days) sang tầng lạnh. Ghi archive xong mới gỡ khỏi doc
+    → lỗi giữa chừng chỉ để lại bản trùng (archive_put bỏ trùng ở lần sau). Trả về số bản ghi đã chuyển;
+    bên gọi tự save_user.
+    """
+    cfg = _tiering_config()
+    hot_days = cfg["hot_days"] if hot_days is None else hot_days
+    if hot_days <= 0:
+        return 0
+    cutoff_month = (_today_utc() - timedelta(days=hot_days)).isoformat()[:7]
+    ensure_search_index(data)  # index giữ cả bản ghi lạnh → tìm kiếm vẫn thấy, bấm vào mới tải
+    game = data.setdefault("game", {})
+    index = game.setdefault("archive_index", {})
+    pending = getattr(game, "pending", ())
+    moved = 0
+    for kind in cfg["kinds"]:
+        pv = game.preview(kind) if kind in pending else None
+        if pv and (pv.get("first") or "")[:7] >= cutoff_month:
+            continue   # bản ghi cũ nhất của mục còn nóng → khỏi đọc đủ mục chỉ để kiểm tra
+        items = game.get(kind) or ({} if kind == "quests" else [])
+        rows = list(items.values()) if kind == "quests" else items
+        by_month: dict[str, list] = {}
+        for e in rows:
+            month = _entity_date(kind, e)[:7]
+            if month and month < cutoff_month:
+                by_month.setdefault(month, []).append(e)
+        for month, old in sorted(by_month.items()):
+            merged = store.archive_put(user_id, kind, month, old)
+            index.setdefault(kind, {})[month] = _archive_stats(kind, merged)
+            gone = {_archive_key(kind, e) for e in old}
+            if kind == "quests":
+                for qid in gone:
+                    items.pop(qid, None)
+            else:
+                game[kind] = rows = [e for e in rows if _archive_key(kind, e) not in gone]
+            moved += len(old)
+    if moved:
+        perf_inc("archive.moved", moved)
+    return moved
+
+def archived_months(data: dict, kind: str) -> list[str]:
+    return sorted(data.get("game", {}).get("archive_index", {}).get(kind, {}))
+
+def archived_count(data: dict, kind: str, field: str = "n") -> int:
+    return sum(m.get(field, 0) for m in data.get("game", {}).get("archive_index", {}).get(kind, {}).values())
+
+def load_archived(data: dict, kind: str, month: str) -> list[dict]:
+    """Tải 1 tháng từ tầng lạnh khi người dùng lật về quá khứ; giữ tối đa ARCHIVE_CACHE_MONTHS tháng/phiên."""
+    cache = st.session_state.setdefault("_archive_cache", OrderedDict())
+    key = (kind, month)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    store, user_id = _archive_target(data)
+    t0 = _t.perf_counter()
+    items = store.archive_get(user_id, kind, month)
+    perf_observe("archive.load_ms", (_t.perf_counter() - t0) * 1000)
+    cache[key] = items
+    while len(cache) > ARCHIVE_CACHE_MONTHS:
+        cache.popitem(last=False)
+    return items
+
+def loaded_archive_items(kind: str) -> list[dict]:
+    """Các bản ghi lạnh của `kind` đã được tải trong phiên này."""
+    return [e for (k, _), items in st.session_state.get("_archive_cache", {}).items() if k == kind for e in items]
 
 # --------- High-level user state load/save ----------
+def _load_account_doc(auth_user_id: str, nickname_hint: str = "") -> tuple[dict, bool]:
+    """
+    Doc của tài khoản: ưu tiên storage engine; chưa có → lấy bản local (khóa theo user_id) rồi đẩy lên.
+    Không đụng session_state (chạy được trong luồng prefetch). Trả về (doc, cần merge khi cloud sống lại).
+    """
+    store = get_storage()
+    cloud_data = store.load_lazy(auth_user_id)
+    if cloud_data:
+        if nickname_hint and not cloud_data.get("profile", {}).get("nickname"):
+            cloud_data.setdefault("profile", {})["nickname"] = nickname_hint
+        if migrate_user_doc(cloud_data):
+            store.save(auth_user_id, cloud_data)
+        return cloud_data, False
+    local_data = _load_local(local_key_for(auth_user_id), nickname_hint)
+    migrate_user_doc(local_data)
+    local_data["user_id"] = auth_user_id
+    if store.remote and not cloud_available():
+        # Cloud ngắt: chạy bằng bản local, lần lưu đầu tiên khi cloud sống lại sẽ merge chứ không ghi đè
+        return local_data, True
+    store.save(auth_user_id, local_data)
+    return local_data, False
+
 def load_user_cloud_or_local(auth_user_id: str, nickname_hint: str = "") -> dict:
     """
-    Có auth_user_id → ưu tiên Mongo; nếu chưa có → dùng local & sync lên.
+    Có auth_user_id → bản prefetch lúc đăng nhập nếu có, không thì tải ngay (xem _load_account_doc).
+    Chưa đăng nhập → file local theo tên đăng nhập.
     """
     if auth_user_id:
-        cloud_data = _cloud_load_mongo(auth_user_id)
-        if cloud_data:
-            if nickname_hint and not cloud_data.get("profile", {}).get("nickname"):
-                cloud_data.setdefault("profile", {})["nickname"] = nickname_hint
-            return cloud_data
-        # Không có trên cloud → lấy local rồi đẩy lên
-        local_key = (f"user-{nickname_hint.strip().lower().replace(' ', '_')}"
-                     if nickname_hint else f"user-local-{auth_user_id}")
+        data, pending_merge = take_prefetched(auth_user_id) or _load_account_doc(auth_user_id, nickname_hint)
+        if pending_merge:
+            st.session_state["_cloud_pending_merge"] = True
+        return data
+    else:
+        local_key = local_key_for(username=st.session_state.get("username") or nickname_hint)
         local_data = _load_local(local_key, nickname_hint)
-        local_data["user_id"] = auth_user_id
-        _cloud_upsert_mongo(auth_user_id, local_data)
+        if migrate_user_doc(local_data):
+            _save_local(local_data)
         return local_data
-    else:
-        local_key = (f"user-{nickname_hint.strip().lower().replace(' ', '_')}"
-                     if nickname_hint else "user-local")
-        return _load_local(local_key, nickname_hint)
+
+# --------- Prefetch sau đăng nhập ----------
+# Đăng nhập thành công → luồng nền tải doc, nạp các mục LazyGame, lập quest hôm nay và làm nóng cache asset
+# trong lúc trình duyệt còn chạy hiệu ứng #healing-loader. Lượt render đầu chỉ việc lấy kết quả.
+PREFETCH_WAIT_S = 20   # quá hạn → bỏ, tải đồng bộ như cũ
+
+@st.cache_resource(show_spinner=False)
+def _prefetch_pool():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="hz-prefetch")
+
+def _prefetch_user(auth_user_id: str, nickname_hint: str) -> tuple[dict, bool]:
+    t0 = _t.perf_counter()
+    data, pending_merge = _load_account_doc(auth_user_id, nickname_hint)
+    game = data.get("game", {})
+    for kind in getattr(game, "pending", ()):
+        if game.preview(kind) is None:   # mục có lát cắt sẵn chỉ đọc đủ khi người dùng lùi về lịch sử
+            game.get(kind)
+    daily_quests(auth_user_id, k=3, data=data)
+    _badge_catalogue()
+    _warm_asset_caches()
+    perf_observe("login.prefetch_ms", (_t.perf_counter() - t0) * 1000)
+    return data, pending_merge
+
+def start_prefetch(auth_user_id: str, nickname_hint: str):
+    st.session_state["_login_t0"] = _t.perf_counter()
+    st.session_state["_prefetch"] = (auth_user_id, _prefetch_pool().submit(_prefetch_user, auth_user_id, nickname_hint))
+
+def take_prefetched(auth_user_id: str) -> Optional[tuple[dict, bool]]:
+    job = st.session_state.pop("_prefetch", None)
+    if not job or job[0] != auth_user_id:
+        return None
+    t0 = _t.perf_counter()
+    try:
+        out = job[1].result(timeout=PREFETCH_WAIT_S)
+    except Exception:
+        perf_inc("login.prefetch_failed")
+        return None
+    perf_observe("login.prefetch_wait_ms", (_t.perf_counter() - t0) * 1000)
+    perf_inc("login.prefetch_hit")
+    return out
+
+def report_time_to_interactive():
+    """Gọi cuối lượt chạy: lượt đầu tiên đã có user_data sau khi đăng nhập → ghi login.tti_ms."""
+    if "_login_t0" in st.session_state and "user_data" in st.session_state:
+        perf_observe("login.tti_ms", (_t.perf_counter() - st.session_state.pop("_login_t0")) * 1000)
+
+def _merge_user_docs(base: dict, other: dict) -> dict:
+    """Gộp `other` vào `base` (tại chỗ): hợp các list theo ngày, hợp quests/badges, lấy streak mới hơn."""
+    gb, go = base.setdefault("game", {}), (other or {}).get("game", {})
+    for key in ("moods", "journal", "garden"):
+        seen = {(x.get("date"), x.get("id")) for x in gb.get(key, [])}
+        extra = [x for x in go.get(key, []) if (x.get("date"), x.get("id")) not in seen]
+        if extra:
+            gb[key] = sorted(gb.get(key, []) + extra, key=lambda x: x.get("date", ""))
+    for qid, rec in go.get("quests", {}).items():
+        gb.setdefault("quests", {}).setdefault(qid, rec)
+    gb["badges"] = list(dict.fromkeys(gb.get("badges", []) + go.get("badges", [])))
+    gb["badge_ids"] = list(dict.fromkeys(gb.get("badge_ids", []) + go.get("badge_ids", [])))
+    for kind, months in go.get("archive_index", {}).items():
+        for month, meta in months.items():
+            gb.setdefault("archive_index", {}).setdefault(kind, {}).setdefault(month, meta)
+    qc = gb.setdefault("quest_counts", {})
+    for qt in {q.get("type") for q in gb.get("quests", {}).values()}:
+        if qt:
+            qc[qt] = max(qc.get(qt, 0), go.get("quest_counts", {}).get(qt, 0),
+                         sum(1 for q in gb["quests"].values() if q.get("type") == qt))
+    last_b, last_o = gb.get("last_checkin_date") or "", go.get("last_checkin_date") or ""
+    # cùng ngày mà bên kia dài hơn (ingest bù check-in cũ vào chỗ trống) → cũng lấy
+    if last_o > last_b or (last_o and last_o[:10] == last_b[:10] and int(go.get("streak", 0)) > int(gb.get("streak", 0))):
+        gb["last_checkin_date"], gb["streak"] = go["last_checkin_date"], go.get("streak", 0)
+        if "streak_history" in go:
+            gb["streak_history"] = go["streak_history"]
+    if "longest_streak" in gb or "longest_streak" in go:
+        gb["longest_streak"] = max(int(gb.get("longest_streak", 0)), int(go.get("longest_streak", 0)),
+                                   int(gb.get("streak", 0)))
+    if (go.get("quest_plan") or {}).get("day", "") > (gb.get("quest_plan") or {}).get("day", ""):
+        gb["quest_plan"] = go["quest_plan"]
+    gb["week_summary"] = week_summary_build(base)
+    return base
+
+# --------- Unit of work: mỗi lượt chạy (rerun) ghi tối đa 1 lần ----------
+# main() mở unit of work ở đầu lượt; save_user() trong lượt chỉ đánh dấu doc bẩn, còn ghi thật xảy ra
+# 1 lần ở uow_commit() (khối finally của __main__, chạy cả khi st.rerun()/st.stop()) hoặc ở uow_flush()
+# khi cần mốc rõ ràng (VD trước khi đăng xuất xóa user_data). Ngoài unit of work → ghi ngay như cũ.
+def uow_begin():
+    st.session_state["_uow"] = {"docs": {}, "requests": 0}
+
+def uow_commit() -> int:
+    """Ghi các doc bẩn của lượt này; trả về số lần ghi thật."""
+    uow = st.session_state.pop("_uow", None)
+    if not uow:
+        return 0
+    failed = None
+    for data in uow["docs"].values():
+        try:
+            _save_user_now(data)
+        except Exception as e:   # 1 doc lỗi không được chặn các doc còn lại
+            failed = failed or e
+    writes = len(uow["docs"])
+    if uow["requests"]:
+        perf_observe("save.requests_per_run", uow["requests"])
+        perf_observe("save.writes_per_run", writes)
+        perf_inc("save.coalesced", uow["requests"] - writes)
+    if failed is not None:
+        raise failed
+    return writes
+
+def uow_flush() -> int:
+    """Mốc commit giữa lượt: ghi ngay phần đã gom rồi mở unit of work mới."""
+    active = "_uow" in st.session_state
+    writes = uow_commit()
+    if active:
+        uow_begin()
+    return writes
 
 def save_user(data: dict):
+    """Yêu cầu lưu doc: trong unit of work → gom lại tới cuối lượt; ngoài → ghi ngay."""
+    perf_inc("save.requested")
+    uow = st.session_state.get("_uow")
+    if uow is None:
+        _save_user_now(data)
+        return
+    uow["docs"][id(data)] = data
+    uow["requests"] += 1
+
+def _save_user_now(data: dict):
     """
     Lưu song song:
-    - Local JSON (luôn)
-    - Cloud Mongo (nếu có auth_user_id)
+    - Local JSON (bản sao, khi engine ở xa như Mongo hoặc chưa đăng nhập)
+    - Storage engine (nếu có auth_user_id)
     """
-    nickname = data.get("profile", {}).get("nickname") or "local"
-    local_key = f"user-{nickname.strip().lower().replace(' ', '_')}"
-    _save_local({**data, "user_id": local_key})
-
+    perf_inc("save.writes")
+    store = get_storage()
     auth_user_id = st.session_state.get("auth_user_id")
+    # khóa cố định theo phiên đăng nhập → đổi nickname ở sidebar không tách ra file mới
+    local_key = local_key_for(auth_user_id or "", st.session_state.get("username") or "")
+    if store.remote or not auth_user_id:
+        _save_local({**data, "user_id": local_key})
+
+    if auth_user_id and store.remote and st.session_state.get("_cloud_pending_merge"):
+        if not cloud_available():
+            return  # vẫn đang ngắt → chỉ lưu local
+        cloud_data = store.load(auth_user_id)
+        if cloud_data is None and not cloud_available():
+            return
+        _merge_user_docs(data, cloud_data or {})
+        st.session_state.pop("_cloud_pending_merge", None)
+        _save_local({**data, "user_id": local_key})
     if auth_user_id:
         try:
-            _cloud_upsert_mongo(auth_user_id, {**data, "user_id": auth_user_id})
+            store.save(auth_user_id, {**data, "user_id": auth_user_id})
         except Exception as e:
             st.warning(f"⚠️ Lưu cloud chậm, đã lưu local: {e}")
 
@@ -277,7 +2315,7 @@ def auth_block():
                     if not u1 or not p1:
                         st.error("Nhập đầy đủ username và password.")
                     else:
-                        auth_id, err = _login_user_mongo(u1.strip(), p1)
+                        auth_id, err = _login_user(u1.strip(), p1)
                         if err:
                             st.error(err)
                         else:
@@ -285,6 +2323,7 @@ def auth_block():
                             st.session_state["username"] = u1.strip()
                             st.session_state["nickname"] = u1.strip()
                             st.session_state["just_logged_in"] = True
+                            start_prefetch(auth_id, u1.strip())
                             st.rerun(); st.stop()
             with tabs[1]:
                 with st.form("signup_form", clear_on_submit=False):
@@ -299,7 +2338,7 @@ def auth_block():
                         st.error("Mật khẩu nhập lại không khớp.")
                     else:
                         try:
-                            _create_user_mongo(u2.strip(), p2)
+                            _create_user(u2.strip(), p2)
                             st.success("Tạo tài khoản thành công. Bạn có thể đăng nhập ngay.")
                         except Exception as e:
                             st.error(f"Tạo tài khoản thất bại: {e}")
@@ -344,7 +2383,11 @@ def notify_achievement(title: str,
         "duration_ms": max(3000, int(duration_ms)),
     })
 
-    payload = _json.dumps([st.session_state["_hz_toasts"][-1]], ensure_ascii=False)
+    components.html(_hz_toast_html([st.session_state["_hz_toasts"][-1]]), height=0)
+
+def _hz_toast_html(items: list[dict]) -> str:
+    """HTML/JS hiện các toast; mỗi item tự hẹn giờ theo `start_ms` (epoch ms) ở phía trình duyệt."""
+    payload = _json.dumps(items, ensure_ascii=False)
     html = """
     <style>
       @keyframes hz_in { 0%{opacity:0; transform:translateX(24px)} 100%{opacity:1; transform:translateX(0)} }
@@ -404,7 +2447,7 @@ def notify_achievement(title: str,
       })();
     </script>
     """
-    components.html(html.replace("__PAYLOAD__", payload), height=0)
+    return html.replace("__PAYLOAD__", payload)
 
 def render_notifier():
     """Chuẩn hóa lại thời gian còn lại của các toast (giữ đúng 5s)."""
@@ -418,109 +2461,677 @@ def render_notifier():
     # Chỉ cần 'anchor' rỗng để đảm bảo wrap hiện diện, còn spawn từng cái đã lo trong notify_achievement.
     components.html('<div id="hz_wrap_fixed"></div>', height=0)
 
+# ====== Danh sách lịch sử ảo hóa (1 iframe thay cho 1 st.write mỗi dòng) ======
+# Server gửi dữ liệu gọn: mỗi dòng là 1 mảng ngắn + bảng tra (emoji, tên hoạt động lặp lại) và 1 template;
+# trình duyệt chỉ dựng các dòng đang nằm trong khung cuộn. Lịch sử dài hơn VLIST_PAGE_ROWS chia trang
+# để payload mỗi lượt có giới hạn — cả danh sách chỉ tốn 1 delta thay vì hàng trăm.
+VLIST_PAGE_ROWS = 1000
+VLIST_ROW_PX = 28
+VLIST_MAX_PX = 320
+
+def _hz_vlist_html(rows: list, template: str, tables: dict, height: int) -> str:
+    payload = _json.dumps({"rows": rows, "tpl": template, "tables": tables, "rowh": VLIST_ROW_PX},
+                          ensure_ascii=False, separators=(",", ":")).replace("</", "<\\/")
+    html = """
+    <style>
+      body{ margin:0 }
+      .hz_vl{ height:__H__px; overflow-y:auto; position:relative;
+              font-family: 'Segoe UI', system-ui, -apple-system, 'Segoe UI Emoji', sans-serif; font-size:15px }
+      .hz_vl .row{ position:absolute; left:0; right:0; padding:0 6px; white-space:nowrap; overflow:hidden;
+                   text-overflow:ellipsis; color:inherit }
+    </style>
+    <div class="hz_vl" id="hz_vl"><div id="hz_vl_sp"></div></div>
+    <script>
+      (function(){
+        const d = __PAYLOAD__, box = document.getElementById('hz_vl'), sp = document.getElementById('hz_vl_sp');
+        try { box.style.color = getComputedStyle(window.parent.document.body).color; } catch(e) {}
+        sp.style.height = (d.rows.length * d.rowh) + 'px';
+        const fmt = (r) => d.tpl.replace(/\\{(\\d+)(?::(\\w+))?\\}/g, (_, i, t) => {
+          const v = r[+i]; return t ? (d.tables[t][v] ?? v) : v;
+        });
+        let shown = [-1, -1];
+        function draw(){
+          const a = Math.max(0, Math.floor(box.scrollTop / d.rowh) - 5);
+          const b = Math.min(d.rows.length, Math.ceil((box.scrollTop + box.clientHeight) / d.rowh) + 5);
+          if (a === shown[0] && b === shown[1]) return;
+          shown = [a, b];
+          sp.replaceChildren();
+          for (let i = a; i < b; i++) {
+            const el = document.createElement('div');
+            el.className = 'row'; el.style.top = (i * d.rowh) + 'px'; el.style.lineHeight = d.rowh + 'px';
+            el.textContent = fmt(d.rows[i]);
+            sp.appendChild(el);
+          }
+        }
+        box.addEventListener('scroll', () => requestAnimationFrame(draw), {passive: true});
+        draw();
+      })();
+    </script>
+    """
+    return html.replace("__H__", str(height)).replace("__PAYLOAD__", payload)
+
+def render_history_list(rows: list, template: str, key: str, tables: Optional[dict] = None):
+    """rows: mảng các dòng (mới nhất trước), template kiểu "{0} — {1:emoji}" ({i:bảng} = tra bảng `tables`)."""
+    start = 0
+    if len(rows) > VLIST_PAGE_ROWS:
+        pages = range(0, len(rows), VLIST_PAGE_ROWS)
+        start = st.selectbox("Trang", pages, key=f"{key}_page",
+                             format_func=lambda i: f"{i + 1}–{min(i + VLIST_PAGE_ROWS, len(rows))} / {len(rows)}")
+    page = rows[start:start + VLIST_PAGE_ROWS]
+    height = min(VLIST_MAX_PX, len(page) * VLIST_ROW_PX + 4)
+    components.html(_hz_vlist_html(page, template, tables or {}, height), height=height + 8)
+
+# ====== Reminders (1 scheduler cho cả tiến trình) ======
+REMINDER_KINDS = {
+    # kind: (icon, tiêu đề, lời nhắc)
+    "breathe": ("🌬️", "Đến giờ hít thở", "Dành 1 phút cho bài thở 4-7-8 nhé."),
+    "checkin": ("📝", "Check-in tâm trạng", "Hôm nay bạn thấy thế nào?"),
+}
+REMINDERS_PER_USER_MAX = 10
+REMINDER_TZ_OFFSET_MIN = 7 * 60      # giờ Việt Nam; đổi bằng [reminders] tz_offset_min
+REMINDER_CLIENT_HORIZON_S = 12 * 3600  # hẹn giờ sẵn ở trình duyệt cho các lần nhắc trong 12h tới
+
+def reminder_next_fire(rem: dict, after: float) -> Optional[float]:
+    """Epoch (giây) của lần nhắc kế tiếp > `after`; `days` rỗng = mỗi ngày. Sai định dạng → None."""
+    try:
+        hh, mm = (int(x) for x in str(rem["time"]).split(":")[:2])
+        off = int(rem.get("tz_offset_min", REMINDER_TZ_OFFSET_MIN)) * 60
+        days = set(rem.get("days") or range(7))
+        base = datetime.utcfromtimestamp(after + off).replace(hour=hh, minute=mm, second=0, microsecond=0)
+    except Exception:
+        return None
+    for i in range(8):
+        cand = base + timedelta(days=i)
+        fire_at = (cand - datetime(1970, 1, 1)).total_seconds() - off
+        if cand.weekday() in days and fire_at > after:
+            return fire_at
+    return None
+
+class _ReminderScheduler:
+    """
+    Min-heap theo thời điểm nhắc kế tiếp cho mọi reminder của mọi user đang có trong tiến trình.
+    - Thêm/sửa/xóa: O(log n). Bản cũ không gỡ khỏi heap mà bị bỏ qua khi pop (so version);
+      khi rác nhiều hơn số reminder sống thì dựng lại heap 1 lần.
+    - 1 luồng nền ngủ trên Condition tới đúng thời điểm sớm nhất (không polling); đến giờ →
+      bỏ vào hộp thư của user rồi xếp lịch lần kế tiếp.
+    - Hộp thư không bị lấy mất khi đọc: mọi phiên đang mở của user (nhiều tab/thiết bị) đều thấy lần nhắc,
+      mỗi phiên tự nhớ cái đã hiện (`_rem_shown`); mục quá INBOX_TTL_S bị dọn.
+    Phạm vi: chỉ trong 1 tiến trình. Lịch của user chỉ vào heap khi có phiên của user chạy ở tiến trình này
+    (sync_user ở mỗi rerun) → user không mở app, hoặc đang mở ở replica khác, không nhận nhắc từ đây;
+    không có push/email ngoài trình duyệt đang mở.
+    """
+    INBOX_MAX = 5
+    INBOX_TTL_S = 2 * 3600
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap: list = []           # (fire_at, version, user_key, rid)
+        self.versions = itertools.count(1)
+        self.live: dict = {}           # user_key -> {rid: (version, fire_at, reminder)}
+        self.sigs: dict = {}           # user_key -> chữ ký list reminder đã sync
+        self.inbox: dict = {}          # user_key -> deque[(fire_at, rid, reminder)]
+        self.stale = 0
+        self.thread = threading.Thread(target=self._run, name="hz-reminders", daemon=True)
+        self.thread.start()
+
+    def _schedule(self, user_key: str, rem: dict, after: float):
+        mine = self.live.setdefault(user_key, {})
+        if rem["id"] in mine:
+            self.stale += 1
+        fire_at = reminder_next_fire(rem, after)
+        if fire_at is None:
+            mine.pop(rem["id"], None)
+            return
+        ver = next(self.versions)
+        mine[rem["id"]] = (ver, fire_at, rem)
+        heapq.heappush(self.heap, (fire_at, ver, user_key, rem["id"]))
+
+    def sync_user(self, user_key: str, reminders: list[dict]):
+        """Đồng bộ lịch của 1 user theo list trong doc; list không đổi → không làm gì."""
+        sig = json.dumps(reminders, sort_keys=True, ensure_ascii=False)
+        with self.cond:
+            if self.sigs.get(user_key) == sig:
+                return
+            self.sigs[user_key] = sig
+            now = time.time()
+            wanted = {r["id"]: r for r in reminders if r.get("id") and r.get("enabled", True)}
+            mine = self.live.setdefault(user_key, {})
+            for rid in [rid for rid in mine if rid not in wanted]:
+                del mine[rid]; self.stale += 1
+            for rid, rem in wanted.items():
+                if rid not in mine or mine[rid][2] != rem:
+                    self._schedule(user_key, dict(rem), now)
+            if not mine:
+                self.live.pop(user_key, None)
+                self.inbox.pop(user_key, None)
+            if self.stale > 1024 and self.stale > len(self.heap) // 2:
+                self.heap = [(f, v, u, r) for u, rems in self.live.items() for r, (v, f, _) in rems.items()]
+                heapq.heapify(self.heap)
+                self.stale = 0
+            self.cond.notify()
+
+    def _run(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    fire_at, ver, user_key, rid = heapq.heappop(self.heap)
+                    ent = self.live.get(user_key, {}).get(rid)
+                    if not ent or ent[0] != ver:
+                        self.stale = max(0, self.stale - 1)
+                        continue
+                    box = self.inbox.setdefault(user_key, deque(maxlen=self.INBOX_MAX))
+                    while box and box[0][0] < now - self.INBOX_TTL_S:
+                        box.popleft()
+                    box.append((fire_at, rid, ent[2]))
+                    perf_inc("reminders.fired")
+                    self._schedule(user_key, ent[2], fire_at)
+                    self.stale -= 1   # _schedule vừa tính bản vừa pop là rác
+                self.cond.wait(self.heap[0][0] - now if self.heap else None)
+
+    def fired(self, user_key: str) -> list[tuple]:
+        """Các lần nhắc đã tới trong INBOX_TTL_S của user (không xóa: phiên khác của user cũng cần thấy)."""
+        cutoff = time.time() - self.INBOX_TTL_S
+        with self.cond:
+            box = self.inbox.get(user_key)
+            if box is None:
+                return []
+            while box and box[0][0] < cutoff:
+                box.popleft()
+            if not box:
+                del self.inbox[user_key]
+            return list(box)
+
+    def upcoming(self, user_key: str, horizon_s: float) -> list[tuple]:
+        until = time.time() + horizon_s
+        with self.cond:
+            items = [(f, rid, rem) for rid, (_, f, rem) in self.live.get(user_key, {}).items() if f <= until]
+        return sorted(items, key=lambda x: x[0])
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {"heap": len(self.heap), "stale": self.stale,
+                    "users": len(self.live), "reminders": sum(len(v) for v in self.live.values())}
+
+@st.cache_resource(show_spinner=False)
+def _reminder_scheduler() -> _ReminderScheduler:
+    return _ReminderScheduler()
+
+def _reminder_toast(rem: dict, fire_at: float) -> dict:
+    icon, title, subtitle = REMINDER_KINDS.get(rem.get("kind"), REMINDER_KINDS["breathe"])
+    return {"id": f"rem-{rem['id']}-{int(fire_at)}", "title": f"{title} · {rem.get('time', '')}",
+            "subtitle": rem.get("note") or subtitle, "icon": icon,
+            "start_ms": int(fire_at * 1000), "duration_ms": 5000}
+
+def render_reminders(user_key: str, data: dict):
+    """
+    Mỗi lượt chạy: đồng bộ lịch của user vào scheduler, hiện các lần nhắc đã tới mà phiên chưa thấy,
+    và nhúng 1 khối JS hẹn giờ sẵn các lần nhắc sắp tới → toast tự bật dù trang đang đứng yên.
+    Khối JS có nội dung ổn định giữa các rerun nên Streamlit giữ nguyên iframe (timer không bị reset).
+    """
+    sched = _reminder_scheduler()
+    sched.sync_user(user_key, data["game"].get("reminders", []))
+    shown = st.session_state.setdefault("_rem_shown", {})
+    for fire_at, rid, rem in sched.fired(user_key):
+        if f"{rid}@{int(fire_at)}" not in shown:
+            t = _reminder_toast(rem, fire_at)
+            notify_achievement(t["title"], t["subtitle"], t["icon"])
+            shown[f"{rid}@{int(fire_at)}"] = fire_at
+    upcoming = sched.upcoming(user_key, REMINDER_CLIENT_HORIZON_S)
+    now = time.time()
+    for key in [k for k, f in shown.items() if f < now - _ReminderScheduler.INBOX_TTL_S]:
+        del shown[key]
+    for fire_at, rid, _ in upcoming:
+        shown[f"{rid}@{int(fire_at)}"] = fire_at
+    if upcoming:
+        components.html(_hz_toast_html([_reminder_toast(rem, f) for f, _, rem in upcoming]), height=0)
+
+def _reminder_days_label(rem: dict) -> str:
+    days = sorted(rem.get("days") or [])
+    return "mỗi ngày" if not days or len(days) == 7 else ", ".join(WEEKDAYS_VI[d] for d in days)
+
+def ui_reminders_sidebar(data: dict):
+    rems = data["game"].setdefault("reminders", [])
+    locked = is_ui_locked()
+    with st.sidebar.expander(f"⏰ Nhắc nhở ({len(rems)})"):
+        for r in list(rems):
+            icon, title, _ = REMINDER_KINDS.get(r.get("kind"), REMINDER_KINDS["breathe"])
+            c1, c2 = st.columns([5, 1])
+            c1.markdown(f"{icon} **{r.get('time')}** · {title}  \n<small>{_reminder_days_label(r)}</small>",
+                        unsafe_allow_html=True)
+            if c2.button("✕", key=f"rem_del_{r['id']}", disabled=locked):
+                rems.remove(r); save_user(data); st.rerun()
+        kind = st.selectbox("Nhắc việc", list(REMINDER_KINDS), format_func=lambda k: REMINDER_KINDS[k][1],
+                            key="rem_kind", disabled=locked)
+        at = st.time_input("Lúc", value=dtime(20, 0), step=300, key="rem_time", disabled=locked)
+        days = st.multiselect("Ngày (bỏ trống = mỗi ngày)", list(range(7)), format_func=lambda d: WEEKDAYS_VI[d],
+                              key="rem_days", disabled=locked)
+        full = len(rems) >= REMINDERS_PER_USER_MAX
+        if st.button("Thêm nhắc nhở", key="rem_add", disabled=locked or full):
+            rems.append({
+                "id": _uuid.uuid4().hex[:12], "kind": kind, "time": at.strftime("%H:%M"),
+                "days": sorted(days), "enabled": True,
+                "tz_offset_min": int(_secrets_section("reminders").get("tz_offset_min", REMINDER_TZ_OFFSET_MIN)),
+                "created_at": datetime.utcnow().isoformat(),
+            })
+            save_user(data); st.rerun()
+        if full:
+            st.caption(f"Tối đa {REMINDERS_PER_USER_MAX} nhắc nhở.")
+
 # ====== Streak + badges ======
-def update_streak_on_checkin(data: dict):
-    today = date.today()
-    last = data["game"]["last_checkin_date"]
+def _today_utc() -> date:
+    """Ngày hiện tại theo UTC — cùng mốc với ngày ghi trong moods/quests (datetime.utcnow())."""
+    return datetime.utcnow().date()
+
+def advance_streak(game: dict):
+    """Cập nhật streak cho 1 lần check-in hôm nay (không lưu)."""
+    today = _today_utc()
+    last = game.get("last_checkin_date")
     if last is None:
-        data["game"]["streak"] = 1
+        game["streak"] = 1
     else:
         try:
             last_date = datetime.fromisoformat(last).date()
         except Exception:
             last_date = None
         if last_date is None:
-            data["game"]["streak"] = 1
+            game["streak"] = 1
         else:
             if today == last_date:
                 pass
             elif today == (last_date + timedelta(days=1)):
-                data["game"]["streak"] += 1
+                game["streak"] = int(game.get("streak", 0)) + 1
             else:
-                data["game"]["streak"] = 1
-    data["game"]["last_checkin_date"] = datetime.combine(today, datetime.min.time()).isoformat()
+                game["streak"] = 1
+    game["last_checkin_date"] = datetime.combine(today, datetime.min.time()).isoformat()
+    game["longest_streak"] = max(int(game.get("longest_streak", 0)), game["streak"])
+
+def update_streak_on_checkin(data: dict):
+    advance_streak(data["game"])
     save_user(data)
 
-def progress_snapshot(data: dict) -> dict:
-    g = data.get("game", {})
-    streak = int(g.get("streak", 0))
-    moods = g.get("moods", [])
-    qcounts = g.get("quest_counts", {})
-    garden = g.get("garden", [])
-    journal = g.get("journal", [])
-    breathing = int(qcounts.get("breathing", 0))
-    gratitude = int(qcounts.get("gratitude", 0))
-    mindful   = int(qcounts.get("mini_mindful", 0))
-    plant_total = len(garden)
-    rare_total  = sum(1 for p in garden if p.get("rare"))
-    journal_total = len(journal)
-    checkins = len(moods)
+def _iso_days(isos: list[str]) -> "np.ndarray":
+    """ISO datetime → số ngày kể từ 1970-01-01 (vector hóa, không parse từng dòng bằng Python)."""
+    if not isos:
+        return np.empty(0, dtype=np.int32)
+    return np.array([s[:10] for s in isos], dtype="datetime64[D]").astype(np.int32)
+
+STREAK_HISTORY_MIN_DAYS = 2
+STREAK_HISTORY_MAX = 100
+
+def compute_streaks(mood_dates: list[str]) -> dict:
+    """
+    Tính lại streak từ log check-in (không phụ thuộc trạng thái cũ):
+    sắp xếp ngày duy nhất → diff → tách các chuỗi ngày liên tiếp.
+    `streak` = độ dài chuỗi kết thúc ở lần check-in cuối (giống update_streak_on_checkin).
+    """
+    days = np.unique(_iso_days([d for d in mood_dates if d]))
+    if days.size == 0:
+        return {"streak": 0, "longest_streak": 0, "last_checkin_date": None, "streak_history": []}
+    breaks = np.flatnonzero(np.diff(days) != 1)
+    starts = np.concatenate([[0], breaks + 1])
+    ends = np.concatenate([breaks, [days.size - 1]])
+    lengths = ends - starts + 1
+    keep = np.flatnonzero(lengths >= STREAK_HISTORY_MIN_DAYS)[-STREAK_HISTORY_MAX:]
+    as_iso = lambda d: str(np.datetime64(int(d), "D"))
     return {
-        "streak": streak, "breathing": breathing, "gratitude": gratitude, "mindful": mindful,
-        "plant_total": plant_total, "rare_total": rare_total, "journal_total": journal_total,
-        "checkins": checkins, "all_quests_done_today": False,
+        "streak": int(lengths[-1]),
+        "longest_streak": int(lengths.max()),
+        "last_checkin_date": as_iso(days[-1]) + "T00:00:00",
+        "streak_history": [{"start": as_iso(days[starts[i]]), "end": as_iso(days[ends[i]]), "days": int(lengths[i])}
+                           for i in keep],
     }
 
-BADGE_RULES = [
-    ("streak_3",  "3 ngày liên tục",       lambda p: p["streak"] >= 3,           "🏅", "Giữ nhịp thật đều!"),
-    ("streak_7",  "7 ngày liên tục",       lambda p: p["streak"] >= 7,           "🏅", "Một tuần kiên trì!"),
-    ("checkin_1", "Check-in lần đầu",      lambda p: p["checkins"] >= 1,         "🏅", "Ghi nhận bước đầu tiên"),
-    ("plant_1",   "Hạt mầm đầu tiên",      lambda p: p["plant_total"] >= 1,      "🏅", "Gieo hạt đầu tiên"),
-    ("quests_all","Hoàn tất hôm nay",      lambda p: p["all_quests_done_today"], "🏅", "Xong toàn bộ hoạt động hôm nay"),
-]
+def repair_streaks(game: dict) -> bool:
+    """Ghi đè các trường streak trong `game` bằng giá trị tính lại. Trả về True nếu có thay đổi."""
+    fixed = compute_streaks([m.get("date") for m in game.get("moods", [])])
+    if game.get("archive_index", {}).get("moods"):
+        # phần đầu log đã sang tầng lạnh → không hạ kỷ lục cũ / chuỗi đang chạy dài hơn cửa sổ nóng
+        fixed["longest_streak"] = max(fixed["longest_streak"], int(game.get("longest_streak") or 0))
+        if (game.get("last_checkin_date") or "")[:10] == (fixed["last_checkin_date"] or "")[:10]:
+            fixed["streak"] = max(fixed["streak"], int(game.get("streak") or 0))
+    changed = any(game.get(k) != v for k, v in fixed.items())
+    game.update(fixed)
+    return changed
+
+def _is_rare_plant(p: dict) -> bool:
+    return p.get("rarity") == "hiem" or bool(p.get("rare"))
+
+def _section_preview(data: dict, kind: str) -> Optional[dict]:
+    game = data.get("game", {})
+    return game.preview(kind) if isinstance(game, LazyGame) else None
+
+def _section_total(data: dict, kind: str, field: str = "n") -> int:
+    """
+    Tổng bản ghi của 1 mục (cả phần đã lưu kho); field="rare" → số cây hiếm. Mục chưa nạp mà lát cắt của engine
+    đã có con số → dùng luôn, không nạp cả mục chỉ để đếm.
+    """
+    pv = _section_preview(data, kind)
+    if pv is not None and field in pv:
+        n = int(pv[field])
+    else:
+        items = data.get("game", {}).get(kind) or []
+        n = len(items) if field == "n" else sum(1 for p in items if _is_rare_plant(p))
+    return n + archived_count(data, kind, field)
+
+_PROGRESS_COUNTERS = {
+    "streak": lambda data: int(data.get("game", {}).get("streak", 0)),
+    "breathing": lambda data: int(data.get("game", {}).get("quest_counts", {}).get("breathing", 0)),
+    "gratitude": lambda data: int(data.get("game", {}).get("quest_counts", {}).get("gratitude", 0)),
+    "mindful": lambda data: int(data.get("game", {}).get("quest_counts", {}).get("mini_mindful", 0)),
+    "plant_total": lambda data: _section_total(data, "garden"),
+    "rare_total": lambda data: _section_total(data, "garden", "rare"),
+    "journal_total": lambda data: _section_total(data, "journal"),
+    "checkins": lambda data: _section_total(data, "moods"),
+    "all_quests_done_today": lambda data: 0,
+}
 
-def check_badges(data: dict, *, set_all_done_today: bool = False):
-    def _clean_title(s: str) -> str:
-        return re.sub(r'^\W+\s*', '', s or "").strip()
-    p = progress_snapshot(data)
-    if set_all_done_today:
-        p["all_quests_done_today"] = True
-    owned_titles = set(_clean_title(t) for t in data["game"].get("badges", []))
-    newly = []
-    for bid, title, cond, icon, sub in BADGE_RULES:
-        try:
-            ok = bool(cond(p))
-        except Exception:
-            ok = False
-        if not ok: continue
-        t_clean = _clean_title(title)
-        if t_clean in owned_titles: continue
-        newly.append((t_clean, icon, sub))
+def progress_value(data: dict, counter: str) -> int:
+    """Giá trị hiện tại của 1 counter huy hiệu — chỉ đọc mục cần cho counter đó (check-in không nạp nhật ký/vườn)."""
+    fn = _PROGRESS_COUNTERS.get(counter)
+    return fn(data) if fn else 0
+
+# --------- Tóm tắt tuần (materialized) ----------
+# game.week_summary = {"cur": {...}, "prev": {...}} — cộng dồn ngay lúc ghi (check-in, quest, cây, nhật ký),
+# nằm trong khung doc → trang chào đọc thẳng, không duyệt moods/journal/garden (vốn có thể chưa nạp / đã lưu kho).
+def _week_key(d: date) -> str:
+    y, w, _ = d.isocalendar()
+    return f"{y}-W{w:02d}"
+
+def _week_blank(key: str) -> dict:
+    return {"week": key, "mood_sum": 0, "mood_n": 0, "days": [], "quests": {}, "plants": 0, "rare": 0, "journal": 0}
+
+def _week_apply(w: dict, kind: str, entry: dict, day: str):
+    if kind == "moods":
+        w["mood_sum"] += int(entry.get("mood", 0)); w["mood_n"] += 1
+        if day not in w["days"]:
+            w["days"].append(day)
+    elif kind == "quests":
+        qt = entry.get("type") or "other"
+        w["quests"][qt] = w["quests"].get(qt, 0) + 1
+    elif kind == "garden":
+        w["plants"] += 1
+        w["rare"] += int(_is_rare_plant(entry))
+    elif kind == "journal":
+        w["journal"] += 1
+
+def week_summary_add(data: dict, kind: str, entry: dict) -> bool:
+    """Cộng 1 bản ghi mới vào tóm tắt tuần của nó. Sang tuần mới thì tuần cũ lùi về `prev`."""
+    day = str(entry.get("date") or entry.get("completed_at") or "")[:10]
+    try:
+        key = _week_key(date.fromisoformat(day))
+    except ValueError:
+        return False
+    ws = data["game"].setdefault("week_summary", {})
+    cur = ws.get("cur")
+    if not cur or cur["week"] < key:
+        if cur:
+            ws["prev"] = cur
+        cur = ws["cur"] = _week_blank(key)
+    elif cur["week"] != key:
+        cur = ws.get("prev") if (ws.get("prev") or {}).get("week") == key else None
+        if cur is None:   # bản ghi cũ hơn 2 tuần (ingest muộn) → không thuộc tóm tắt nào
+            return False
+    _week_apply(cur, kind, entry, day)
+    return True
+
+def week_summary_build(data: dict, today: Optional[date] = None) -> dict:
+    """Dựng lại tóm tắt tuần này + tuần trước từ dữ liệu thô (migration, gộp doc)."""
+    today = today or _today_utc()
+    cur_key = _week_key(today)
+    prev_key = _week_key(today - timedelta(days=7))
+    since = (today - timedelta(days=today.weekday() + 7)).isoformat()
+    out = {"cur": _week_blank(cur_key), "prev": _week_blank(prev_key)}
+    g = data.get("game", {})
+    for kind in ("moods", "journal", "garden", "quests"):
+        items = g.get(kind, [])
+        for e in (items.values() if isinstance(items, dict) else items):
+            day = str(e.get("date") or e.get("completed_at") or "")[:10]
+            if day >= since:
+                w = out["cur"] if _week_key(date.fromisoformat(day)) == cur_key else out["prev"]
+                _week_apply(w, kind, e, day)
+    for w in out.values():
+        w["days"].sort()
+    return out
+
+def week_summary_view(data: dict, today: Optional[date] = None) -> tuple[str, Optional[dict]]:
+    """(nhãn, tóm tắt) để hiển thị: tuần này nếu đã có hoạt động, không thì tuần gần nhất có hoạt động."""
+    ws = dict.get(data.get("game", {}), "week_summary") or {}
+    key = _week_key(today or _today_utc())
+    cur, prev = ws.get("cur"), ws.get("prev")
+    if cur and cur["week"] == key:
+        return "Tuần này", cur
+    recent = cur or prev
+    if not recent:
+        return "", None
+    last_key = _week_key((today or _today_utc()) - timedelta(days=7))
+    return ("Tuần trước" if recent["week"] == last_key else f"Tuần {recent['week']}"), recent
+
+QUEST_TYPE_LABELS = {"breathing": "Hít thở", "gratitude": "Biết ơn", "mini_mindful": "Chánh niệm"}
+
+def render_week_summary(data: dict):
+    label, w = week_summary_view(data)
+    if not w:
+        return
+    q = w["quests"]
+    c = st.columns(5)
+    c[0].metric("Tâm trạng TB", f"{w['mood_sum'] / w['mood_n']:.1f}" if w["mood_n"] else "—")
+    c[1].metric("Ngày check-in", f"{len(w['days'])}/7")
+    c[2].metric("Hoạt động", sum(q.values()),
+                help=", ".join(f"{QUEST_TYPE_LABELS.get(k, k)}: {v}" for k, v in sorted(q.items())) or None)
+    c[3].metric("Cây đã gieo", w["plants"], help=f"{w['rare']} cây hiếm" if w["rare"] else None)
+    c[4].metric("Nhật ký", w["journal"])
+    st.caption(f"📅 {label} ({w['week']})")
+
+# Danh mục huy hiệu khai báo trong assets/badges.json (đổi file qua [badges] file hoặc HEALINGIZZ_BADGES).
+# Mỗi huy hiệu: id cố định, title/subtitle/icon, và điều kiện `counter` + `min` (+ `window_days` = chỉ đếm
+# sự kiện trong N ngày gần nhất) hoặc `all`: [điều kiện, ...]. Rule được index theo counter → mỗi thay đổi
+# chỉ chấm lại các rule phụ thuộc counter đó.
+BADGE_COUNTERS = ("streak", "checkins", "breathing", "gratitude", "mindful", "plant_total", "rare_total",
+                  "journal_total", "all_quests_done_today")
+# counter đếm được theo cửa sổ thời gian → (mục trong game, bộ lọc)
+BADGE_EVENT_SOURCES = {
+    "checkins": ("moods", None),
+    "journal_total": ("journal", None),
+    "plant_total": ("garden", None),
+    "rare_total": ("garden", lambda e: _is_rare_plant(e)),
+    "breathing": ("quests", lambda e: e.get("type") == "breathing"),
+    "gratitude": ("quests", lambda e: e.get("type") == "gratitude"),
+    "mindful": ("quests", lambda e: e.get("type") == "mini_mindful"),
+}
+QUEST_TYPE_COUNTER = {"breathing": "breathing", "gratitude": "gratitude", "mini_mindful": "mindful"}
+
+def _clean_badge_title(s: str) -> str:
+    return re.sub(r'^\W+\s*', '', s or "").strip()
+
+def _badge_rule(raw: dict) -> dict:
+    conds = raw.get("all") or [{k: raw[k] for k in ("counter", "min", "window_days") if k in raw}]
+    for c in conds:
+        if c.get("counter") not in BADGE_COUNTERS:
+            raise ValueError(f"Huy hiệu {raw.get('id')!r}: counter không hỗ trợ {c.get('counter')!r}")
+        if c.get("window_days") and c["counter"] not in BADGE_EVENT_SOURCES:
+            raise ValueError(f"Huy hiệu {raw.get('id')!r}: counter {c['counter']!r} không đếm theo cửa sổ được")
+    return {"id": raw["id"], "title": raw["title"], "subtitle": raw.get("subtitle", ""),
+            "icon": raw.get("icon", "🏅"), "conds": [{"counter": c["counter"], "min": int(c.get("min", 1)),
+                                                     "window_days": int(c.get("window_days") or 0)} for c in conds]}
+
+@st.cache_resource(show_spinner=False)
+def _badge_catalogue() -> dict:
+    path = Path(os.environ.get("HEALINGIZZ_BADGES") or _secrets_section("badges").get("file")
+                or Path(__file__).with_name("assets") / "badges.json")
+    rules = [_badge_rule(r) for r in json.loads(path.read_text(encoding="utf-8"))["badges"]]
+    by_id = {r["id"]: r for r in rules}
+    if len(by_id) != len(rules):
+        raise ValueError(f"{path}: trùng id huy hiệu")
+    by_counter: dict[str, list] = {}
+    for r in rules:
+        for counter in dict.fromkeys(c["counter"] for c in r["conds"]):
+            by_counter.setdefault(counter, []).append(r)
+    return {"rules": rules, "by_id": by_id, "by_counter": by_counter,
+            "by_title": {_clean_badge_title(r["title"]): r["id"] for r in rules}}
+
+def _window_count(data: dict, counter: str, days: int) -> int:
+    """Số sự kiện của counter trong `days` ngày gần nhất (tính cả hôm nay). Duyệt ngược từ cuối → O(cửa sổ)."""
+    kind, pred = BADGE_EVENT_SOURCES[counter]
+    since = (_today_utc() - timedelta(days=days - 1)).isoformat()
+    pv = _section_preview(data, kind)
+    if pv is not None and pv["items"] and _entity_date(kind, pv["items"][0])[:10] < since:
+        items = pv["items"]   # lát cắt đã phủ hết cửa sổ → không nạp cả mục
+    else:
+        items = data.get("game", {}).get(kind) or []
+    rows = reversed(list(items.values()) if isinstance(items, dict) else items)
+    n = 0
+    for e in rows:
+        if _entity_date(kind, e)[:10] < since:
+            break
+        n += 1 if pred is None or pred(e) else 0
+    return n
+
+def evaluate_badges(data: dict, changed: Optional[tuple] = None, *, facts: Optional[dict] = None) -> list[dict]:
+    """
+    Chấm các rule chưa có, phụ thuộc counter trong `changed` (None → chấm hết, dùng cho job/migration).
+    Huy hiệu mới được ghi vào game["badge_ids"] + game["badges"] (tên hiển thị). Không lưu, không thông báo.
+    """
+    cat = _badge_catalogue()
+    game = data.setdefault("game", {})
+    owned = set(game.get("badge_ids", []))
+    if changed is None:
+        rules = cat["rules"]
+    else:
+        rules = list({r["id"]: r for c in changed for r in cat["by_counter"].get(c, [])}.values())
+    rules = [r for r in rules if r["id"] not in owned]
+    if not rules:
+        return []
+    totals, windows = {}, {}
+    def value(c: dict) -> int:
+        if c["window_days"]:
+            key = (c["counter"], c["window_days"])
+            if key not in windows:
+                windows[key] = _window_count(data, *key)
+            return windows[key]
+        if facts and c["counter"] in facts:
+            return int(facts[c["counter"]])
+        if c["counter"] not in totals:
+            totals[c["counter"]] = progress_value(data, c["counter"])
+        return totals[c["counter"]]
+    newly = [r for r in rules if all(value(c) >= c["min"] for c in r["conds"])]
+    if newly:
+        game.setdefault("badge_ids", []).extend(r["id"] for r in newly)
+        game.setdefault("badges", []).extend(r["title"] for r in newly)
+    perf_inc("badges.rules_evaluated", len(rules))
+    return newly
+
+def check_badges(data: dict, changed: Optional[tuple] = None, *, set_all_done_today: bool = False):
+    """Chấm huy hiệu sau 1 thay đổi (xem evaluate_badges); có huy hiệu mới → lưu + toast."""
+    facts = {"all_quests_done_today": 1} if set_all_done_today else None
+    newly = evaluate_badges(data, changed, facts=facts)
     if newly:
-        data["game"].setdefault("badges", []).extend([t for (t,_,_) in newly])
         save_user(data)
-        for i, (title, _icon, sub) in enumerate(newly):
-            notify_achievement(title=title, subtitle=sub, icon="🏅", delay_ms=i*350)
+        for i, r in enumerate(newly):
+            notify_achievement(title=r["title"], subtitle=r["subtitle"], icon=r["icon"], delay_ms=i*350)
     return True
 
 # ====== Quests ======
+# Mỗi mẫu có `id` cố định (không đổi khi sửa chữ) và `weight` (tần suất tương đối trong cùng loại).
+# Mỗi ngày chọn tối đa 1 mẫu cho mỗi loại → quest_id = "<type>-<ngày>" khớp với lịch sử đã lưu.
 QUEST_TEMPLATES = [
-    {"type": "breathing","title": "Thở 4-7-8","desc": "Thở vào 4s – nín 7s – thở ra 8s. Lặp lại trong hai vòng.","duration_sec": 60},
-    {"type": "gratitude","title": "Điều ý nghĩa hôm nay","desc": "Viết 1 điều mà bạn cảm thấy có ý nghĩa trong ngày hôm nay"},
-    {"type": "mini_mindful","title": "Mắt nhắm thư giãn","desc": "Mắt nhắm, nghe nhạc và chú ý cảm giác trong 30 giây","duration_sec": 30},
+    {"id": "br_478", "type": "breathing","title": "Thở 4-7-8","desc": "Thở vào 4s – nín 7s – thở ra 8s. Lặp lại trong hai vòng.","duration_sec": 60, "weight": 3},
+    {"id": "br_box", "type": "breathing", "title": "Thở hộp 4-4-4-4", "desc": "Hít vào 4s – giữ 4s – thở ra 4s – giữ 4s. Lặp lại ba vòng.",
+     "phases": [["Hít vào", 4], ["Giữ", 4], ["Thở ra", 4], ["Giữ", 4]], "rounds": 3, "weight": 2},
+    {"id": "br_calm", "type": "breathing", "title": "Thở ra dài", "desc": "Hít vào 4s – thở ra chậm 6s, để cơ thể thả lỏng. Lặp lại bốn vòng.",
+     "phases": [["Hít vào", 4], ["Thở ra", 6]], "rounds": 4, "weight": 1},
+    {"id": "gr_meaning", "type": "gratitude","title": "Điều ý nghĩa hôm nay","desc": "Viết 1 điều mà bạn cảm thấy có ý nghĩa trong ngày hôm nay", "weight": 3},
+    {"id": "gr_person", "type": "gratitude", "title": "Người mình biết ơn", "desc": "Viết về 1 người đã giúp đỡ hoặc làm bạn vui gần đây", "weight": 2},
+    {"id": "gr_self", "type": "gratitude", "title": "Điều mình làm tốt", "desc": "Viết 1 việc nhỏ hôm nay bạn đã làm tốt, dù nhỏ đến đâu", "weight": 2},
+    {"id": "gr_small", "type": "gratitude", "title": "Niềm vui nhỏ", "desc": "Một niềm vui nhỏ hôm nay: một món ăn, một câu nói, một khoảnh khắc", "weight": 1},
+    {"id": "mm_eyes", "type": "mini_mindful","title": "Mắt nhắm thư giãn","desc": "Mắt nhắm, nghe nhạc và chú ý cảm giác trong 30 giây","duration_sec": 30, "weight": 3},
+    {"id": "mm_body", "type": "mini_mindful", "title": "Quét cơ thể", "desc": "Nghe nhạc, lần lượt chú ý từ đỉnh đầu xuống bàn chân trong 30 giây", "duration_sec": 30, "weight": 2},
+    {"id": "mm_sound", "type": "mini_mindful", "title": "Lắng nghe âm thanh", "desc": "Nhắm mắt, đếm xem bạn nghe được bao nhiêu âm thanh quanh mình trong 30 giây", "duration_sec": 30, "weight": 1},
 ]
+QUEST_PLAN_CACHE_MAX = 20000
+
+def _stable_hash(s: str) -> int:
+    """Hash 64-bit ổn định giữa các process/lần khởi động (khác hash() có salt của Python)."""
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
 
 def todays_seed(user_id: str):
-    base = f"{user_id}-{date.today().isoformat()}"
-    return abs(hash(base)) % (2**32)
-
-def daily_quests(user_id: str, k=3):
-    rnd = random.Random(todays_seed(user_id))
-    picks = rnd.sample(QUEST_TEMPLATES, k=min(k, len(QUEST_TEMPLATES)))
-    result = []
-    for q in picks:
-        qid = f"{q['type']}-{date.today().isoformat()}"
-        result.append({**q, "quest_id": qid})
-    return result
+    return _stable_hash(f"{user_id}-{_today_utc().isoformat()}") % (2**32)
 
-def mark_quest_completed(data: dict, quest: dict, payload: dict) -> bool:
+@st.cache_resource(show_spinner=False)
+def _quest_catalogue() -> dict:
+    """Chỉ mục catalogue: theo loại → (mẫu, tổng tích lũy trọng số) + trọng số loại; dựng 1 lần/process."""
+    by_type: dict[str, list[dict]] = {}
+    for t in QUEST_TEMPLATES:
+        by_type.setdefault(t["type"], []).append(t)
+    index = {}
+    for qt, items in by_type.items():
+        cum, acc = [], 0.0
+        for t in items:
+            acc += max(0.0, float(t.get("weight", 1))); cum.append(acc)
+        index[qt] = (items, cum)
+    return {"types": index, "by_id": {t["id"]: t for t in QUEST_TEMPLATES},
+            "type_weight": {qt: cum[-1] for qt, (_, cum) in index.items()}}
+
+def _weighted_pick(items: list[dict], cum: list[float], u: float) -> dict:
+    return items[min(len(items) - 1, bisect.bisect_right(cum, u * cum[-1]))]
+
+def plan_daily_quests(user_id: str, day: str, k: int = 3) -> list[str]:
+    """Kế hoạch ngày (list template id), tất định theo (user, ngày): chọn k loại rồi 1 mẫu/loại theo trọng số."""
+    cat = _quest_catalogue()
+    types = sorted(cat["types"])
+    if k < len(types):
+        # Efraimidis–Spirakis: khóa u^(1/w), lấy k khóa lớn nhất = lấy mẫu có trọng số không hoàn lại
+        def key(qt):
+            u = (_stable_hash(f"{user_id}|{day}|type|{qt}") % 2**53 + 1) / (2**53 + 1)
+            return u ** (1.0 / max(cat["type_weight"][qt], 1e-9))
+        types = sorted(types, key=key, reverse=True)[:k]
+    plan = []
+    for qt in types:
+        items, cum = cat["types"][qt]
+        u = (_stable_hash(f"{user_id}|{day}|{qt}") % 2**53) / 2**53
+        plan.append(_weighted_pick(items, cum, u)["id"])
+    return plan
+
+@st.cache_resource(show_spinner=False)
+def _quest_plan_cache() -> dict:
+    return {"lock": threading.Lock(), "plans": OrderedDict()}
+
+def daily_quests(user_id: str, k=3, data: Optional[dict] = None):
+    """
+    Quest hôm nay của user. Thứ tự tra: cache process → kế hoạch đã lưu trong doc → tính mới.
+    Kế hoạch mới được ghi vào `data["game"]["quest_plan"]` và lưu cùng lần save kế tiếp,
+    nên đổi catalogue giữa ngày cũng không làm đổi quest của hôm đó.
+    """
+    day = _today_utc().isoformat()
+    cache = _quest_plan_cache()
+    ck = (user_id, day, k)
+    with cache["lock"]:
+        ids = cache["plans"].get(ck)
+    if ids is None:
+        saved = (data or {}).get("game", {}).get("quest_plan") or {}
+        by_id = _quest_catalogue()["by_id"]
+        if saved.get("day") == day and saved.get("k", k) == k and all(i in by_id for i in saved.get("ids", [])):
+            ids = saved["ids"]
+        else:
+            ids = plan_daily_quests(user_id, day, k)
+        with cache["lock"]:
+            cache["plans"][ck] = ids
+            while len(cache["plans"]) > QUEST_PLAN_CACHE_MAX:
+                cache["plans"].popitem(last=False)
+    if data is not None and (data["game"].get("quest_plan") or {}).get("day") != day:
+        data["game"]["quest_plan"] = {"day": day, "k": k, "ids": list(ids)}
+    by_id = _quest_catalogue()["by_id"]
+    return [{**by_id[i], "template_id": i, "quest_id": f"{by_id[i]['type']}-{day}"} for i in ids]
+
+def record_quest(data: dict, quest: dict, payload: dict) -> bool:
+    """Ghi quest đã hoàn thành vào doc (không lưu, không chấm huy hiệu). False nếu đã có."""
     qid = quest["quest_id"]
     if qid in data["game"]["quests"]:
-        st.info("Bạn đã hoàn thành các hoạt động hôm nay ✔️")
         return False
     now = datetime.utcnow().isoformat()
     data["game"]["quests"][qid] = {
         "quest_id": qid,
+        "template_id": quest.get("template_id"),
         "type": quest["type"],
         "title": quest["title"],
         "completed_at": now,
@@ -528,8 +3139,17 @@ def mark_quest_completed(data: dict, quest: dict, payload: dict) -> bool:
     }
     tc = data["game"].setdefault("quest_counts", {})
     qt = quest["type"]; tc[qt] = tc.get(qt, 0) + 1
+    if qt == "gratitude":
+        search_index_add(data, "quests", data["game"]["quests"][qid])
+    week_summary_add(data, "quests", data["game"]["quests"][qid])
+    return True
+
+def mark_quest_completed(data: dict, quest: dict, payload: dict) -> bool:
+    if not record_quest(data, quest, payload):
+        st.info("Bạn đã hoàn thành các hoạt động hôm nay ✔️")
+        return False
     save_user(data)
-    check_badges(data)
+    check_badges(data, (QUEST_TYPE_COUNTER.get(quest["type"], quest["type"]),))
     st.success(f"Hoàn thành: {quest['title']} 🎉")
     return True
 
@@ -552,9 +3172,9 @@ def _get_timer_left(qid: str, prefix: str) -> int:
     if not end_ts: return 0
     return max(0, int(round(end_ts - _t.time())))
 
-def breathing_478_stateful(qid: str, rounds: int = 2):
+def breathing_478_stateful(qid: str, rounds: int = 2, phases: Optional[list] = None):
     """
-    Thở 4-7-8 kiểu cũ: vòng lặp time.sleep() cập nhật UI.
+    Thở 4-7-8 kiểu cũ (hoặc các pha `phases` của mẫu quest): vòng lặp time.sleep() cập nhật UI.
     - Start: set state 'running', khóa UI, rerun.
     - Running: hiển thị đếm ngược từng pha; kết thúc → set 'done', mở khóa, rerun.
     - Stop: về 'idle', mở khóa, rerun.
@@ -562,7 +3182,7 @@ def breathing_478_stateful(qid: str, rounds: int = 2):
     key_state = f"br_{qid}_state"
     state = st.session_state.get(key_state, "idle")
 
-    phases = [("Hít vào", 4), ("Nín thở", 7), ("Thở ra", 8)]
+    phases = [tuple(p) for p in phases] if phases else [("Hít vào", 4), ("Nín thở", 7), ("Thở ra", 8)]
 
     c1, _ = st.columns([3, 7])
 
@@ -570,6 +3190,7 @@ def breathing_478_stateful(qid: str, rounds: int = 2):
     if state == "idle":
         if c1.button("Bắt đầu thực hiện", key=f"{qid}_start", disabled=is_ui_locked()):
             st.session_state[key_state] = "running"
+            st.session_state[f"br_{qid}_started_at"] = time.time()
             _lock_ui(True)
             st.rerun()
         return
@@ -579,6 +3200,7 @@ def breathing_478_stateful(qid: str, rounds: int = 2):
         if c1.button("Dừng thực hiện", key=f"{qid}_stop_btn"):
             st.session_state[key_state] = "idle"
             st.session_state.pop("active_quest_id", None)
+            st.session_state.pop(f"br_{qid}_started_at", None)
             _lock_ui(False)
             st.rerun()   # 👈 thêm dòng này để rerender ngay nút "Bắt đầu thực hiện"
             return
@@ -586,26 +3208,35 @@ def breathing_478_stateful(qid: str, rounds: int = 2):
         round_info = st.empty()
         status = st.empty()
 
+        # Bỏ qua phần đã thở (phiên được khôi phục trên replica khác / sau khi worker restart)
+        started_at = float(st.session_state.setdefault(f"br_{qid}_started_at", time.time()))
+        skip = int(max(0.0, time.time() - started_at))
+
         for r in range(1, rounds + 1):
-            round_info.markdown(f"Vòng {r}/{rounds}")
             for label, sec in phases:
+                if skip >= sec:
+                    skip -= sec
+                    continue
+                round_info.markdown(f"Vòng {r}/{rounds}")
                 # nếu user vừa nhấn Stop rồi rerun thì state sẽ khác; nhưng trong 1 run thì không thể stop giữa chừng – giữ nguyên hành vi cũ
-                for s in range(sec, 0, -1):
+                for s in range(sec - skip, 0, -1):
                     status.markdown(f"### {label} {s}s")
                     time.sleep(1)
+                skip = 0
 
         status.empty()
         round_info.empty()
 
         # Kết thúc bài tập: set 'done' để main chấm điểm, mở khóa và rerun
         st.session_state[key_state] = "done"
+        st.session_state.pop(f"br_{qid}_started_at", None)
         _lock_ui(False)
         st.rerun()
         return
 
     # --- Done
     if state == "done":
-        st.success("✅ Hoàn thành thở 4-7-8 🎉")
+        st.success("✅ Hoàn thành bài thở 🎉")
         _lock_ui(False)
         return
 
@@ -655,9 +3286,16 @@ def mindful_30s_with_music(qid: str, total_sec: int = 30):
             st.rerun()
             return
         
+        # Tính theo started_at → phiên khôi phục ở replica khác đếm tiếp phần còn lại
+        target = int(st.session_state.get(f"tm_{qid}_target_sec", total_sec))
+        started_at = float(st.session_state.setdefault(f"tm_{qid}_started_at", time.time()))
+        elapsed = int(max(0.0, time.time() - started_at))
+
         # Render audio đúng 1 lần, không autoplay lại
         audio_b64 = _load_audio_base64(MINDFUL_30S_FILE)
-        if audio_b64:
+        if elapsed >= target:
+            pass   # đã hết giờ trong lúc chuyển replica → kết thúc ngay bên dưới
+        elif audio_b64:
             # autoplay vì user vừa bấm "Bắt đầu", thường được phép
             components.html(f"""
                 <audio id="mindful_{qid}" autoplay>
@@ -668,6 +3306,7 @@ def mindful_30s_with_music(qid: str, total_sec: int = 30):
                       const a = document.getElementById("mindful_{qid}");
                       if (a) {{
                         a.volume = 0.7;   // chỉnh âm lượng
+                        a.currentTime = {elapsed};
                         a.play().catch(()=>{{}});
                       }}
                     }} catch(e) {{}}
@@ -677,8 +3316,7 @@ def mindful_30s_with_music(qid: str, total_sec: int = 30):
             st.info("Không tìm thấy assets/mindful_30s.mp3 – vẫn tiếp tục đếm 30 giây.")
 
         # Đếm ngược ngay trong một vòng lặp (không autorefresh)
-        target = int(st.session_state.get(f"tm_{qid}_target_sec", total_sec))
-        for sec in range(target, 0, -1):
+        for sec in range(target - elapsed, 0, -1):
             status.markdown(f"Thời gian còn lại: **{sec} giây**")
             # note.caption("Nhắm mắt, chú ý cảm giác…")
             time.sleep(1)
@@ -729,6 +3367,15 @@ def _load_tree_asset_base64() -> Optional[str]:
     img64, _ = _cache_first_existing(tuple(NORMAL_FILES + RARE_FILES))
     return img64
 
+def _tree_img_for(plant: dict) -> Optional[str]:
+    """Ảnh của cây: theo tree_file đã lưu (doc cũ có thể còn `img`), không có thì theo độ hiếm."""
+    if plant.get("img"):
+        return plant["img"]
+    rare = plant.get("rarity") == "hiem" or plant.get("rare")
+    files = ((plant["tree_file"],) if plant.get("tree_file") else ()) + tuple(RARE_FILES if rare else NORMAL_FILES)
+    img64, _ = _cache_first_existing(files)
+    return img64 or _load_tree_asset_base64()
+
 def _date_key_from_iso(iso: str) -> str:
     try: return datetime.fromisoformat(iso).date().isoformat()
     except Exception: return datetime.utcnow().date().isoformat()
@@ -760,7 +3407,7 @@ def _goto_day(day_iso: str, key="garden_day_page"):
     # Button click tự rerun rồi, không cần gọi st.rerun()
 
 def render_garden_day_ui(data: dict, allow_planting: bool=True):
-    garden = data["game"].get("garden", [])
+    garden = game_recent(data, "garden", []) + loaded_archive_items("garden")
     days_sorted = _get_all_days_sorted(garden)
     grouped = _group_garden_by_day(garden)
 
@@ -769,12 +3416,26 @@ def render_garden_day_ui(data: dict, allow_planting: bool=True):
         days_sorted.append(cur_day); days_sorted = sorted(days_sorted)
 
     idx = days_sorted.index(cur_day)
-    has_prev = idx > 0; has_next = idx < len(days_sorted) - 1
+    # tháng cũ còn nằm ở tầng lạnh → vẫn cho lùi, bấm mới tải
+    loaded = st.session_state.get("_archive_cache", {})
+    cold = [m for m in archived_months(data, "garden") if m <= cur_day[:7] and ("garden", m) not in loaded]
+    need_cold = bool(cold) and (idx == 0 or days_sorted[idx-1][:7] < cold[-1])
+    # mới có lát cắt gần đây của vườn → ngày đầu lát cắt vẫn lùi được, bấm mới đọc đủ
+    need_full = idx == 0 and "garden" in getattr(data["game"], "pending", ())
+    has_prev = idx > 0 or need_cold or need_full; has_next = idx < len(days_sorted) - 1
 
     # Nav
     col_left, col_mid, col_right = st.columns([1,2.5,1], gap="small")
     with col_left:
         if st.button("◀ Ngày trước", disabled=not has_prev, key="garden_prev"):
+            if need_full:
+                older = [d for d in _get_all_days_sorted(data["game"].get("garden", [])) if d < cur_day]
+                if older: _goto_day(older[-1])
+                st.rerun()
+            if need_cold:
+                older = [d for d in _get_all_days_sorted(load_archived(data, "garden", cold[-1])) if d < cur_day]
+                if older: _goto_day(older[-1])
+                st.rerun()
             if has_prev: _goto_day(days_sorted[idx-1]); st.rerun()
     with col_mid:
         st.markdown(f"<div style='text-align:center;font-weight:800;font-size:18px;'>Ngày {cur_day}</div>", unsafe_allow_html=True)
@@ -827,7 +3488,7 @@ def render_garden_day_ui(data: dict, allow_planting: bool=True):
     cards_html = []
 
     for p in display_plants:
-        img64 = p.get("img") or _load_tree_asset_base64()
+        img64 = _tree_img_for(p)
         rarity = p.get("rarity") or ("hiem" if p.get("rare") else "binh_thuong")
         cat_label = p.get("category_label") or _rarity_label_vi(rarity)
         meaning = p.get("meaning") or TREE_MEANINGS.get(rarity, "Điều tốt đẹp đang lớn lên.")
@@ -878,7 +3539,7 @@ def render_garden_day_ui(data: dict, allow_planting: bool=True):
         if not aff.strip():
             st.error("Hãy viết một điều tích cực trước khi gieo.")
         else:
-            img64, rarity, fname = pick_random_tree_asset()
+            _img64, rarity, fname = pick_random_tree_asset()
             meaning = TREE_MEANINGS.get(rarity, "Điều tốt đẹp đang lớn lên.")
             plant = {
                 "id": str(uuid.uuid4()),
@@ -887,12 +3548,14 @@ def render_garden_day_ui(data: dict, allow_planting: bool=True):
                 "category_label": _rarity_label_vi(rarity),
                 "meaning": meaning,
                 "affirmation": aff.strip(),
-                "img": img64,
                 "tree_file": fname,
                 "new_until": (datetime.utcnow() + timedelta(seconds=8)).isoformat(),
             }
             data["game"].setdefault("garden", []).append(plant)
+            search_index_add(data, "garden", plant)
+            week_summary_add(data, "garden", plant)
             save_user(data)
+            check_badges(data, ("plant_total", "rare_total"))
             st.rerun()
 
 # ====== Sidebar ======
@@ -908,12 +3571,22 @@ st.markdown("""
 
 def ui_sidebar(data: dict):
     st.sidebar.title("👤 Hồ sơ")
-    nickname = st.sidebar.text_input("Nickname", value=data["profile"].get("nickname",""), disabled=is_ui_locked())
-    bio = st.sidebar.text_area("Giới thiệu ngắn", value=data["profile"].get("bio",""), help="Tùy chọn", disabled=is_ui_locked())
-    if (not is_ui_locked()) and (nickname != data["profile"].get("nickname","") or bio != data["profile"].get("bio","")):
+    nickname = st.sidebar.text_input("Nickname", value=data["profile"].get("nickname",""), key="profile_nickname",
+                                     disabled=is_ui_locked())
+    bio = st.sidebar.text_area("Giới thiệu ngắn", value=data["profile"].get("bio",""), help="Tùy chọn",
+                               key="profile_bio", disabled=is_ui_locked())
+    cohort = st.sidebar.text_input("Lớp", value=data["profile"].get("cohort",""), placeholder="VD: 10A1",
+                                   key="profile_cohort", disabled=is_ui_locked())
+    old_cohort = data["profile"].get("cohort","")
+    roster_changed = nickname != data["profile"].get("nickname","") or cohort.strip() != old_cohort
+    if (not is_ui_locked()) and (roster_changed or bio != data["profile"].get("bio","")):
         data["profile"]["nickname"] = nickname
         data["profile"]["bio"] = bio
+        data["profile"]["cohort"] = cohort.strip()
         save_user(data)
+        if st.session_state.get("auth_user_id") and roster_changed:
+            cohort_set_member(st.session_state["auth_user_id"], nickname, user_cohort(data),
+                              old_cohort=old_cohort.strip() or NO_COHORT)
 
     st.sidebar.markdown("---")
     st.sidebar.markdown("**Huy hiệu**")
@@ -940,6 +3613,9 @@ def ui_sidebar(data: dict):
     else:
         st.sidebar.write("Chưa có huy hiệu nào.")
 
+    st.sidebar.markdown("---")
+    ui_reminders_sidebar(data)
+
     # Nút đồng bộ cloud theo yêu cầu (không auto fetch mỗi rerun)
     # if st.session_state.get("auth_user_id"):
     #     if st.sidebar.button("↻ Đồng bộ lại từ cloud (Mongo)", disabled=is_ui_locked()):
@@ -956,11 +3632,1100 @@ def ui_sidebar(data: dict):
     st.sidebar.markdown("**Tài khoản**")
     st.sidebar.markdown('<div class="logout-wrap">', unsafe_allow_html=True)
     if st.sidebar.button("Đăng xuất", key="logout_sidebar", disabled=is_ui_locked()):
+        uow_flush()   # ghi nốt trước khi user_data bị xóa khỏi phiên
+        session_forget()
         for k in ["auth_user_id","username","nickname","finished_today","active_quest_id","user_data"]:
             if k in st.session_state: del st.session_state[k]
         st.success("Đã đăng xuất."); st.rerun()
     st.sidebar.markdown('</div>', unsafe_allow_html=True)
 
+# ====== Cohort mood rollups (counselor) ======
+LOW_MOOD_MAX = 3          # điểm ≤ 3 tính là "thấp"
+SUSTAINED_LOW_DAYS = 3    # ≥ 3 ngày thấp trong 7 ngày gần nhất → cần quan tâm
+NO_COHORT = "_none"
+
+def _mongo_col_rollups():
+    """Rollup theo (ngày, lớp): count, sum, hist 1..10, low_users."""
+    client = get_mongo_client()
+    mongo = st.secrets["mongo"]
+    col = client[mongo.get("db", "healingizz")][mongo.get("rollup_col", "mood_rollups")]
+    col.create_index([("cohort", ASCENDING), ("day", ASCENDING)], unique=True, background=True)
+    return col
+
+def _mongo_col_cohorts():
+    """Danh sách lớp: {cohort, members: {user_id: nickname}}."""
+    client = get_mongo_client()
+    mongo = st.secrets["mongo"]
+    col = client[mongo.get("db", "healingizz")][mongo.get("cohort_col", "cohorts")]
+    col.create_index([("cohort", ASCENDING)], unique=True, background=True)
+    return col
+
+def user_cohort(data: dict) -> str:
+    return (data.get("profile", {}).get("cohort") or "").strip() or NO_COHORT
+
+def rollup_record_checkin(user_id: str, cohort: str, day: str, mood: int):
+    """Cộng dồn 1 check-in vào rollup ngày/lớp. Lỗi thì bỏ qua — job backfill sẽ dựng lại."""
+    try:
+        get_storage().rollup_inc(cohort, day, int(mood), user_id)
+    except Exception:
+        perf_inc("rollup.skipped")
+
+def cohort_set_member(user_id: str, nickname: str, cohort: str, old_cohort: Optional[str] = None):
+    try:
+        get_storage().cohort_set_member(cohort, user_id, nickname, old_cohort=old_cohort)
+    except Exception:
+        perf_inc("rollup.skipped")
+
+def rollup_backfill_pipeline(since: Optional[str] = None, into: str = "mood_rollups") -> list[dict]:
+    """Pipeline dựng lại toàn bộ rollup từ `healing_users` (chạy phía server Mongo, $merge vào `into`)."""
+    pipeline = [
+        {"$project": {"_id": 0, "user_id": 1,
+                      "cohort": {"$ifNull": ["$data.profile.cohort", NO_COHORT]},
+                      "moods": "$data.game.moods"}},
+        {"$unwind": "$moods"},
+        {"$project": {"user_id": 1,
+                      "cohort": {"$cond": [{"$eq": ["$cohort", ""]}, NO_COHORT, "$cohort"]},
+                      "day": {"$substrCP": ["$moods.date", 0, 10]},
+                      "mood": {"$toInt": "$moods.mood"}}},
+    ]
+    if since:
+        pipeline.append({"$match": {"day": {"$gte": since}}})
+    pipeline += [
+        {"$group": {"_id": {"cohort": "$cohort", "day": "$day", "mood": "$mood"},
+                    "n": {"$sum": 1}, "users": {"$addToSet": "$user_id"}}},
+        {"$group": {"_id": {"cohort": "$_id.cohort", "day": "$_id.day"},
+                    "count": {"$sum": "$n"},
+                    "sum": {"$sum": {"$multiply": ["$_id.mood", "$n"]}},
+                    "hist": {"$push": {"k": {"$toString": "$_id.mood"}, "v": "$n"}},
+                    "low": {"$push": {"$cond": [{"$lte": ["$_id.mood", LOW_MOOD_MAX]}, "$users", []]}}}},
+        {"$project": {"_id": 0, "cohort": "$_id.cohort", "day": "$_id.day", "count": 1, "sum": 1,
+                      "hist": {"$arrayToObject": "$hist"},
+                      "low_users": {"$reduce": {"input": "$low", "initialValue": [],
+                                                "in": {"$setUnion": ["$$value", "$$this"]}}}}},
+        {"$merge": {"into": into, "on": ["cohort", "day"],
+                    "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+    return pipeline
+
+def cohort_backfill_pipeline(into: str = "cohorts") -> list[dict]:
+    return [
+        {"$project": {"_id": 0, "user_id": 1,
+                      "cohort": {"$ifNull": ["$data.profile.cohort", NO_COHORT]},
+                      "nickname": {"$ifNull": ["$data.profile.nickname", "$user_id"]}}},
+        {"$group": {"_id": {"$cond": [{"$eq": ["$cohort", ""]}, NO_COHORT, "$cohort"]}, "members": {"$push": {"k": "$user_id", "v": "$nickname"}}}},
+        {"$project": {"_id": 0, "cohort": "$_id", "members": {"$arrayToObject": "$members"}}},
+        {"$merge": {"into": into, "on": ["cohort"], "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+
+def is_admin() -> bool:
+    try:
+        return st.session_state.get("username") in set(st.secrets.get("admins", []))
+    except Exception:
+        return False
+
+def is_counselor() -> bool:
+    try:
+        return st.session_state.get("username") in set(st.secrets.get("counselors", []))
+    except Exception:
+        return False
+
+def render_counselor_dashboard():
+    """Trang tư vấn viên: chỉ đọc rollup + danh sách lớp, không đụng vào tài liệu từng học sinh."""
+    st.header("🧑‍🏫 Tổng quan lớp")
+    store = get_storage()
+    try:
+        cohorts = store.cohorts()
+    except NotImplementedError:
+        st.info(f"Engine lưu trữ `{store.name}` chưa hỗ trợ rollup lớp — dùng `mongo` hoặc `sqlite`."); return
+    except Exception as e:
+        st.warning(f"⚠️ Chưa tải được danh sách lớp: {e}"); return
+    names = sorted(c["cohort"] for c in cohorts)
+    if not names:
+        st.caption("Chưa có lớp nào. Học sinh điền **Lớp** trong hồ sơ, hoặc chạy `python healing_jobs.py backfill-rollups`.")
+        return
+    c1, c2 = st.columns([2, 1])
+    cohort = c1.selectbox("Lớp", names, format_func=lambda c: "Chưa xếp lớp" if c == NO_COHORT else c)
+    n_days = c2.selectbox("Khoảng thời gian", [7, 14, 30, 90], index=2, format_func=lambda d: f"{d} ngày")
+    members = next((c.get("members", {}) for c in cohorts if c["cohort"] == cohort), {})
+    today = datetime.utcnow().date()
+    since = (today - timedelta(days=n_days - 1)).isoformat()
+    try:
+        rows = store.rollup_range(cohort, since)
+    except Exception as e:
+        st.warning(f"⚠️ Chưa tải được rollup: {e}"); return
+
+    total = sum(r.get("count", 0) for r in rows)
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Học sinh", len(members))
+    m2.metric("Điểm trung bình", f"{sum(r.get('sum', 0) for r in rows) / total:.1f}" if total else "–")
+    m3.metric("Tỉ lệ check-in", f"{100 * total / (n_days * len(members)):.0f}%" if members else "–")
+    if not rows:
+        st.caption("Chưa có check-in nào trong khoảng này."); return
+
+    st.line_chart({"Ngày": [r["day"] for r in rows],
+                   "Điểm TB": [r["sum"] / r["count"] if r.get("count") else None for r in rows],
+                   "Check-in": [r.get("count", 0) for r in rows]},
+                  x="Ngày", y=["Điểm TB", "Check-in"])
+    hist = [sum(int(r.get("hist", {}).get(str(k), 0)) for r in rows) for k in range(1, 11)]
+    st.bar_chart({"Điểm": [str(k) for k in range(1, 11)], "Số lượt": hist}, x="Điểm", y="Số lượt")
+
+    week_ago = (today - timedelta(days=6)).isoformat()
+    low_days: dict[str, int] = {}
+    for r in rows:
+        if r["day"] >= week_ago:
+            for uid in r.get("low_users", []):
+                low_days[uid] = low_days.get(uid, 0) + 1
+    flagged = sorted((n, uid) for uid, n in low_days.items() if n >= SUSTAINED_LOW_DAYS)
+    st.subheader("Cần quan tâm")
+    if flagged:
+        for n, uid in reversed(flagged):
+            st.write(f"- **{members.get(uid, uid)}** — {n} ngày điểm thấp (≤ {LOW_MOOD_MAX}) trong 7 ngày qua")
+    else:
+        st.caption(f"Không có học sinh nào có ≥ {SUSTAINED_LOW_DAYS} ngày điểm thấp trong 7 ngày qua.")
+
+def _fmt_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+def render_memory_report():
+    """Bộ nhớ process (RSS, tổng các phiên, cache dùng chung) + chi tiết phiên hiện tại."""
+    memory_publish(force=True)
+    proc, mine = process_memory_report(), session_memory_report()
+    m1, m2, m3 = st.columns(3)
+    m1.metric("RSS", _fmt_bytes(proc["rss"]) if "rss" in proc else "–")
+    m2.metric("Phiên đang mở", proc["sessions"])
+    m3.metric("Dữ liệu các phiên", _fmt_bytes(proc["sessions_bytes"]))
+    st.caption("Cache dùng chung: " + " · ".join(f"{k} {_fmt_bytes(v)}" for k, v in proc["caches"].items()))
+    st.markdown("**Phiên lớn nhất**")
+    for s_ in proc["top_sessions"]:
+        st.write(f"- {s_['user']}: {_fmt_bytes(s_['total'])} (user_data {_fmt_bytes(s_['user_data'])})")
+    st.markdown("**Phiên này**")
+    st.write({"user_data": _fmt_bytes(mine["user_data"]),
+              **{f"game.{k}": _fmt_bytes(v) for k, v in mine["sections"].items()},
+              **{k: _fmt_bytes(v) for k, v in mine["keys"].items()}})
+    if mine["pending"]:
+        st.caption("Chưa nạp: " + ", ".join(mine["pending"]))
+
+def render_profiler_admin():
+    """Admin: hẹn đo N lượt chạy tới của 1 phiên đang mở; tải kết quả đã ghi."""
+    reg, req = _memory_registry(), _profile_requests()
+    with reg["lock"]:
+        sessions = sorted(reg["sessions"].items(), key=lambda kv: -kv[1]["total"])
+    if not sessions:
+        st.caption("Chưa có phiên nào báo cáo (mỗi phiên tự báo cáo sau lượt chạy đầu)."); return
+    labels = {sid: f"{s['user']} · {sid} · {_fmt_bytes(s['user_data'])}" for sid, s in sessions}
+    sid = st.selectbox("Phiên", list(labels), format_func=labels.get, key="prof_sid")
+    runs = st.number_input("Số lượt chạy tới", 1, PROFILE_MAX_RUNS, 3, key="prof_runs")
+    c1, c2 = st.columns(2)
+    if c1.button("Bật profiler", key="prof_arm"):
+        profile_arm(sid, runs, st.session_state.get("username") or "")
+        st.success(f"Sẽ đo {runs} lượt chạy tới của {labels[sid]}.")
+    if c2.button("Tắt", key="prof_disarm"):
+        profile_disarm(sid)
+    with req["lock"]:
+        jobs = {k: {**v, "captured": list(v["captured"])} for k, v in req["armed"].items()}
+    for job_sid, job in jobs.items():
+        st.write(f"- {labels.get(job_sid, job_sid)}: còn {job['runs']} lượt, đã ghi {len(job['captured'])}")
+        for name in job["captured"][-3:]:
+            files = [f for f in (Path(str(PROFILE_DIR / name) + ext) for ext in (".prof", ".collapsed", ".json"))
+                     if f.exists()]
+            cols = st.columns(len(files) or 1)
+            for col, f in zip(cols, files):
+                col.download_button(f.suffix, f.read_bytes(), file_name=f.name, key=f"prof_dl_{f.name}")
+
+# ====== Kiosk lớp học (máy tính bảng dùng chung) ======
+# Tư vấn viên mở kiosk cho 1 lớp: học sinh chạm tên + PIN, hoặc quét thẻ QR (máy quét gõ mã vào ô nhập)
+# → chỉ check-in + hoạt động hôm nay; không bcrypt, không đăng xuất, không tải lại cả trang hồ sơ.
+# Doc của cả lớp nằm trong 1 pool ấm dùng chung process; thay đổi được đánh dấu bẩn và ghi theo lô
+# (đủ KIOSK_FLUSH_BATCH doc hoặc doc bẩn lâu nhất quá KIOSK_FLUSH_S giây — luồng nền tự xả).
+KIOSK_POOL_MAX = 120
+KIOSK_FLUSH_BATCH = 10
+KIOSK_FLUSH_S = 15
+KIOSK_DOC_TTL_S = 120            # doc sạch giữ lâu hơn → nạp lại (học sinh có thể vừa lưu ở phiên riêng/ingest/job)
+KIOSK_PIN_ITER = 20_000          # pbkdf2 ~ vài ms: đủ chậm cho PIN 4 số trên máy dùng chung, nhanh hơn bcrypt nhiều
+KIOSK_PIN_MAX_FAILS = 5
+KIOSK_PIN_LOCK_S = 300
+KIOSK_CARD_PREFIX = "HZK1"
+
+def _kiosk_pin_hash(pin: str, salt: Optional[str] = None) -> dict:
+    salt = salt or os.urandom(8).hex()
+    h = hashlib.pbkdf2_hmac("sha256", pin.encode("utf-8"), bytes.fromhex(salt), KIOSK_PIN_ITER).hex()
+    return {"salt": salt, "hash": h}
+
+def kiosk_pin_ok(data: dict, pin: str) -> bool:
+    rec = data.get("profile", {}).get("kiosk_pin") or {}
+    if not rec.get("salt") or not pin:
+        return False
+    return hmac.compare_digest(_kiosk_pin_hash(pin, rec["salt"])["hash"], rec.get("hash", ""))
+
+@st.cache_resource(show_spinner=False)
+def _kiosk_card_secret() -> bytes:
+    """[kiosk] card_secret trong secrets; chưa có → sinh 1 lần và giữ ở DATA_DIR/kiosk_secret."""
+    configured = _secrets_section("kiosk").get("card_secret")
+    if configured:
+        return str(configured).encode("utf-8")
+    f = DATA_DIR / "kiosk_secret"
+    if not f.exists():
+        f.write_bytes(os.urandom(32))
+    return f.read_bytes()
+
+def kiosk_card_token(user_id: str) -> str:
+    sig = hmac.new(_kiosk_card_secret(), user_id.encode("utf-8"), "sha256").hexdigest()[:16]
+    return f"{KIOSK_CARD_PREFIX}:{user_id}:{sig}"
+
+def kiosk_parse_card(text: str) -> Optional[str]:
+    """Mã quét từ thẻ → user_id nếu chữ ký đúng."""
+    parts = (text or "").strip().split(":")
+    if len(parts) != 3 or parts[0] != KIOSK_CARD_PREFIX:
+        return None
+    return parts[1] if hmac.compare_digest(kiosk_card_token(parts[1]), text.strip()) else None
+
+_KIOSK_LISTS = ("moods", "journal", "garden")
+_KIOSK_FIELDS = ("streak", "last_checkin_date", "longest_streak", "quest_plan")
+
+def _kiosk_mark(data: dict) -> dict:
+    """Mốc đã ghi của 1 doc: số bản ghi mỗi list, quest đã có, giá trị profile → delta là phần vượt mốc."""
+    game = data.get("game", {})
+    return {"lists": {k: len(dict.get(game, k) or []) for k in _KIOSK_LISTS},
+            "quests": set(dict.get(game, "quests") or {}),
+            "profile": {k: json.dumps(v, sort_keys=True, default=str) for k, v in data.get("profile", {}).items()}}
+
+def _kiosk_delta(data: dict, mark: dict) -> dict:
+    """Phần kiosk đã đổi so với `mark`, chép rời khỏi doc (ghi ngoài lock trong khi doc vẫn bị sửa tiếp)."""
+    game = data.get("game", {})
+    g = {k: (dict.get(game, k) or [])[mark["lists"][k]:] for k in _KIOSK_LISTS}
+    g["quests"] = {q: r for q, r in (dict.get(game, "quests") or {}).items() if q not in mark["quests"]}
+    g.update({k: game.get(k, []) for k in ("badges", "badge_ids")}, quest_counts=game.get("quest_counts", {}))
+    g.update({k: game[k] for k in _KIOSK_FIELDS if k in game})
+    profile = {k: v for k, v in data.get("profile", {}).items()
+               if mark["profile"].get(k) != json.dumps(v, sort_keys=True, default=str)}
+    return json.loads(json.dumps({"game": g, "profile": profile}, default=str))
+
+class _KioskPool:
+    """
+    LRU các doc học sinh đang dùng ở kiosk (chung process, nhiều kiosk cùng dùng được).
+    Mọi thay đổi đi qua `mutate` (trong lock). Lần xả chụp trong lock phần kiosk đã đổi (_kiosk_delta) rồi
+    ghi NGOÀI lock bằng store.apply_delta → gộp vào bản mới nhất trong store, không đè check-in/nhật ký học
+    sinh vừa lưu ở phiên riêng, ingest hay job; cloud chậm cũng không chặn get/mutate của học sinh khác.
+    Doc sạch để quá KIOSK_DOC_TTL_S thì nạp lại; doc bẩn không bị đẩy khỏi pool trước khi ghi xong.
+    """
+    def __init__(self, max_docs: int = KIOSK_POOL_MAX):
+        self.max_docs = max_docs
+        self.lock = threading.RLock()
+        self.flushing = threading.Lock()         # 1 lần xả tại 1 thời điểm (luồng nền + nút "Xong")
+        self.docs: OrderedDict = OrderedDict()   # user_id -> doc
+        self.marks: dict = {}                    # user_id -> _kiosk_mark lúc nạp / lần ghi xong gần nhất
+        self.loaded: dict = {}                   # user_id -> thời điểm nạp
+        self.dirty: dict = {}                    # user_id -> thời điểm bẩn đầu tiên
+        self.version: dict = {}                  # user_id -> số lần mutate (sửa tiếp trong lúc ghi → vẫn bẩn)
+        self.pin_fails: dict = {}                # user_id -> (số lần sai, khóa đến) — chung mọi phiên/kiosk
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="hz-kiosk-flush", daemon=True)
+        self.thread.start()
+
+    def _fresh(self, user_id: str) -> bool:
+        return user_id in self.docs and (user_id in self.dirty
+                                         or _t.time() - self.loaded[user_id] < KIOSK_DOC_TTL_S)
+
+    def get(self, user_id: str, nickname: str = "") -> dict:
+        with self.lock:
+            if self._fresh(user_id):
+                self.docs.move_to_end(user_id)
+                return self.docs[user_id]
+        t0 = _t.perf_counter()
+        data, _ = _load_account_doc(user_id, nickname)
+        perf_observe("kiosk.load_ms", (_t.perf_counter() - t0) * 1000)
+        with self.lock:
+            if self._fresh(user_id):   # luồng khác vừa nạp / doc vừa bị sửa → dùng bản đó
+                self.docs.move_to_end(user_id)
+                return self.docs[user_id]
+            self.docs[user_id] = data
+            self.docs.move_to_end(user_id)
+            self.marks[user_id], self.loaded[user_id] = _kiosk_mark(data), _t.time()
+            self._evict(keep=user_id)
+            return data
+
+    def warm(self, members: dict) -> list:
+        """Nạp song song doc của cả lớp (dùng chung pool luồng prefetch)."""
+        with self.lock:
+            missing = [uid for uid in members if not self._fresh(uid)]
+        pool = _prefetch_pool()
+        return [pool.submit(self.get, uid, members[uid]) for uid in missing]
+
+    def mutate(self, user_id: str, fn):
+        """fn(doc) sửa doc trong lock; trả về kết quả của fn và đánh dấu doc bẩn."""
+        while True:
+            self.get(user_id)
+            with self.lock:
+                data = self.docs.get(user_id)
+                if data is None:   # bị đẩy ra giữa chừng → nạp lại
+                    continue
+                out = fn(data)
+                self.dirty.setdefault(user_id, _t.time())
+                self.version[user_id] = self.version.get(user_id, 0) + 1
+                due = len(self.dirty) >= KIOSK_FLUSH_BATCH
+                break
+        if due:
+            self.wake.set()
+        return out
+
+    def pin_locked(self, user_id: str) -> bool:
+        with self.lock:
+            fails = self.pin_fails.get(user_id)
+        return bool(fails and fails[0] >= KIOSK_PIN_MAX_FAILS and _t.time() < fails[1])
+
+    def pin_failed(self, user_id: str):
+        """Mỗi lần sai gia hạn khóa; hết hạn mà sai tiếp là khóa lại ngay (đếm chỉ xóa khi nhập đúng)."""
+        with self.lock:
+            n = self.pin_fails.get(user_id, (0, 0))[0] + 1
+            self.pin_fails[user_id] = (n, _t.time() + KIOSK_PIN_LOCK_S)
+
+    def pin_ok(self, user_id: str):
+        with self.lock:
+            self.pin_fails.pop(user_id, None)
+
+    def _drop(self, user_id: str):
+        for d in (self.docs, self.marks, self.loaded, self.version):
+            d.pop(user_id, None)
+
+    def _evict(self, keep: Optional[str] = None):
+        """Gọi trong lock. Chỉ bỏ doc sạch; toàn doc bẩn → tạm vượt trần và đánh thức luồng xả (không ghi tại chỗ)."""
+        while len(self.docs) > self.max_docs:
+            victim = next((uid for uid in self.docs if uid not in self.dirty and uid != keep), None)
+            if victim is None:
+                self.wake.set()
+                return
+            self._drop(victim)
+
+    def flush(self, force: bool = False) -> int:
+        with self.flushing:
+            with self.lock:
+                if not self.dirty:
+                    return 0
+                if not force and len(self.dirty) < KIOSK_FLUSH_BATCH \
+                        and _t.time() - min(self.dirty.values()) < KIOSK_FLUSH_S:
+                    return 0
+                batch = {uid: (_kiosk_delta(self.docs[uid], self.marks[uid]), _kiosk_mark(self.docs[uid]),
+                               self.version.get(uid, 0)) for uid in self.dirty}
+            store, t0, n = get_storage(), _t.perf_counter(), 0
+            for user_id, (delta, mark, version) in batch.items():
+                try:
+                    merged = store.apply_delta(user_id, delta)
+                    if store.remote:
+                        _save_local(merged)
+                except Exception:
+                    perf_inc("kiosk.flush_errors")   # giữ bẩn, lần sau gửi lại delta (gộp không nhân đôi)
+                    continue
+                with self.lock:
+                    self.marks[user_id] = mark
+                    if self.version.get(user_id, 0) == version:
+                        self.dirty.pop(user_id, None)
+                n += 1
+            with self.lock:
+                self._evict()
+        perf_inc("kiosk.saves", n)
+        perf_observe("kiosk.flush_ms", (_t.perf_counter() - t0) * 1000)
+        return n
+
+    def _run(self):
+        while True:
+            self.wake.wait(KIOSK_FLUSH_S)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                perf_inc("kiosk.flush_errors")
+
+@st.cache_resource(show_spinner=False)
+def _kiosk_pool() -> _KioskPool:
+    return _KioskPool()
+
+def _kiosk_checkin(data: dict, mood: int) -> list[dict]:
+    now_iso = datetime.utcnow().isoformat()
+    data["game"].setdefault("moods", []).append({"date": now_iso, "mood": int(mood)})
+    week_summary_add(data, "moods", data["game"]["moods"][-1])
+    advance_streak(data["game"])
+    return evaluate_badges(data, ("checkins", "streak"))
+
+def _kiosk_quest(data: dict, quest: dict, payload: dict) -> list[dict]:
+    if not record_quest(data, quest, payload):
+        return []
+    return evaluate_badges(data, (QUEST_TYPE_COUNTER.get(quest["type"], quest["type"]),))
+
+def _kiosk_notify(badges: list[dict]):
+    for i, r in enumerate(badges):
+        notify_achievement(title=r["title"], subtitle=r["subtitle"], icon=r["icon"], delay_ms=i*350)
+
+def _kiosk_enroll(members: dict) -> list[dict]:
+    """Cấp PIN 4 số cho học sinh chưa có; trả về danh sách để in (PIN chỉ hiện 1 lần)."""
+    pool, out = _kiosk_pool(), []
+    for uid, nick in sorted(members.items(), key=lambda kv: kv[1].lower()):
+        data = pool.get(uid, nick)
+        pin = None
+        if not data.get("profile", {}).get("kiosk_pin"):
+            pin = f"{random.SystemRandom().randrange(10000):04d}"
+            pool.mutate(uid, lambda d, pin=pin: d.setdefault("profile", {}).__setitem__("kiosk_pin", _kiosk_pin_hash(pin)))
+        out.append({"nickname": nick, "pin": pin or "(đã có)", "card": kiosk_card_token(uid)})
+    pool.flush(force=True)
+    return out
+
+def render_kiosk_setup():
+    """Trang tư vấn viên: cấp PIN/thẻ cho lớp và bật kiosk trên thiết bị này."""
+    st.header("📱 Kiosk lớp học")
+    try:
+        cohorts = get_storage().cohorts()
+    except NotImplementedError:
+        st.info(f"Engine lưu trữ `{get_storage().name}` chưa có danh sách lớp — dùng `mongo` hoặc `sqlite`."); return
+    except Exception as e:
+        st.warning(f"⚠️ Chưa tải được danh sách lớp: {e}"); return
+    names = sorted(c["cohort"] for c in cohorts if c["cohort"] != NO_COHORT)
+    if not names:
+        st.caption("Chưa có lớp nào."); return
+    cohort = st.selectbox("Lớp", names, key="kiosk_cohort")
+    members = next((c.get("members", {}) for c in cohorts if c["cohort"] == cohort), {})
+    st.caption(f"{len(members)} học sinh")
+    c1, c2 = st.columns(2)
+    if c1.button("Cấp PIN & thẻ", key="kiosk_enroll", disabled=not members):
+        rows = _kiosk_enroll(members)
+        csv = "nickname,pin,card\n" + "\n".join(f"{r['nickname']},{r['pin']},{r['card']}" for r in rows)
+        st.session_state["_kiosk_cards"] = csv
+    if st.session_state.get("_kiosk_cards"):
+        st.download_button("Tải danh sách PIN/thẻ (.csv)", st.session_state["_kiosk_cards"].encode("utf-8"),
+                           file_name=f"kiosk_{cohort}.csv", mime="text/csv")
+        st.caption("Cột `card` in thành mã QR; máy quét gõ mã vào ô “Quét thẻ” của kiosk.")
+    if c2.button("▶ Bắt đầu kiosk", key="kiosk_start", disabled=not members):
+        _kiosk_pool().warm(members)
+        st.session_state["_kiosk"] = {"cohort": cohort, "members": dict(members)}
+        st.session_state.pop("_kiosk_cards", None)
+        st.rerun()
+
+def _kiosk_enter(user_id: str):
+    st.session_state["_kiosk_student"] = user_id
+    _kiosk_pool().pin_ok(user_id)
+    st.session_state["_kiosk_t0"] = _t.perf_counter()
+
+def _kiosk_leave():
+    t0 = st.session_state.pop("_kiosk_t0", None)
+    if t0:
+        perf_observe("kiosk.student_s", _t.perf_counter() - t0)
+    perf_inc("kiosk.students")
+    st.session_state.pop("_kiosk_student", None)
+    st.session_state.pop("_kiosk_pick", None)
+
+def _kiosk_on_scan(members: dict):
+    """Máy quét gõ mã + Enter → callback chạy trước khi vẽ lại, xóa ô để quét thẻ kế tiếp."""
+    uid = kiosk_parse_card(st.session_state.get("kiosk_scan", ""))
+    st.session_state["kiosk_scan"] = ""
+    if uid in members:
+        _kiosk_enter(uid)
+    else:
+        st.session_state["_kiosk_scan_bad"] = True
+
+def _kiosk_roster(kiosk: dict):
+    members = kiosk["members"]
+    st.subheader(f"Lớp {kiosk['cohort']} — chạm tên của em")
+    st.text_input("Quét thẻ", key="kiosk_scan", placeholder="Đưa thẻ QR vào máy quét…",
+                  on_change=_kiosk_on_scan, args=(members,))
+    if st.session_state.pop("_kiosk_scan_bad", False):
+        st.error("Thẻ không hợp lệ cho lớp này.")
+    pick = st.session_state.get("_kiosk_pick")
+    if pick:
+        st.markdown(f"### {members.get(pick, pick)}")
+        if _kiosk_pool().pin_locked(pick):   # đếm sai ở pool (process) → tải lại trang không xóa được
+            st.error("Nhập sai quá nhiều lần — nhờ thầy cô hỗ trợ nhé."); 
+        else:
+            with st.form("kiosk_pin_form", clear_on_submit=True):
+                pin = st.text_input("PIN", type="password", max_chars=6)
+                ok = st.form_submit_button("Vào")
+            if ok:
+                if kiosk_pin_ok(_kiosk_pool().get(pick, members.get(pick, "")), pin):
+                    _kiosk_enter(pick); st.rerun()
+                _kiosk_pool().pin_failed(pick)
+                st.error("PIN chưa đúng.")
+        if st.button("← Chọn lại", key="kiosk_back"):
+            st.session_state.pop("_kiosk_pick", None); st.rerun()
+        return
+    cols = st.columns(5)
+    for i, (uid, nick) in enumerate(sorted(members.items(), key=lambda kv: kv[1].lower())):
+        if cols[i % 5].button(nick, key=f"kiosk_pick_{uid}", use_container_width=True):
+            st.session_state["_kiosk_pick"] = uid; st.rerun()
+
+def _kiosk_student(kiosk: dict, user_id: str):
+    pool = _kiosk_pool()
+    nick = kiosk["members"].get(user_id, "")
+    data = pool.get(user_id, nick)
+    st.subheader(f"Chào {data['profile'].get('nickname') or nick}! 🌱")
+    today = _today_utc().isoformat()
+    moods = data["game"].get("moods", [])
+    if not (moods and moods[-1].get("date", "")[:10] == today):
+        mood = st.slider("Tâm trạng của em (1 rất tệ → 10 rất tốt):", 1, 10, 5, key=f"kiosk_mood_{user_id}")
+        st.markdown(f"### {mood_emoji(mood)} ({mood})")
+        if st.button("Lưu check-in ✅", key="kiosk_checkin", disabled=is_ui_locked()):
+            _kiosk_notify(pool.mutate(user_id, lambda d: _kiosk_checkin(d, mood)))
+            rollup_record_checkin(user_id, user_cohort(data), today, int(mood))
+            st.rerun()
+    else:
+        st.success(f"Đã check-in hôm nay — streak {data['game'].get('streak', 0)} ngày 🎉")
+        with pool.lock:   # kế hoạch quest ghi vào doc, đi cùng lần xả của check-in
+            quests = daily_quests(user_id, k=3, data=data)
+        for q in quests:
+            kq = f"k{_safe_name(user_id)[:10]}_{q['quest_id']}"   # timer riêng từng học sinh
+            with st.expander(f"{'✅' if is_quest_done(data, q['quest_id']) else '🕹️'} {q['title']}"):
+                if is_quest_done(data, q["quest_id"]):
+                    st.caption("Đã hoàn thành."); continue
+                st.caption(q["desc"])
+                payload = None
+                if q["type"] == "breathing":
+                    breathing_478_stateful(kq, rounds=q.get("rounds", 2), phases=q.get("phases"))
+                    payload = {"completed": True} if st.session_state.get(f"br_{kq}_state") == "done" else None
+                elif q["type"] == "mini_mindful":
+                    mindful_30s_with_music(kq, total_sec=q.get("duration_sec", 30))
+                    payload = {"completed": True} if st.session_state.get(f"tm_{kq}_state") == "done" else None
+                elif q["type"] == "gratitude":
+                    g = st.text_input("Điều ý nghĩa hôm nay", key=f"{kq}_g1", disabled=is_ui_locked())
+                    if st.button("Lưu", key=f"{kq}_save", disabled=is_ui_locked() or not g.strip()):
+                        payload = {"gratitude": [g.strip()]}
+                if payload:
+                    _kiosk_notify(pool.mutate(user_id, lambda d, q=q, payload=payload: _kiosk_quest(d, q, payload)))
+                    st.rerun()
+    st.markdown("---")
+    if st.button("✅ Xong — bạn tiếp theo", key="kiosk_done", disabled=is_ui_locked(), type="primary"):
+        for k in [k for k in st.session_state.keys() if f"k{_safe_name(user_id)[:10]}_" in k]:
+            st.session_state.pop(k, None)
+        _kiosk_leave(); pool.flush(); st.rerun()
+
+def render_kiosk():
+    """Màn hình kiosk: danh sách lớp ↔ màn hình check-in của 1 học sinh. Thoát cần mật khẩu giáo viên."""
+    kiosk = st.session_state["_kiosk"]
+    st.title(APP_TITLE); st.caption("Chế độ kiosk lớp học")
+    user_id = st.session_state.get("_kiosk_student")
+    if user_id in kiosk["members"]:
+        _kiosk_student(kiosk, user_id)
+        return
+    _kiosk_roster(kiosk)
+    st.markdown("---")
+    with st.expander("🔒 Giáo viên"):
+        with st.form("kiosk_exit_form", clear_on_submit=True):
+            pw = st.text_input("Mật khẩu giáo viên", type="password")
+            ok = st.form_submit_button("Thoát kiosk")
+        if ok:
+            _uid, err = _login_user(st.session_state.get("username", ""), pw)
+            if err:
+                st.error(err)
+            else:
+                _kiosk_pool().flush(force=True)
+                for k in ("_kiosk", "_kiosk_student", "_kiosk_pick"):
+                    st.session_state.pop(k, None)
+                st.rerun()
+
+# ====== Mood trends (NumPy) ======
+TREND_CACHE_MAX_USERS = 512
+
+class _MoodSeries:
+    """Chuỗi thời gian gọn của 1 user: ngày (int32) + điểm (int8) cho check-in, ngày hoàn thành quest."""
+    __slots__ = ("n_moods", "last_mood_date", "days", "scores", "n_quests", "quest_days")
+
+    def __init__(self):
+        self.n_moods, self.last_mood_date = 0, None
+        self.days = np.empty(0, dtype=np.int32)
+        self.scores = np.empty(0, dtype=np.int8)
+        self.n_quests = 0
+        self.quest_days = np.empty(0, dtype=np.int32)
+
+    def sync(self, game: dict) -> "_MoodSeries":
+        """Chỉ nối thêm các bản ghi mới; nếu lịch sử bị sửa ở giữa (merge/migrate) thì dựng lại."""
+        moods = game.get("moods", [])
+        n = self.n_moods
+        if n > len(moods) or (n and moods[n - 1].get("date") != self.last_mood_date):
+            self.__init__(); n = 0
+        new = moods[n:]
+        if new:
+            valid = [m for m in new if m.get("date")]
+            self.days = np.concatenate([self.days, _iso_days([m["date"] for m in valid])])
+            self.scores = np.concatenate([self.scores, np.array([int(m.get("mood", 0)) for m in valid], dtype=np.int8)])
+            self.n_moods, self.last_mood_date = len(moods), moods[-1].get("date")
+        quests = game.get("quests", {})
+        if self.n_quests > len(quests):
+            self.n_quests, self.quest_days = 0, np.empty(0, dtype=np.int32)
+        if len(quests) > self.n_quests:
+            new_q = list(quests.values())[self.n_quests:]
+            self.quest_days = np.concatenate([self.quest_days,
+                                              _iso_days([q["completed_at"] for q in new_q if q.get("completed_at")])])
+            self.n_quests = len(quests)
+        return self
+
+@st.cache_resource(show_spinner=False)
+def _trend_cache() -> dict:
+    return {"lock": threading.Lock(), "series": OrderedDict()}
+
+def mood_series_for(user_key: str, data: dict) -> _MoodSeries:
+    cache = _trend_cache()
+    with cache["lock"]:
+        ser = cache["series"].pop(user_key, None) or _MoodSeries()
+        cache["series"][user_key] = ser
+        while len(cache["series"]) > TREND_CACHE_MAX_USERS:
+            cache["series"].popitem(last=False)
+    return ser.sync(data.get("game", {}))
+
+def _rolling_mean(sums: "np.ndarray", counts: "np.ndarray", window: int) -> "np.ndarray":
+    cs = np.concatenate([[0.0], np.cumsum(sums)])
+    cc = np.concatenate([[0], np.cumsum(counts)])
+    idx = np.arange(1, len(sums) + 1)
+    lo = np.maximum(0, idx - window)
+    s, c = cs[idx] - cs[lo], cc[idx] - cc[lo]
+    return np.divide(s, c, out=np.full(len(sums), np.nan), where=c > 0)
+
+def mood_trends(ser: _MoodSeries) -> Optional[dict]:
+    """Trung bình trượt 7/30 ngày, theo thứ trong tuần, độ dao động, tương quan với số quest/ngày."""
+    if ser.days.size == 0:
+        return None
+    d0 = int(ser.days.min()); span = int(ser.days.max()) - d0 + 1
+    off = ser.days - d0
+    sums = np.bincount(off, weights=ser.scores, minlength=span)
+    counts = np.bincount(off, minlength=span)
+    has = counts > 0
+    daily = np.divide(sums, counts, out=np.full(span, np.nan), where=has)
+
+    wd = (ser.days + 3) % 7  # 1970-01-01 là thứ Năm → 0 = thứ Hai
+    wd_cnt = np.bincount(wd, minlength=7)
+    wd_mean = np.divide(np.bincount(wd, weights=ser.scores, minlength=7), wd_cnt,
+                        out=np.full(7, np.nan), where=wd_cnt > 0)
+
+    observed = daily[has]
+    volatility = float(np.std(observed)) if observed.size > 1 else 0.0
+    swing = float(np.mean(np.abs(np.diff(observed)))) if observed.size > 1 else 0.0
+
+    q = ser.quest_days[(ser.quest_days >= d0) & (ser.quest_days < d0 + span)] - d0
+    quests_per_day = np.bincount(q, minlength=span)[:span]
+    corr = None
+    if observed.size >= 3:
+        qx = quests_per_day[has].astype(float)
+        if np.std(qx) > 0 and np.std(observed) > 0:
+            corr = float(np.corrcoef(observed, qx)[0, 1])
+
+    return {
+        "start": d0, "span": span, "daily": daily,
+        "avg7": _rolling_mean(sums, counts, 7), "avg30": _rolling_mean(sums, counts, 30),
+        "weekday": wd_mean, "volatility": volatility, "swing": swing, "corr_quests": corr,
+        "checkins": int(ser.days.size),
+    }
+
+def _nan_to_none(a: "np.ndarray") -> list:
+    return [None if np.isnan(v) else round(float(v), 2) for v in a]
+
+def render_mood_trends(user_key: str, data: dict):
+    tr = mood_trends(mood_series_for(user_key, data))
+    if tr is None:
+        st.caption("Chưa có check-in nào."); return
+    c1, c2, c3 = st.columns(3)
+    last7 = tr["avg7"][-1]
+    c1.metric("TB 7 ngày", "–" if np.isnan(last7) else f"{last7:.1f}")
+    c2.metric("Độ dao động", f"{tr['volatility']:.2f}", help="Độ lệch chuẩn điểm theo ngày")
+    c3.metric("Tương quan với hoạt động", "–" if tr["corr_quests"] is None else f"{tr['corr_quests']:+.2f}",
+              help="Hệ số tương quan giữa điểm tâm trạng và số hoạt động hoàn thành trong ngày")
+
+    window = st.selectbox("Hiển thị", [30, 90, 365, 0], index=1, key="trend_window",
+                          format_func=lambda d: "Toàn bộ" if d == 0 else f"{d} ngày gần nhất")
+    lo = 0 if window == 0 else max(0, tr["span"] - window)
+    dates = np.arange(tr["start"] + lo, tr["start"] + tr["span"]).astype("datetime64[D]").astype(str)
+    st.line_chart({"Ngày": dates.tolist(), "Theo ngày": _nan_to_none(tr["daily"][lo:]),
+                   "TB 7 ngày": _nan_to_none(tr["avg7"][lo:]), "TB 30 ngày": _nan_to_none(tr["avg30"][lo:])},
+                  x="Ngày", y=["Theo ngày", "TB 7 ngày", "TB 30 ngày"])
+    st.bar_chart({"Thứ": WEEKDAYS_VI, "Điểm TB": _nan_to_none(tr["weekday"])}, x="Thứ", y="Điểm TB")
+    st.caption(f"{tr['checkins']} lần check-in · chênh lệch trung bình giữa 2 lần liên tiếp: {tr['swing']:.2f} điểm")
+
+# ====== Tìm kiếm (inverted index theo user) ======
+# Lưu trong doc ở data["search"]:
+#   docs: [[kind, ref, date, độ dài], ...]   (doc id = vị trí trong list)
+#   post: {term đã bỏ dấu: "id id:tf ..."}   (tf=1 thì bỏ ":1"; chuỗi cho gọn khi lưu JSON/BSON)
+# Thêm bản ghi = nối chuỗi postings → cập nhật tăng dần ngay khi lưu nhật ký/cây/biết ơn.
+SEARCH_INDEX_VERSION = 1
+SEARCH_TITLE_BOOST = 3
+SEARCH_PAGE_SIZE = 10
+_SEARCH_TOKEN_RE = re.compile(r"\w+")
+_COMBINING_RE = re.compile("[\u0300-\u036f]")   # mọi dấu thanh/dấu phụ tiếng Việt nằm trong khối này
+_BM25_K1, _BM25_B = 1.2, 0.75
+
+def fold_vi(text: str) -> str:
+    """Bỏ dấu tiếng Việt + chữ thường: 'Điều ý nghĩa' → 'dieu y nghia' (giữ nguyên độ dài chuỗi NFC)."""
+    text = unicodedata.normalize("NFD", text.replace("đ", "d").replace("Đ", "D"))
+    return _COMBINING_RE.sub("", text).lower()
+
+def search_tokens(text: str) -> list[str]:
+    return [t for t in _SEARCH_TOKEN_RE.findall(fold_vi(text or "")) if len(t) > 1 or t.isdigit()]
+
+def _search_fields(kind: str, e: dict) -> list[tuple[str, int]]:
+    if kind == "journal":
+        return [(e.get("title", ""), SEARCH_TITLE_BOOST), (e.get("content", ""), 1)]
+    if kind == "garden":
+        return [(e.get("affirmation", ""), 1)]
+    return [(" ".join((e.get("payload") or {}).get("gratitude") or []), 1)]
+
+def _search_ref(kind: str, e: dict) -> str:
+    if kind == "quests":
+        return e.get("quest_id", "")
+    return e.get("id") or e.get("date", "")
+
+def _search_index_many(data: dict, items: list[tuple[str, dict]]) -> int:
+    """Thêm nhiều bản ghi 1 lượt: gom postings mới theo term rồi nối chuỗi 1 lần/term."""
+    idx = data.get("search")
+    if not idx or idx.get("v") != SEARCH_INDEX_VERSION:
+        idx = data["search"] = {"v": SEARCH_INDEX_VERSION, "docs": [], "post": {}, "total_len": 0}
+    docs, new_post, added = idx["docs"], {}, 0
+    for kind, entry in items:
+        tf = Counter()
+        for text, w in _search_fields(kind, entry):
+            for t in search_tokens(text):
+                tf[t] += w
+        if not tf:
+            continue
+        doc_id, dl = len(docs), sum(tf.values())
+        docs.append([kind, _search_ref(kind, entry), _entity_date(kind, entry)[:19], dl])
+        idx["total_len"] = idx.get("total_len", 0) + dl
+        for t, n in tf.items():
+            new_post.setdefault(t, []).append(f"{doc_id}:{n}" if n > 1 else str(doc_id))
+        added += 1
+    post = idx["post"]
+    for t, plist in new_post.items():
+        post[t] = f"{post[t]} {' '.join(plist)}" if t in post else " ".join(plist)
+    return added
+
+def search_index_add(data: dict, kind: str, entry: dict) -> bool:
+    """Đưa 1 bản ghi vào index của user (không lưu doc — bên gọi tự save_user)."""
+    return _search_index_many(data, [(kind, entry)]) > 0
+
+def ensure_search_index(data: dict) -> int:
+    """Bù các bản ghi chưa có trong index (doc cũ, dữ liệu gộp từ cloud/replica khác). Trả về số bản ghi thêm."""
+    idx = data.get("search") or {}
+    have = {(d[0], d[1]) for d in idx.get("docs", [])} if idx.get("v") == SEARCH_INDEX_VERSION else set()
+    game = data.get("game", {})
+    # index đúng version → chỉ cần bù phần gần đây (lát cắt nếu mục chưa nạp); khác version → dựng từ đủ dữ liệu
+    recent = (lambda k, d: game_recent(data, k, d)) if have else game.get
+    missing = [(kind, e)
+               for kind, entries in (("journal", recent("journal", [])), ("garden", recent("garden", [])),
+                                     ("quests", recent("quests", {}).values()))
+               for e in entries
+               if (kind != "quests" or e.get("type") == "gratitude") and (kind, _search_ref(kind, e)) not in have]
+    return _search_index_many(data, missing) if missing else 0
+
+def _decode_postings(s: str) -> tuple:
+    ids, tfs = [], []
+    for p in s.split():
+        d, _, n = p.partition(":")
+        ids.append(int(d)); tfs.append(int(n or 1))
+    return np.array(ids, dtype=np.int64), np.array(tfs, dtype=np.float64)
+
+def _term_postings(post: dict, term: str, cache: Optional[dict]) -> tuple:
+    """Postings đã giải mã; có `cache` (theo phiên) thì chỉ giải mã phần đuôi mới nối thêm."""
+    s = post.get(term, "")
+    if cache is None:
+        return _decode_postings(s)
+    hit = cache.get(term)
+    if hit and hit[0] == len(s):
+        return hit[1], hit[2]
+    if hit and hit[0] < len(s):
+        ids, tfs = _decode_postings(s[hit[0]:])
+        ids, tfs = np.concatenate([hit[1], ids]), np.concatenate([hit[2], tfs])
+    else:
+        ids, tfs = _decode_postings(s)
+    cache[term] = (len(s), ids, tfs)
+    return ids, tfs
+
+def search_entries(data: dict, query: str, page: int = 0, per_page: int = SEARCH_PAGE_SIZE,
+                   cache: Optional[dict] = None) -> tuple[int, list[dict]]:
+    """
+    BM25 trên index của user; mọi từ trong câu truy vấn đều phải xuất hiện (AND),
+    từ cuối khớp theo tiền tố ("nghi" → nghi, nghia, nghiem...). Trả về (tổng số kết quả, 1 trang hit).
+    Cùng điểm → bản ghi vào index sau (mới hơn) đứng trước.
+    """
+    terms = list(dict.fromkeys(search_tokens(query)))
+    idx = data.get("search") or {}
+    docs, post = idx.get("docs", []), idx.get("post", {})
+    if not terms or not docs:
+        return 0, []
+    if cache is not None and cache.get("_idx") is not idx:
+        cache.clear(); cache["_idx"] = idx
+    n_docs = len(docs)
+    dl = cache.get("_dl") if cache is not None else None
+    if dl is None or len(dl) != n_docs:
+        dl = np.array([d[3] for d in docs], dtype=np.float64)
+        if cache is not None:
+            cache["_dl"] = dl
+    norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * dl / max(1.0, idx.get("total_len", 0) / n_docs))
+
+    total = np.zeros(n_docs)
+    matched = np.ones(n_docs, dtype=bool)
+    for i, term in enumerate(terms):
+        expanded = [t for t in post if t.startswith(term)] if i == len(terms) - 1 else [term]
+        part = np.zeros(n_docs)
+        for t in expanded:
+            ids, tfs = _term_postings(post, t, cache)
+            if not len(ids):
+                continue
+            idf = math.log(1 + (n_docs - len(ids) + 0.5) / (len(ids) + 0.5))
+            part[ids] = np.maximum(part[ids], idf * tfs * (_BM25_K1 + 1) / (tfs + norm[ids]))
+        matched &= part > 0
+        if not matched.any():
+            return 0, []
+        total += part
+    ids = np.nonzero(matched)[0]
+    order = ids[np.lexsort((-ids, -total[ids]))]
+    hits = [{"kind": docs[d][0], "ref": docs[d][1], "date": docs[d][2], "score": float(total[d])}
+            for d in order[page * per_page:(page + 1) * per_page].tolist()]
+    return len(ids), hits
+
+def _search_snippet(text: str, terms: list[str], width: int = 160) -> str:
+    text = unicodedata.normalize("NFC", text or "")
+    folded = fold_vi(text)
+    pos = min([p for p in (folded.find(t) for t in terms) if p >= 0] or [0])
+    start = max(0, pos - width // 3)
+    out = text[start:start + width].replace("\n", " ")
+    return ("…" if start else "") + out + ("…" if start + width < len(text) else "")
+
+def render_search(data: dict):
+    q = st.text_input("Tìm trong nhật ký, lời biết ơn và khu vườn", key="search_q",
+                      placeholder="VD: biet on me, ky thi…")
+    if not q.strip():
+        return
+    if ensure_search_index(data):
+        save_user(data)
+    if st.session_state.get("_search_last_q") != q:
+        st.session_state["_search_last_q"] = q; st.session_state["search_page"] = 0
+    page = int(st.session_state.get("search_page", 0))
+    t0 = _t.perf_counter()
+    total, hits = search_entries(data, q, page, cache=st.session_state.setdefault("_search_cache", {}))
+    took_ms = (_t.perf_counter() - t0) * 1000
+    perf_observe("search.query_ms", took_ms)
+    if not total:
+        st.caption("Không tìm thấy kết quả."); return
+    st.caption(f"{total} kết quả · {took_ms:.1f} ms")
+
+    game, terms = data["game"], search_tokens(q)
+    lookup = {}
+    for kind in {h["kind"] for h in hits}:
+        if kind == "quests":
+            lookup[kind] = game.get("quests", {})
+        else:
+            lookup[kind] = {_search_ref(kind, e): e for e in game.get(kind, [])}
+    labels = {"journal": "📔 Nhật ký", "garden": "🌱 Khu vườn", "quests": "🙏 Biết ơn"}
+    for h in hits:
+        e = lookup.get(h["kind"], {}).get(h["ref"])
+        if not e and h["date"][:7] in data["game"].get("archive_index", {}).get(h["kind"], {}):
+            # bản ghi đã sang tầng lạnh → tải đúng tháng của kết quả
+            e = next((x for x in load_archived(data, h["kind"], h["date"][:7])
+                      if _search_ref(h["kind"], x) == h["ref"]), None)
+        if not e:
+            continue
+        text = " · ".join(t for t, _ in _search_fields(h["kind"], e) if t)
+        st.markdown(f"**{labels[h['kind']]}** — {h['date'][:16].replace('T', ' ')}")
+        st.write(_search_snippet(text, terms))
+
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    if pages > 1:
+        c1, c2, c3 = st.columns([1, 2, 1])
+        if c1.button("◀", key="search_prev", disabled=page <= 0):
+            st.session_state["search_page"] = page - 1; st.rerun()
+        c2.caption(f"Trang {page + 1}/{pages}")
+        if c3.button("▶", key="search_next", disabled=page >= pages - 1):
+            st.session_state["search_page"] = page + 1; st.rerun()
+
+# ====== Ingest đối tác (NDJSON) ======
+# Mỗi dòng 1 bản ghi JSON có user_id + type:
+#   {"user_id": "...", "type": "checkin", "date": "2026-10-19T07:30:00", "mood": 7}
+#   {"user_id": "...", "type": "journal", "date": "...", "title": "...", "content": "..."}
+#   {"user_id": "...", "type": "quest", "quest_type": "breathing|gratitude|mini_mindful", "date": "...",
+#    "gratitude": ["..."]}
+# Bản ghi được kiểm tra theo đúng mô hình dữ liệu của app, gom theo user rồi áp 1 lượt/user (streak, đếm quest,
+# huy hiệu, tóm tắt tuần) rồi ghi PHẦN THÊM bằng StorageEngine.apply_deltas (như kiosk: gộp vào bản mới nhất trong
+# store, Mongo $addToSet/$max) → không đè thay đổi app/kiosk/job ghi cùng user giữa lúc đọc và lúc ghi. Index tìm
+# kiếm không đi theo delta: ensure_search_index bù lúc user tìm. Gửi lại cùng file là an
+# toàn: check-in trùng thời điểm, nhật ký trùng (ngày, tiêu đề) và quest cùng loại trong ngày đều bị bỏ qua.
+# Mỗi nhóm user là 1 đơn vị: ghi doc rồi cộng rollup trong cùng 1 khối try. Nhóm lỗi được báo ở `failed`
+# (các nhóm khác vẫn ghi) → gửi lại cả lô. Rollup không bỏ trùng được như doc: nhóm lỗi giữa chừng (doc đã ghi,
+# rollup chưa / ghi 1 phần) có thể làm rollup lệch → báo cáo kèm `rollup_since` để chạy backfill-rollups.
+INGEST_TYPES = ("checkin", "journal", "quest")
+INGEST_MAX_TEXT = 20_000
+INGEST_MAX_ERRORS = 100
+
+def _ingest_date(raw) -> str:
+    try:
+        dt = datetime.fromisoformat(str(raw).replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"date không hợp lệ: {raw!r}")
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    if dt > datetime.utcnow() + timedelta(days=1):
+        raise ValueError("date ở tương lai")
+    return dt.isoformat()
+
+def ingest_parse(rec: dict) -> tuple[str, str, dict]:
+    """Kiểm tra 1 bản ghi → (user_id, kind trong game, entity). Sai mô hình → ValueError."""
+    if not isinstance(rec, dict):
+        raise ValueError("mỗi dòng phải là 1 object JSON")
+    uid = str(rec.get("user_id") or "").strip()
+    if not uid:
+        raise ValueError("thiếu user_id")
+    typ = rec.get("type")
+    if typ not in INGEST_TYPES:
+        raise ValueError(f"type phải là 1 trong {INGEST_TYPES}")
+    when = _ingest_date(rec.get("date") or rec.get("completed_at") or "")
+    if typ == "checkin":
+        mood = rec.get("mood")
+        if isinstance(mood, bool) or not isinstance(mood, int) or not 1 <= mood <= 10:
+            raise ValueError("mood phải là số nguyên 1–10")
+        return uid, "moods", {"date": when, "mood": mood}
+    if typ == "journal":
+        content = str(rec.get("content") or "").strip()
+        if not content:
+            raise ValueError("nhật ký trống")
+        if len(content) > INGEST_MAX_TEXT:
+            raise ValueError(f"nhật ký dài quá {INGEST_MAX_TEXT} ký tự")
+        return uid, "journal", {"date": when, "title": str(rec.get("title") or "").strip()[:200] or "(No title)",
+                                "content": content}
+    qt = rec.get("quest_type")
+    if qt not in QUEST_TYPE_COUNTER:
+        raise ValueError(f"quest_type phải là 1 trong {tuple(QUEST_TYPE_COUNTER)}")
+    payload = {"completed": True, "source": "ingest"}
+    if qt == "gratitude":
+        items = [str(g).strip()[:500] for g in (rec.get("gratitude") or []) if str(g).strip()]
+        if not items:
+            raise ValueError("quest gratitude cần ít nhất 1 mục trong `gratitude`")
+        payload = {"gratitude": items, "source": "ingest"}
+    return uid, "quests", {"quest_id": f"{qt}-{when[:10]}", "type": qt, "title": QUEST_TYPE_LABELS[qt],
+                           "completed_at": when, "payload": payload}
+
+def ingest_apply(data: dict, items: list[tuple[str, dict]]) -> dict:
+    """
+    Áp các bản ghi đã kiểm tra của 1 user vào doc (không lưu). Trả về số thêm/trùng, check-in để cộng rollup
+    và `new` (bản ghi thực sự thêm, theo kind) để dựng delta.
+    """
+    game = data.setdefault("game", {})
+    added = dupes = 0
+    new = {"moods": [], "journal": [], "quests": {}}
+    changed, checkins, late = set(), [], set()
+    seen = {"moods": {m.get("date") for m in game.get("moods", [])},
+            "journal": {(j.get("date"), j.get("title")) for j in game.get("journal", [])}}
+    for kind, e in items:
+        if kind == "quests":
+            if e["quest_id"] in game.setdefault("quests", {}):
+                dupes += 1; continue
+            game["quests"][e["quest_id"]] = new["quests"][e["quest_id"]] = e
+            tc = game.setdefault("quest_counts", {}); tc[e["type"]] = tc.get(e["type"], 0) + 1
+            if e["type"] == "gratitude":
+                search_index_add(data, "quests", e)
+            changed.add(QUEST_TYPE_COUNTER[e["type"]])
+        else:
+            key = e["date"] if kind == "moods" else (e["date"], e["title"])
+            if key in seen[kind]:
+                dupes += 1; continue
+            seen[kind].add(key)
+            lst = game.setdefault(kind, [])
+            if lst and lst[-1].get("date", "") > e["date"]:
+                late.add(kind)
+            lst.append(e); new[kind].append(e)
+            if kind == "moods":
+                checkins.append((e["date"][:10], e["mood"]))
+                changed.update(("checkins", "streak"))
+            else:
+                search_index_add(data, "journal", e)
+                changed.add("journal_total")
+        week_summary_add(data, kind, e)
+        added += 1
+    for kind in late:   # giữ list theo thứ tự ngày như khi ghi từ app
+        game[kind].sort(key=lambda x: x.get("date", ""))
+    if checkins:
+        repair_streaks(game)
+    badges = evaluate_badges(data, tuple(changed)) if changed else []
+    return {"added": added, "duplicates": dupes, "checkins": checkins, "badges": [b["id"] for b in badges], "new": new}
+
+def _ingest_delta(data: dict, new: dict) -> dict:
+    """Delta cho StorageEngine.apply_delta: bản ghi mới + streak/đếm quest/huy hiệu đã tính lại trên doc vừa áp."""
+    game = data["game"]
+    g = {**new, "quest_counts": game.get("quest_counts", {}),
+         "badges": game.get("badges", []), "badge_ids": game.get("badge_ids", [])}
+    g.update({k: game[k] for k in ("streak", "last_checkin_date", "longest_streak", "streak_history") if k in game})
+    return {"game": g, "profile": {}}
+
+def _ingest_rollups(store: StorageEngine, rollups: list[tuple]):
+    """Cộng rollup của 1 nhóm; lỗi được ném ra (khác rollup_record_checkin) để nhóm bị báo `failed`."""
+    for uid, cohort, day, mood in rollups:
+        try:
+            store.rollup_inc(cohort, day, int(mood), uid)
+        except NotImplementedError:   # engine không có rollup (json)
+            return
+
+def ingest_lines(lines, store: Optional[StorageEngine] = None, chunk: int = 200) -> dict:
+    """
+    Nạp 1 lô NDJSON (iterable các dòng str/bytes). Lỗi từng dòng không chặn cả lô; user không tồn tại → bản ghi
+    bị từ chối. Ghi theo từng nhóm `chunk` user bằng store.apply_deltas (chỉ phần thêm, gộp vào bản mới nhất)
+    rồi cộng rollup của nhóm. Nhóm lỗi: bản ghi tính vào `failed` (không vào `accepted`), `retry` nói cách gửi lại.
+    """
+    store = store or get_storage()
+    t0 = _t.perf_counter()
+    report = {"lines": 0, "accepted": 0, "duplicates": 0, "rejected": 0, "failed": 0, "users": 0, "badges": 0,
+              "errors": [], "retry": None, "rollup_since": None}
+    def reject(line_no: int, msg: str, n: int = 1):
+        report["rejected"] += n
+        if len(report["errors"]) < INGEST_MAX_ERRORS:
+            report["errors"].append({"line": line_no, "error": msg})
+    by_user: dict[str, list] = {}
+    for line_no, raw in enumerate(lines, 1):
+        raw = raw.decode("utf-8") if isinstance(raw, bytes) else raw
+        if not raw.strip():
+            continue
+        report["lines"] += 1
+        try:
+            uid, kind, entity = ingest_parse(json.loads(raw))
+        except (ValueError, TypeError) as e:   # JSONDecodeError là ValueError
+            reject(line_no, str(e)); continue
+        by_user.setdefault(uid, []).append((line_no, kind, entity))
+    uids = list(by_user)
+    for i in range(0, len(uids), max(1, chunk)):
+        batch, rollups, added, dups, badges = [], [], 0, 0, 0
+        try:
+            for uid in uids[i:i + chunk]:
+                recs = by_user[uid]
+                data = store.load(uid)
+                if data is None:
+                    reject(recs[0][0], f"user_id không tồn tại: {uid}", len(recs)); continue
+                migrate_user_doc(data)
+                res = ingest_apply(data, [(k, e) for _, k, e in recs])
+                added += res["added"]; dups += res["duplicates"]; badges += len(res["badges"])
+                if res["added"]:
+                    batch.append((uid, _ingest_delta(data, res["new"])))
+                    rollups += [(uid, user_cohort(data), day, mood) for day, mood in res["checkins"]]
+            if batch:
+                store.apply_deltas(batch)
+            _ingest_rollups(store, rollups)
+        except Exception as e:
+            report["failed"] += added
+            first = by_user[uids[i]][0][0]
+            if len(report["errors"]) < INGEST_MAX_ERRORS:
+                report["errors"].append({"line": first, "error": f"nhóm user {i}–{i + len(uids[i:i + chunk]) - 1} "
+                                                                  f"chưa ghi xong: {e}"})
+            days = [day for _, _, day, _ in rollups]
+            if days:
+                report["rollup_since"] = min([d for d in (report["rollup_since"], *days) if d])
+            perf_inc("ingest.chunk_errors")
+            continue
+        report["accepted"] += added; report["duplicates"] += dups; report["badges"] += badges
+        report["users"] += len(batch)
+    if report["failed"]:
+        report["retry"] = ("Gửi lại cả lô: bản ghi đã ghi được sẽ bị bỏ qua như trùng."
+                           + (f" Rollup lớp có thể lệch từ {report['rollup_since']} → chạy "
+                              f"`healing_jobs.py backfill-rollups --since {report['rollup_since']}`."
+                              if report["rollup_since"] else ""))
+    dt = _t.perf_counter() - t0
+    report["seconds"] = round(dt, 3)
+    report["records_per_s"] = round(report["lines"] / dt, 1) if dt else 0.0
+    perf_inc("ingest.records", report["accepted"])
+    perf_inc("ingest.rejected", report["rejected"])
+    perf_observe("ingest.batch_ms", dt * 1000)
+    return report
+
 # ====== Misc ======
 def mood_emoji(score: int):
     if score <= 2: return "😢"
@@ -981,9 +4746,22 @@ QUOTES = [
     "Thật tốt khi bạn vẫn ở đây, tiếp tục cố gắng.",
 ]
 
-def export_journal_to_txt(data: dict):
+def _archive_month_picker(data: dict, kind: str, key: str) -> Optional[list[dict]]:
+    """Chọn 1 tháng đã lưu trữ để xem; None = đang xem dữ liệu gần đây."""
+    months = archived_months(data, kind)
+    if not months:
+        return None
+    pick = st.selectbox("Xem tháng", ["Gần đây"] + months[::-1], key=key)
+    return None if pick == "Gần đây" else load_archived(data, kind, pick)
+
+def export_journal_to_txt(data: dict, include_archive: bool = False):
+    entries = data["game"].get("journal", [])
+    if include_archive:
+        # đọc thẳng từ tầng lạnh, không đi qua cache phiên để khỏi đẩy các tháng đang xem ra ngoài
+        store, user_id = _archive_target(data)
+        entries = [e for m in archived_months(data, "journal") for e in store.archive_get(user_id, "journal", m)] + entries
     lines = []
-    for entry in data["game"].get("journal", []):
+    for entry in entries:
         lines.append(f"=== {entry.get('date','')} — {entry.get('title','(No title)')} ===")
         lines.append(entry.get("content","")); lines.append("\n")
     return "\n".join(lines)
@@ -991,6 +4769,9 @@ def export_journal_to_txt(data: dict):
 # ====== Main ======
 def main():
     st.set_page_config(page_title=APP_TITLE, page_icon="🌱", layout="wide", initial_sidebar_state="expanded")
+    profile_begin()
+    trace_begin()
+    uow_begin()
     _sync_ui_lock_with_timers()
     render_notifier()
 
@@ -1052,9 +4833,22 @@ def main():
         </div>
         """, unsafe_allow_html=True)
 
+    _startup_warmup()
+
     # Gate
     if "auth_user_id" not in st.session_state and "username" not in st.session_state:
-        show_login_header(); auth_block(); st.stop()
+        show_login_header(); auth_block()
+        _warm_asset_caches()   # form đã gửi xuống trình duyệt, tranh thủ làm nóng cache
+        st.stop()
+
+    # Phiên mới (replica khác / worker restart) → khôi phục timer & khóa UI của user
+    session_restore()
+    _sync_ui_lock_with_timers()
+
+    # Kiosk lớp đang bật trên thiết bị này → không tải doc của giáo viên
+    if st.session_state.get("_kiosk"):
+        render_kiosk()
+        return
 
     # Title
     st.title(APP_TITLE); st.caption(APP_TAGLINE)
@@ -1071,14 +4865,47 @@ def main():
     if data["profile"].get("nickname","") != nickname_hint and nickname_hint:
         data["profile"]["nickname"] = nickname_hint; save_user(data)
 
-    cloud_flag = "☁️" if auth_user_id else "💾"
+    cloud_flag = ("☁️" if cloud_available() else "⚡💾") if auth_user_id and get_storage().remote else "💾"
     st.markdown(
         f"<div style='font-size:22px; font-weight:800;'>Xin chào, {data['profile'].get('nickname','bạn')}!"
         f" <span style='font-size:18px; font-weight:600;'>{cloud_flag}</span></div>",
         unsafe_allow_html=True
     )
+    render_week_summary(data)
 
     ui_sidebar(data)
+    render_reminders(str(auth_user_id or st.session_state.get("username") or nickname_hint), data)
+
+    if is_counselor() or is_admin():
+        pages = ["Của tôi"] + (["Tư vấn lớp", "Kiosk lớp"] if is_counselor() else []) + (["Quản trị"] if is_admin() else [])
+        page = st.sidebar.radio("Trang", pages, key="counselor_page")
+        if page == "Quản trị":
+            st.markdown("---")
+            with st.expander("🧠 Bộ nhớ máy chủ", expanded=True):
+                render_memory_report()
+            with st.expander("🔬 Profiler theo phiên", expanded=True):
+                render_profiler_admin()
+            return
+        if page == "Kiosk lớp":
+            st.markdown("---")
+            render_kiosk_setup()
+            return
+        if page == "Tư vấn lớp":
+            st.markdown("---")
+            render_counselor_dashboard()
+            with st.expander("🧠 Bộ nhớ máy chủ"):
+                render_memory_report()
+            return
+
+    # Tầng lạnh: 1 lần/phiên dời bản ghi cũ khỏi doc làm việc → load/save nhẹ dần theo thời gian
+    if not st.session_state.get("_archived_checked"):
+        st.session_state["_archived_checked"] = True
+        try:
+            if archive_cold_records(data, *_archive_target(data)):
+                save_user(data)
+        except Exception as e:
+            perf_inc("archive.errors")
+            st.warning(f"⚠️ Chưa dời được dữ liệu cũ sang kho lưu trữ: {e}")
 
     st.markdown("---")
     st.header("Góc chậm lại hôm nay")
@@ -1107,19 +4934,23 @@ def main():
     mood = st.slider("Tâm trạng của bạn (1 rất tệ → 10 rất tốt):", 1, 10, 5, key="mood_slider", disabled=done_today or ui_locked)
     st.markdown(f"### Cảm xúc hiện tại: {mood_emoji(mood)} (điểm: {mood})")
     if done_today:
-        st.button("Đã check-in hôm nay 🎉", disabled=True)
+        st.button("Đã check-in hôm nay 🎉", key="checkin_done", disabled=True)
     else:
-        if st.button("Lưu check-in ✅", disabled=ui_locked):
-            data["game"].setdefault("moods", []).append({"date": datetime.utcnow().isoformat(), "mood": int(mood)})
+        if st.button("Lưu check-in ✅", key="checkin_save", disabled=ui_locked):
+            now_iso = datetime.utcnow().isoformat()
+            data["game"].setdefault("moods", []).append({"date": now_iso, "mood": int(mood)})
+            week_summary_add(data, "moods", data["game"]["moods"][-1])
             update_streak_on_checkin(data)
-            check_badges(data)
+            if auth_user_id:
+                rollup_record_checkin(auth_user_id, user_cohort(data), now_iso[:10], int(mood))
+            check_badges(data, ("checkins", "streak"))
             st.rerun()
 
     # Daily quests
     st.markdown("---")
     st.header("🎯 Hoạt động hôm nay")
     seed_id = (st.session_state.get("auth_user_id") or st.session_state.get("username") or "guest")
-    quests = daily_quests(str(seed_id), k=3)
+    quests = daily_quests(str(seed_id), k=3, data=data)
 
     active_q = st.session_state.get("active_quest_id")
     for q in quests:
@@ -1142,7 +4973,7 @@ def main():
                 continue
 
             if q["type"] == "breathing":
-                breathing_478_stateful(qid, rounds=2)
+                breathing_478_stateful(qid, rounds=q.get("rounds", 2), phases=q.get("phases"))
                 if st.session_state.get(f"br_{qid}_state") == "done":
                     if mark_quest_completed(data, q, {"completed": True}):
                         st.rerun()
@@ -1165,13 +4996,7 @@ def main():
     all_completed = all(is_quest_done(data, q["quest_id"]) for q in quests)
     if all_completed and quests and not st.session_state.get("finished_today", False):
         st.session_state["finished_today"] = True
-        try:
-            check_badges(data, set_all_done_today=True)
-        except TypeError:
-            badge = "Hoàn tất hôm nay"
-            if badge not in data["game"].get("badges", []):
-                data["game"].setdefault("badges", []).append(badge)
-                save_user(data)
+        check_badges(data, ("all_quests_done_today",), set_all_done_today=True)
 
     # Garden
     st.markdown("---")
@@ -1186,20 +5011,33 @@ def main():
         with st.expander("Viết nhật ký mới"):
             jtitle = st.text_input("Tiêu đề", key="jtitle", disabled=is_ui_locked())
             jcontent = st.text_area("Nội dung", key="jcontent", height=200, disabled=is_ui_locked())
-            if st.button("Lưu nhật ký", disabled=is_ui_locked()):
+            if st.button("Lưu nhật ký", key="journal_save", disabled=is_ui_locked()):
                 if jcontent.strip():
-                    data["game"].setdefault("journal", []).append({
+                    entry = {
                         "date": datetime.utcnow().isoformat(),
                         "title": jtitle.strip() if jtitle.strip() else "(No title)",
                         "content": jcontent.strip()
-                    })
+                    }
+                    data["game"].setdefault("journal", []).append(entry)
+                    search_index_add(data, "journal", entry)
+                    week_summary_add(data, "journal", entry)
+                    st.session_state.pop("_journal_export_full", None)
                     save_user(data)
-                    check_badges(data)
-                    st.success("Đã lưu nhật ký.")
+                    check_badges(data, ("journal_total",))
+                    try:
+                        uow_flush()   # báo thành công sau khi đã ghi thật, không phải lúc mới gom vào unit of work
+                    except Exception as e:
+                        st.error(f"Chưa lưu được nhật ký: {e}")
+                    else:
+                        st.success("Đã lưu nhật ký.")
                 else:
                     st.error("Nhật ký trống.")
+        with st.expander("🔎 Tìm kiếm"):
+            render_search(data)
         with st.expander("Lịch sử nhật ký"):
-            j = data["game"].get("journal", [])
+            j = _archive_month_picker(data, "journal", "journal_archive_month")
+            if j is None:
+                j = game_recent(data, "journal", [])
             if j:
                 for e in reversed(j[-50:]):
                     st.write(f"**{e.get('title','(No title)')}** — {datetime.fromisoformat(e['date']).strftime('%Y-%m-%d %H:%M')}")
@@ -1207,53 +5045,89 @@ def main():
             else:
                 st.caption("Chưa có nhật ký nào.")
     with colj2:
-        txt = export_journal_to_txt(data)
-        if txt:
+        partial = "journal" in getattr(data["game"], "pending", ())
+        txt = st.session_state.get("_journal_export_full") or ("" if partial else export_journal_to_txt(data))
+        if partial and not txt:
+            if st.button("Chuẩn bị file nhật ký", key="journal_export_load"):
+                st.session_state["_journal_export_full"] = export_journal_to_txt(data)
+                st.rerun()
+        elif txt:
             st.download_button("Tải nhật ký (.txt)", data=txt.encode("utf-8"),
                                file_name=f"{data['profile'].get('nickname','user')}_journal.txt",
                                mime="text/plain")
         else:
             st.caption("Chưa ghi nhận nhật ký nào")
+        if archived_months(data, "journal") and "_journal_export_full" not in st.session_state:
+            if st.button("Gồm cả nhật ký cũ", key="journal_export_full"):
+                st.session_state["_journal_export_full"] = export_journal_to_txt(data, include_archive=True)
+                st.rerun()
 
     # History
     st.markdown("---")
     st.header("📊 Lịch sử & tiến trình")
     colh1, colh2 = st.columns([2,1])
     with colh1:
-        with st.expander("Lịch sử cảm xúc (mới nhất 50)"):
-            moods = data["game"].get("moods", [])
+        with st.expander("Lịch sử cảm xúc"):
+            moods = _archive_month_picker(data, "moods", "moods_archive_month")
+            if moods is None:
+                moods = data["game"].get("moods", [])
             if moods:
-                for m in reversed(moods[-50:]):
-                    dt = datetime.fromisoformat(m["date"]).strftime("%Y-%m-%d %H:%M")
-                    st.write(f"{dt} — {mood_emoji(m['mood'])} ({m['mood']})")
+                st.caption(f"{len(moods)} lần check-in")
+                rows = [[m["date"][:16].replace("T", " "), m["mood"]] for m in reversed(moods)]
+                emoji = {str(v): mood_emoji(v) for v in {m["mood"] for m in moods}}
+                render_history_list(rows, "{0} — {1:emoji} ({1})", "moods_history", {"emoji": emoji})
             else:
                 st.caption("Chưa có check-in nào.")
+        with st.expander("📈 Xu hướng"):
+            render_mood_trends(str(auth_user_id or nickname_hint), data)
         with st.expander("Hoạt động đã hoàn thành"):
-            qs = list(data["game"].get("quests", {}).values())
+            qs = _archive_month_picker(data, "quests", "quests_archive_month")
+            if qs is None:
+                qs = list(data["game"].get("quests", {}).values())
             if qs:
                 qs_sorted = sorted(qs, key=lambda x: x.get("completed_at",""), reverse=True)
-                for item in qs_sorted[:100]:
-                    ts = datetime.fromisoformat(item["completed_at"]).strftime("%Y-%m-%d %H:%M")
-                    st.write(f"✅ {item['title']} — {ts}")
+                titles = list(dict.fromkeys(item["title"] for item in qs_sorted))  # tên lặp lại gửi 1 lần
+                tidx = {t: i for i, t in enumerate(titles)}
+                rows = [[tidx[item["title"]], item["completed_at"][:16].replace("T", " ")] for item in qs_sorted]
+                render_history_list(rows, "✅ {0:titles} — {1}", "quests_history", {"titles": titles})
             else:
                 st.caption("Chưa hoàn thành hoạt động nào.")
     with colh2:
         st.subheader("Thống kê nhanh")
         st.write(f"- Streak hiện tại: {data['game'].get('streak',0)} ngày")
-        if data["game"].get("badges"): st.write("- Huy hiệu:");
-        for b in data["game"].get("badges", []):
-            try:
-                display = re.sub(r'^\W+\s*', '', str(b)).strip()
-            except Exception:
-                display = str(b)
-            st.write(f"  • {display}")
+        badges = data["game"].get("badges", [])
+        if badges:
+            st.write(f"- Huy hiệu ({len(badges)}):")
+            render_history_list([[re.sub(r'^\W+\s*', '', str(b)).strip() or str(b)] for b in reversed(badges)],
+                                "• {0}", "badges_list")
 
     st.markdown("---")
     st.caption("LƯU Ý: Ứng dụng chỉ mang tính hỗ trợ. Không thay thế cho chẩn đoán hoặc điều trị chuyên môn.")
 
 if __name__ == "__main__":
     if "active_quest_id" not in st.session_state: st.session_state["active_quest_id"] = None
-    main()
+    try:
+        main()
+    finally:
+        # mỗi bước kết thúc lượt chạy độc lập: ghi lỗi không được chặn đồng bộ phiên/đo đạc, và ngược lại.
+        # Sau st.stop(), lần đọc session_state đầu tiên cũng ném StopException (BaseException) → bỏ qua.
+        try:
+            uow_commit()     # chạy cả khi st.rerun()/st.stop() ném exception
+        except Exception as e:
+            perf_inc("save.commit_failed")
+            try:
+                st.warning(f"⚠️ Chưa lưu được dữ liệu lượt này, thử lại ở thao tác sau: {e}")
+            except BaseException:
+                pass
+        except BaseException:
+            pass
+        for _finish in (session_sync, report_time_to_interactive, memory_publish, trace_end, profile_end):
+            try:
+                _finish()
+            except Exception:
+                perf_inc(f"run.finalizer_failed.{_finish.__name__}")
+            except BaseException:    # StopException sau st.stop()
+                pass
 
 
 
@@ -0,0 +1,738 @@
+"""
+Healingizz — các job nền / CLI chạy ngoài giao diện Streamlit.
+
+Chạy từ thư mục gốc repo (cùng chỗ với code.py và .streamlit/secrets.toml):
+
+    python healing_jobs.py backfill-rollups [--since YYYY-MM-DD]
+    python healing_jobs.py repair-streaks [--workers N] [--batch 1000] [--dry-run] [--local-only|--cloud-only]
+    python healing_jobs.py migrate [--to V] [--workers N] [--batch 500] [--dry-run] [--reset] [--list]
+    python healing_jobs.py bench-storage [--users 20] [--journal 200] [--mongo]
+    python healing_jobs.py bench-startup [--repeat 3] [--max-import-ms 1500] [--max-first-paint-ms 2500]
+    python healing_jobs.py ingest FILE.ndjson [--chunk 200]
+    python healing_jobs.py serve-ingest [--host 127.0.0.1] [--port 8600] [--chunk 200] [--max-mb 32]
+    python healing_jobs.py replay-traces [TRACE.ndjson|DIR ...] [--engine sqlite] [--baseline F] [--save-baseline F]
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+APP_FILE = Path(__file__).with_name("code.py")
+APP_MODULE = "healingizz_app"
+
+
+def load_app():
+    """Nạp code.py như 1 module thường (tên riêng để không đè module `code` của stdlib)."""
+    if APP_MODULE in sys.modules:
+        return sys.modules[APP_MODULE]
+    logging.disable(logging.WARNING)  # bare mode: Streamlit cảnh báo "streamlit run ..." / ScriptRunContext liên tục
+    spec = importlib.util.spec_from_file_location(APP_MODULE, APP_FILE)
+    app = importlib.util.module_from_spec(spec)
+    sys.modules[APP_MODULE] = app
+    spec.loader.exec_module(app)
+    return app
+
+
+# ====== backfill-rollups ======
+def cmd_backfill_rollups(args):
+    app = load_app()
+    store = app.get_storage()
+    if store.name == "sqlite":
+        t0 = time.perf_counter()
+        n = store.rebuild_rollups(args.since or "")
+        print(f"✔ backfill xong: {n} rollup (ngày × lớp) trong {time.perf_counter() - t0:.2f}s")
+        return
+    if store.name != "mongo":
+        print(f"✖ engine {store.name!r} không có rollup", file=sys.stderr)
+        return 1
+    users = app._mongo_col_data()
+    rollups = app._mongo_col_rollups()
+    app._mongo_col_cohorts()  # đảm bảo index (cohort) cho $merge
+    t0 = time.perf_counter()
+    users.aggregate(app.rollup_backfill_pipeline(args.since, into=rollups.name), allowDiskUse=True)
+    users.aggregate(app.cohort_backfill_pipeline(into=app._mongo_col_cohorts().name), allowDiskUse=True)
+    dt = time.perf_counter() - t0
+    n = rollups.count_documents({"day": {"$gte": args.since}} if args.since else {})
+    print(f"✔ backfill xong: {n} rollup (ngày × lớp) trong {dt:.2f}s")
+
+
+# ====== repair-streaks ======
+def local_user_files(app) -> list[Path]:
+    """Các file dữ liệu user trong cây shard DATA_DIR/users/ (gộp file phẳng kiểu cũ trước nếu còn)."""
+    app.consolidate_local_files()
+    return list(app.iter_local_user_files())
+
+
+def write_json_atomic(path: Path, data: dict):
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _repair_local_file(args) -> tuple[str, bool, str]:
+    path, dry_run = args
+    app = load_app()
+    try:
+        data = app.read_snapshot(Path(path))
+        changed = app.repair_streaks(data.setdefault("game", {}))
+        if changed and not dry_run:
+            app.write_snapshot(Path(path), data)
+        return path, changed, ""
+    except Exception as e:
+        return path, False, str(e)
+
+
+_STREAK_FIELDS = ("streak", "longest_streak", "last_checkin_date", "streak_history")
+
+
+def _repair_cloud_doc(doc: dict) -> tuple[str, dict | None, str]:
+    """(user_id, $set cần ghi hoặc None, lỗi). Doc hỏng (ngày check-in không parse được) chỉ báo lỗi, không dừng cả lượt."""
+    app = load_app()
+    try:
+        # repair_streaks (không gọi thẳng compute_streaks): moods đã sang tầng lạnh thì không hạ kỷ lục/chuỗi đang chạy
+        game = dict((doc.get("data") or {}).get("game") or {})
+        before = {k: game.get(k) for k in _STREAK_FIELDS}
+        app.repair_streaks(game)
+        sets = {f"data.game.{k}": game[k] for k in _STREAK_FIELDS if game.get(k) != before[k]}
+        return doc["user_id"], sets or None, ""
+    except Exception as e:
+        return doc.get("user_id", "?"), None, str(e)
+
+
+def engine_pass(app, fn, dry_run: bool) -> tuple[int, int, int]:
+    """
+    Chạy `fn(doc) -> changed` qua mọi user của engine cục bộ (sqlite/json). SQLite chỉ có 1 writer nên chạy tuần tự.
+    Trả về (đã xem, đã đổi, lỗi).
+    """
+    store = app.get_storage()
+    seen = changed = errors = 0
+    for uid in store.iter_user_ids():
+        seen += 1
+        try:
+            data = store.load(uid)
+            if data is None or not fn(data):
+                continue
+            changed += 1
+            if not dry_run:
+                store.save(uid, data)
+        except Exception as e:   # 1 doc hỏng không được dừng cả lượt giữa chừng
+            errors += 1
+            print(f"  ✖ {uid}: {e}", file=sys.stderr)
+    return seen, changed, errors
+
+
+def cmd_repair_streaks(args):
+    app = load_app()
+    t0 = time.perf_counter()
+    n_seen = n_fixed = n_err = 0
+    if not args.local_only and app.get_storage().name != "mongo":
+        n_seen, n_fixed, n_err = engine_pass(app, lambda d: app.repair_streaks(d.setdefault("game", {})), args.dry_run)
+        args.local_only = True
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        if not args.cloud_only:
+            files = [str(f) for f in local_user_files(app)]
+            for path, changed, err in pool.map(_repair_local_file, [(f, args.dry_run) for f in files],
+                                               chunksize=max(1, len(files) // (4 * (args.workers or os.cpu_count() or 1)))):
+                n_seen += 1
+                if err:
+                    n_err += 1
+                    print(f"  ✖ {path}: {err}", file=sys.stderr)
+                elif changed:
+                    n_fixed += 1
+                    if args.verbose:
+                        print(f"  ~ {path}")
+        if not args.local_only:
+            from pymongo import UpdateOne
+            col = app._mongo_col_data()
+            proj = {"_id": 0, "user_id": 1, "data.game.moods.date": 1, "data.game.streak": 1,
+                    "data.game.longest_streak": 1, "data.game.last_checkin_date": 1, "data.game.streak_history": 1,
+                    "data.game.archive_index.moods": 1}
+            cursor = col.find({}, proj, batch_size=args.batch)
+            while True:
+                batch = [d for _, d in zip(range(args.batch), cursor)]
+                if not batch:
+                    break
+                n_seen += len(batch)
+                ops = []
+                for uid, sets, err in pool.map(_repair_cloud_doc, batch, chunksize=64):
+                    if err:
+                        n_err += 1
+                        print(f"  ✖ {uid}: {err}", file=sys.stderr)
+                    elif sets:
+                        ops.append(UpdateOne({"user_id": uid}, {"$set": sets}))
+                n_fixed += len(ops)
+                if ops and not args.dry_run:
+                    col.bulk_write(ops, ordered=False)
+    dt = time.perf_counter() - t0
+    tag = " (dry-run, chưa ghi)" if args.dry_run else ""
+    print(f"✔ {n_fixed}/{n_seen} user cần sửa streak{tag}{f', {n_err} doc lỗi (bỏ qua)' if n_err else ''} — "
+          f"{dt:.2f}s, {n_seen / dt if dt else 0:.0f} docs/s")
+    return 1 if n_err else 0
+
+
+# ====== migrate ======
+def _migrate_local_file(args) -> tuple[str, bool, str]:
+    path, target, dry_run = args
+    app = load_app()
+    try:
+        data = app.read_snapshot(Path(path))
+        changed = app.migrate_user_doc(data, to=target)
+        if changed and not dry_run:
+            app.write_snapshot(Path(path), data)
+        return path, changed, ""
+    except Exception as e:
+        return path, False, str(e)
+
+
+def _migrate_cloud_doc(args) -> tuple[str, dict | None, str]:
+    doc, target = args
+    app = load_app()
+    try:
+        data = app.decode_text_fields(doc.get("data") or {})
+        changed = app.migrate_user_doc(data, to=target)
+        return doc["user_id"], (app.encode_text_fields(data) if changed else None), ""
+    except Exception as e:
+        return doc.get("user_id", "?"), None, str(e)
+
+
+class _Progress:
+    def __init__(self, label: str, every_s: float = 2.0):
+        self.label, self.every_s = label, every_s
+        self.t0 = self.t_last = time.perf_counter()
+        self.seen = self.changed = self.errors = 0
+
+    def tick(self, n: int, changed: int = 0, errors: int = 0, force: bool = False):
+        self.seen += n; self.changed += changed; self.errors += errors
+        now = time.perf_counter()
+        if force or now - self.t_last >= self.every_s:
+            self.t_last = now
+            dt = now - self.t0
+            print(f"  [{self.label}] {self.seen} docs, {self.changed} đổi, {self.errors} lỗi — "
+                  f"{self.seen / dt if dt else 0:.0f} docs/s")
+
+
+def _load_checkpoint(path: Path, target: int, reset: bool) -> dict:
+    if not reset and path.exists():
+        ck = json.loads(path.read_text(encoding="utf-8"))
+        if ck.get("target") == target:
+            return ck
+    return {"target": target, "local_last": "", "cloud_last_id": None}
+
+
+def cmd_migrate(args):
+    app = load_app()
+    if args.list:
+        for v in sorted(app.MIGRATIONS):
+            print(f"  v{v}: {app.MIGRATIONS[v][0]}")
+        return
+    target = args.to or app.SCHEMA_VERSION
+    ck_path = Path(args.checkpoint or Path(app.DATA_DIR) / ".migrate_checkpoint.json")
+    ck = _load_checkpoint(ck_path, target, args.reset)
+    if not args.local_only and app.get_storage().name != "mongo":
+        t0 = time.perf_counter()
+        seen, changed, errors = engine_pass(app, lambda d: app.migrate_user_doc(d, to=target), args.dry_run)
+        dt = time.perf_counter() - t0
+        print(f"  [{app.get_storage().name}] {seen} docs, {changed} đổi, {errors} lỗi — "
+              f"{seen / dt if dt else 0:.0f} docs/s")
+        args.local_only = True
+
+    def save_ck():
+        if not args.dry_run:
+            write_json_atomic(ck_path, ck)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        if not args.cloud_only:
+            files = [str(f) for f in local_user_files(app) if str(f) > ck["local_last"]]
+            prog = _Progress("local")
+            for i in range(0, len(files), args.batch):
+                chunk = files[i:i + args.batch]
+                res = list(pool.map(_migrate_local_file, [(f, target, args.dry_run) for f in chunk], chunksize=16))
+                for path, _, err in res:
+                    if err:
+                        print(f"  ✖ {path}: {err}", file=sys.stderr)
+                prog.tick(len(res), sum(1 for r in res if r[1]), sum(1 for r in res if r[2]))
+                ck["local_last"] = chunk[-1]; save_ck()
+            prog.tick(0, force=True)
+
+        if not args.local_only:
+            from bson import ObjectId
+            from pymongo import UpdateOne
+            col = app._mongo_col_data()
+            query = {"$or": [{"data.schema_version": {"$lt": target}},
+                             {"data.schema_version": {"$exists": False}}]}
+            if ck["cloud_last_id"]:
+                query = {"$and": [query, {"_id": {"$gt": ObjectId(ck["cloud_last_id"])}}]}
+            cursor = col.find(query, {"_id": 1, "user_id": 1, "data": 1},
+                              batch_size=args.batch).sort("_id", 1)
+            prog = _Progress("cloud")
+            while True:
+                batch = [d for _, d in zip(range(args.batch), cursor)]
+                if not batch:
+                    break
+                res = list(pool.map(_migrate_cloud_doc, [(d, target) for d in batch], chunksize=32))
+                ops = [UpdateOne({"user_id": uid}, {"$set": {"data": data}}) for uid, data, _ in res if data is not None]
+                for uid, _, err in res:
+                    if err:
+                        print(f"  ✖ {uid}: {err}", file=sys.stderr)
+                if ops and not args.dry_run:
+                    col.bulk_write(ops, ordered=False)
+                prog.tick(len(res), len(ops), sum(1 for r in res if r[2]))
+                ck["cloud_last_id"] = str(batch[-1]["_id"]); save_ck()
+            prog.tick(0, force=True)
+
+    if not args.dry_run:
+        ck_path.unlink(missing_ok=True)  # chạy trọn → lần sau bắt đầu lại từ đầu
+    print(f"✔ migrate tới v{target} xong{' (dry-run, chưa ghi)' if args.dry_run else ''}")
+
+
+# ====== bench-storage ======
+_VI_WORDS = ("hôm nay mình cảm thấy khá mệt vì bài kiểm tra toán nhưng tối về được mẹ nấu món canh chua "
+             "nên vui hơn nhiều bạn bè trong lớp rủ nhau đi đá bóng sau giờ học thầy giáo khen bài văn "
+             "của mình trời mưa suốt buổi chiều nên không ra ngoài được đọc thêm vài chương sách mới "
+             "lo lắng về kỳ thi sắp tới nhưng sẽ cố gắng ôn tập đều đặn mỗi ngày biết ơn gia đình").split()
+
+
+def synthetic_user(app, uid: str, n_journal: int, rnd: random.Random) -> dict:
+    text = lambda n: " ".join(rnd.choice(_VI_WORDS) for _ in range(n))
+    data = app.init_user_state(uid, uid)
+    g = data["game"]
+    for i in range(n_journal * 2):
+        g["moods"].append({"date": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T08:00:00.{i:06d}", "mood": rnd.randint(1, 10)})
+    for i in range(n_journal):
+        g["journal"].append({"date": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T21:00:00.{i:06d}",
+                             "title": text(5), "content": text(rnd.randint(80, 400))})
+        g["quests"][f"gratitude-{i}"] = {"quest_id": f"gratitude-{i}", "type": "gratitude", "title": "Điều ý nghĩa",
+                                         "completed_at": f"2024-01-01T00:00:{i % 60:02d}",
+                                         "payload": {"gratitude": [text(rnd.randint(10, 120))]}}
+        g["garden"].append({"id": str(i), "date": f"2024-01-01T00:00:{i % 60:02d}", "rarity": "binh_thuong",
+                            "affirmation": text(rnd.randint(5, 40)), "tree_file": "tree1.png"})
+    return data
+
+
+def cmd_bench_storage(args):
+    import bson
+    app = load_app()
+    rnd = random.Random(7)
+    users = [synthetic_user(app, f"bench{i:04d}", args.journal, rnd) for i in range(args.users)]
+    print(f"{args.users} user × {args.journal} nhật ký (+{args.journal} biết ơn, {args.journal} cây, "
+          f"{2 * args.journal} check-in)\n")
+    print(f"{'codec':6} {'json MB':>8} {'sqlite MB':>9} {'bson MB':>8} {'enc ms/doc':>10} {'dec ms/doc':>10} "
+          f"{'save json p50':>13} {'save sqlite p50':>15}" + (f" {'save mongo p50':>14}" if args.mongo else ""))
+    for codec in ("none", "zlib", "lzma"):
+        os.environ["HEALINGIZZ_COMPRESS"] = codec
+        app._compression_config.clear()
+        with tempfile.TemporaryDirectory() as tmp:
+            js, sq = app.JsonFileEngine(Path(tmp) / "json"), app.SqliteEngine(Path(tmp) / "bench.db")
+            t0 = time.perf_counter()
+            encoded = [app.encode_text_fields(u) for u in users]
+            enc_ms = (time.perf_counter() - t0) * 1000 / len(users)
+            bson_bytes = sum(len(bson.encode({"data": e})) for e in encoded)
+            t0 = time.perf_counter()
+            for e in encoded:
+                app.decode_text_fields(e)
+            dec_ms = (time.perf_counter() - t0) * 1000 / len(users)
+            for u in users:
+                js.save(u["user_id"], u); sq.save(u["user_id"], u)
+            # độ trễ lưu đầu-cuối: thêm 1 nhật ký rồi lưu cả doc, như khi học sinh bấm "Lưu nhật ký"
+            lat = {"json": [], "sqlite": [], "mongo": []}
+            engines = [("json", js), ("sqlite", sq)] + ([("mongo", app.MongoEngine())] if args.mongo else [])
+            for u in users:
+                u["game"]["journal"].append({"date": "2025-01-01T00:00:00", "title": "x",
+                                             "content": " ".join(rnd.choice(_VI_WORDS) for _ in range(200))})
+                for name, eng in engines:
+                    t0 = time.perf_counter(); eng.save(u["user_id"], u)
+                    lat[name].append((time.perf_counter() - t0) * 1000)
+                u["game"]["journal"].pop()
+            sq.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            json_mb = sum(f.stat().st_size for f in (Path(tmp) / "json").glob("*.json")) / 1e6
+            sqlite_mb = (Path(tmp) / "bench.db").stat().st_size / 1e6
+            row = (f"{codec:6} {json_mb:8.2f} {sqlite_mb:9.2f} {bson_bytes / 1e6:8.2f} {enc_ms:10.2f} {dec_ms:10.2f} "
+                   f"{statistics.median(lat['json']):11.2f}ms {statistics.median(lat['sqlite']):13.2f}ms")
+            if args.mongo:
+                row += f" {statistics.median(lat['mongo']):12.2f}ms"
+            print(row)
+    if args.mongo:
+        app._mongo_col_data().delete_many({"user_id": {"$regex": "^bench"}})
+
+
+# ====== bench-startup ======
+# Các module phải được import lười: xuất hiện ngay khi nạp code.py nghĩa là có ai đó import lại ở đầu file.
+STARTUP_LAZY_MODULES = ("pymongo", "numpy", "bcrypt", "streamlit_autorefresh")
+
+_IMPORT_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {root!r})
+import healing_jobs
+healing_jobs.load_app()
+print(json.dumps({{"load_ms": (time.perf_counter() - t0) * 1000,
+                  "eager": [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+_FIRST_PAINT_PROBE = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+t0 = time.perf_counter()
+at = AppTest.from_file(sys.argv[1], default_timeout=60)
+at.run()
+print(json.dumps({"first_paint_ms": (time.perf_counter() - t0) * 1000,
+                  "login_form": any(w.key == "login_username" for w in at.text_input),
+                  "error": str(at.exception) if at.exception else None}))
+"""
+
+
+def _run_probe(argv: list[str], env: dict | None = None) -> tuple[dict, str]:
+    """Chạy 1 tiến trình Python mới (cache import lạnh), trả về (JSON dòng cuối stdout, stderr)."""
+    res = subprocess.run([sys.executable, *argv], capture_output=True, text=True, cwd=APP_FILE.parent,
+                         env={**os.environ, **(env or {})})
+    lines = [ln for ln in res.stdout.splitlines() if ln.startswith("{")]
+    if res.returncode != 0 or not lines:
+        raise RuntimeError(f"probe lỗi (exit {res.returncode}):\n{res.stderr[-2000:]}")
+    return json.loads(lines[-1]), res.stderr
+
+
+def _parse_importtime(stderr: str) -> list[tuple[str, int]]:
+    """`-X importtime` → [(module cấp cao nhất, cumulative µs)]; module lồng (thụt lề) đã nằm trong cha."""
+    out = []
+    for ln in stderr.splitlines():
+        if not ln.startswith("import time:") or "|" not in ln:
+            continue
+        _, cum, name = ln[len("import time:"):].split("|", 2)
+        if cum.strip().isdigit() and not name[1:].startswith(" "):
+            out.append((name.strip(), int(cum)))
+    return out
+
+
+def cmd_bench_startup(args):
+    load_ms, paint_ms, top, eager = [], [], {}, set()
+    for _ in range(args.repeat):
+        probe = _IMPORT_PROBE.format(root=str(APP_FILE.parent), lazy=STARTUP_LAZY_MODULES)
+        res, err = _run_probe(["-X", "importtime", "-c", probe])
+        load_ms.append(res["load_ms"]); eager.update(res["eager"])
+        for name, us in _parse_importtime(err):
+            top[name] = max(top.get(name, 0), us)
+        res, _ = _run_probe(["-c", _FIRST_PAINT_PROBE, str(APP_FILE)])
+        if res["error"] or not res["login_form"]:
+            print(f"❌ lượt chạy đầu không hiện form đăng nhập: {res['error']}")
+            return 1
+        paint_ms.append(res["first_paint_ms"])
+
+    print(f"Top {args.top} import (cumulative, lượt chậm nhất):")
+    for name, us in sorted(top.items(), key=lambda kv: -kv[1])[:args.top]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+    imp, paint = statistics.median(load_ms), statistics.median(paint_ms)
+    print(f"\nNạp code.py (gồm import): p50 {imp:.0f} ms  (min {min(load_ms):.0f}, max {max(load_ms):.0f})")
+    print(f"Lượt render đầu (form đăng nhập): p50 {paint:.0f} ms  (min {min(paint_ms):.0f}, max {max(paint_ms):.0f})")
+
+    failed = False
+    if eager:
+        print(f"❌ Module lẽ ra phải import lười lại bị nạp lúc khởi động: {', '.join(sorted(eager))}")
+        failed = True
+    if imp > args.max_import_ms:
+        print(f"❌ Nạp code.py {imp:.0f} ms > ngưỡng {args.max_import_ms} ms"); failed = True
+    if paint > args.max_first_paint_ms:
+        print(f"❌ Render đầu {paint:.0f} ms > ngưỡng {args.max_first_paint_ms} ms"); failed = True
+    if not failed:
+        print("✅ Trong ngưỡng.")
+    return 1 if failed else 0
+
+
+# ====== ingest (NDJSON từ trường đối tác / phiếu bài tập offline) ======
+def _print_ingest_report(rep: dict):
+    print(f"✔ {rep['accepted']}/{rep['lines']} bản ghi nhận, {rep['duplicates']} trùng, {rep['rejected']} từ chối, "
+          f"{rep['failed']} chưa ghi được, {rep['users']} user, {rep['badges']} huy hiệu mới — {rep['seconds']:.2f}s, "
+          f"{rep['records_per_s']:.0f} rec/s")
+    for e in rep["errors"]:
+        print(f"  ✖ dòng {e['line']}: {e['error']}", file=sys.stderr)
+    if rep["retry"]:
+        print(f"  ↻ {rep['retry']}", file=sys.stderr)
+
+
+def cmd_ingest(args):
+    app = load_app()
+    with open(args.file, "rb") as f:
+        rep = app.ingest_lines(f, chunk=args.chunk)
+    _print_ingest_report(rep)
+    return 1 if rep["rejected"] or rep["failed"] else 0
+
+
+def _ingest_tokens(app) -> set[str]:
+    raw = os.environ.get("HEALINGIZZ_INGEST_TOKENS") or app._secrets_section("ingest").get("tokens") or []
+    return {t.strip() for t in (raw.split(",") if isinstance(raw, str) else raw) if t.strip()}
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    """
+    POST /v1/ingest  (Authorization: Bearer <token>, body NDJSON) → báo cáo JSON của app.ingest_lines
+    GET  /v1/stats   → tổng bản ghi / thông lượng từ lúc chạy
+    GET  /healthz
+    Các lô được áp tuần tự (1 khóa) để 2 lô cùng user không ghi đè nhau.
+    """
+    server_version = "healingizz-ingest/1"
+    app = None
+    tokens: set = set()
+    chunk = 200
+    max_bytes = 32 << 20
+    lock = threading.Lock()
+    totals = {"batches": 0, "lines": 0, "accepted": 0, "rejected": 0, "failed": 0, "seconds": 0.0}
+
+    def _reply(self, code: int, body: dict):
+        raw = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            return self._reply(200, {"ok": True, "engine": self.app.get_storage().name})
+        if self.path == "/v1/stats":
+            t = dict(self.totals)
+            t["records_per_s"] = round(t["lines"] / t["seconds"], 1) if t["seconds"] else 0.0
+            snap = self.app.perf_snapshot()
+            t["batch_ms"] = snap["timings"].get("ingest.batch_ms")
+            return self._reply(200, t)
+        self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/v1/ingest":
+            return self._reply(404, {"error": "not found"})
+        auth = self.headers.get("Authorization", "")
+        if not self.tokens or not auth.startswith("Bearer ") or auth[7:].strip() not in self.tokens:
+            return self._reply(401, {"error": "token không hợp lệ"})
+        n = int(self.headers.get("Content-Length") or 0)
+        if n <= 0:
+            return self._reply(400, {"error": "body trống"})
+        if n > self.max_bytes:
+            return self._reply(413, {"error": f"lô quá {self.max_bytes >> 20} MB, hãy chia nhỏ"})
+        body = self.rfile.read(n)
+        try:
+            with self.lock:
+                rep = self.app.ingest_lines(body.splitlines(), chunk=self.chunk)
+                tot = self.totals
+                tot["batches"] += 1; tot["seconds"] += rep["seconds"]
+                for k in ("lines", "accepted", "rejected", "failed"):
+                    tot[k] += rep[k]
+        except Exception as e:
+            logging.getLogger("ingest").exception("ingest lỗi")
+            return self._reply(503, {"error": f"chưa ghi xong, hãy gửi lại: {e}"})
+        # Có nhóm chưa ghi (cloud ngắt giữa chừng) → 503 kèm báo cáo; gửi lại cả lô an toàn, xem rep["retry"]
+        self._reply(503 if rep["failed"] else 200, rep)
+
+    def log_message(self, fmt, *args):
+        print(f"  {self.address_string()} {fmt % args}", file=sys.stderr)
+
+
+def cmd_serve_ingest(args):
+    app = load_app()
+    IngestHandler.app = app
+    IngestHandler.tokens = _ingest_tokens(app)
+    IngestHandler.chunk = args.chunk
+    IngestHandler.max_bytes = int(args.max_mb * (1 << 20))
+    if not IngestHandler.tokens:
+        print("✖ chưa cấu hình token: [ingest] tokens = [...] trong secrets hoặc HEALINGIZZ_INGEST_TOKENS",
+              file=sys.stderr)
+        return 1
+    srv = ThreadingHTTPServer((args.host, args.port), IngestHandler)
+    print(f"✔ ingest API ({app.get_storage().name}) tại http://{args.host}:{args.port}/v1/ingest")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+
+
+# ====== replay-traces (vết thao tác thật → bộ kiểm tra hồi quy hiệu năng) ======
+# Mỗi file vết chạy trong 1 tiến trình riêng, DATA_DIR tạm + engine local → cache_resource của app không lẫn
+# giữa các vết và không đụng dữ liệu thật. Chữ ẩn danh được thay bằng câu mẫu cùng độ dài, <day> = hôm nay.
+_REPLAY_PROBE = """
+import json, sys, time
+from datetime import date, datetime, time as dtime
+from streamlit.testing.v1 import AppTest
+KINDS = ("button", "checkbox", "toggle", "slider", "select_slider", "text_input", "text_area", "number_input",
+         "selectbox", "radio", "multiselect", "time_input", "date_input")
+FILLER = "Hôm nay mình thấy ổn hơn một chút. "
+def value(v):
+    if isinstance(v, dict):
+        if "$text" in v: return (FILLER * (v["$text"] // len(FILLER) + 1))[:v["$text"]]
+        if "$time" in v: return dtime.fromisoformat(v["$time"])
+        if "$date" in v: return date.fromisoformat(v["$date"][:10])
+    return v
+def find(at, key):
+    key = key.replace("<day>", datetime.utcnow().date().isoformat())
+    for kind in KINDS:
+        for w in getattr(at, kind):
+            if w.key == key:
+                return kind, w
+    return None, None
+steps = [json.loads(ln) for ln in open(sys.argv[2], encoding="utf-8") if ln.strip()]
+steps = [s for s in steps if s.get("type") == "step"]
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+at.run()
+app = next(m for m in list(sys.modules.values()) if getattr(m, "trace_begin", None))
+writes = lambda: app.perf_snapshot()["counters"].get("save.writes", 0)
+out, logged = [], False
+for s in steps:
+    if s.get("logged_in") and not logged:
+        at.session_state["username"] = at.session_state["nickname"] = "replay"
+        at.session_state["auth_user_id"] = "replay-user"
+        logged = True
+    applied = missing = 0
+    for ev in s["events"]:
+        kind, w = find(at, ev["key"])
+        if w is None:
+            missing += ev["value"] is not False  # nút đã biến mất sau lượt bấm: không tính
+            continue
+        if kind == "button":
+            if ev["value"] is True:
+                w.click(); applied += 1
+            continue
+        try:
+            w.set_value(value(ev["value"])); applied += 1
+        except Exception:
+            missing += 1
+    w0, t0 = writes(), time.perf_counter()
+    at.run()
+    out.append({"i": s["i"], "run_ms": (time.perf_counter() - t0) * 1000, "writes": writes() - w0,
+                "recorded_ms": s.get("run_ms"), "applied": applied, "missing": missing,
+                "error": str(at.exception[0].message)[:300] if at.exception else None})
+print(json.dumps({"steps": out}))
+"""
+
+
+def _trace_files(paths: list[str]) -> list[Path]:
+    out = []
+    for p in map(Path, paths or [str(APP_FILE.with_name("healing_data") / "traces")]):
+        out += sorted(p.glob("*.ndjson")) if p.is_dir() else [p]
+    return out
+
+
+def _replay_one(path: Path, engine: str) -> dict:
+    with tempfile.TemporaryDirectory(prefix="hz-replay-") as tmp:
+        res, _ = _run_probe(["-c", _REPLAY_PROBE, str(APP_FILE), str(path.resolve())],
+                            env={"HEALINGIZZ_DATA_DIR": tmp, "HEALINGIZZ_STORAGE": engine, "HEALINGIZZ_TRACE": "0",
+                                 "HEALINGIZZ_SQLITE_PATH": str(Path(tmp) / "replay.db")})
+    steps = res["steps"]
+    ms = sorted(s["run_ms"] for s in steps) or [0.0]
+    return {"steps": len(steps), "p50_ms": round(statistics.median(ms), 1),
+            "p95_ms": round(ms[min(len(ms) - 1, int(0.95 * len(ms)))], 1), "max_ms": round(ms[-1], 1),
+            "writes": sum(s["writes"] for s in steps), "missing": sum(s["missing"] for s in steps),
+            "errors": [f"bước {s['i']}: {s['error']}" for s in steps if s["error"]],
+            "slowest": max(steps, key=lambda s: s["run_ms"])["i"] if steps else None}
+
+
+def cmd_replay_traces(args):
+    files = _trace_files(args.paths)
+    if not files:
+        print("✖ không có file vết nào (bật [trace] record = true rồi dùng app một lúc)", file=sys.stderr)
+        return 1
+    baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8")) if args.baseline else {}
+    results, failed = {}, False
+    for f in files:
+        r = results[f.name] = _replay_one(f, args.engine)
+        print(f"  {f.name}: {r['steps']} bước, p50 {r['p50_ms']:.0f} ms, p95 {r['p95_ms']:.0f} ms, "
+              f"max {r['max_ms']:.0f} ms (bước {r['slowest']}), {r['writes']} lần ghi, {r['missing']} widget không thấy")
+        for e in r["errors"]:
+            print(f"    ❌ {e}"); failed = True
+        base = baseline.get(f.name)
+        if base:
+            limit = base["p95_ms"] * (1 + args.max_regress)
+            if r["p95_ms"] > limit and r["p95_ms"] - base["p95_ms"] > args.min_delta_ms:
+                print(f"    ❌ p95 {r['p95_ms']:.0f} ms > baseline {base['p95_ms']:.0f} ms + {args.max_regress:.0%}")
+                failed = True
+            if r["writes"] > base["writes"]:
+                print(f"    ❌ {r['writes']} lần ghi > baseline {base['writes']}"); failed = True
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(results, ensure_ascii=False, indent=1), encoding="utf-8")
+        print(f"✔ đã lưu baseline: {args.save_baseline}")
+    print("❌ Hồi quy so với baseline." if failed else "✅ Trong ngưỡng.")
+    return 1 if failed else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(prog="healing_jobs", description="Job nền cho Healingizz")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("backfill-rollups", help="Dựng lại rollup tâm trạng theo ngày/lớp bằng aggregation pipeline")
+    p.add_argument("--since", help="Chỉ dựng lại từ ngày này (YYYY-MM-DD)")
+    p.set_defaults(func=cmd_backfill_rollups)
+
+    p = sub.add_parser("repair-streaks", help="Tính lại streak/longest streak từ log check-in cho mọi user")
+    p.add_argument("--workers", type=int, default=None, help="Số process (mặc định = số CPU)")
+    p.add_argument("--batch", type=int, default=1000, help="Số doc Mongo mỗi lượt bulk_write")
+    p.add_argument("--dry-run", action="store_true", help="Chỉ đếm, không ghi")
+    g = p.add_mutually_exclusive_group()
+    g.add_argument("--local-only", action="store_true", help="Chỉ sửa file trong healing_data/")
+    g.add_argument("--cloud-only", action="store_true", help="Chỉ sửa doc trên Mongo")
+    p.add_argument("-v", "--verbose", action="store_true")
+    p.set_defaults(func=cmd_repair_streaks)
+
+    p = sub.add_parser("migrate", help="Nâng schema_version cho mọi doc user (có checkpoint, chạy tiếp được)")
+    p.add_argument("--to", type=int, default=None, help="Version đích (mặc định = mới nhất)")
+    p.add_argument("--workers", type=int, default=None, help="Số process (mặc định = số CPU)")
+    p.add_argument("--batch", type=int, default=500, help="Số doc mỗi lượt / mỗi checkpoint")
+    p.add_argument("--checkpoint", help="File checkpoint (mặc định healing_data/.migrate_checkpoint.json)")
+    p.add_argument("--reset", action="store_true", help="Bỏ checkpoint cũ, chạy lại từ đầu")
+    p.add_argument("--dry-run", action="store_true", help="Chỉ đếm, không ghi")
+    p.add_argument("--list", action="store_true", help="Liệt kê các migration đã đăng ký")
+    g = p.add_mutually_exclusive_group()
+    g.add_argument("--local-only", action="store_true")
+    g.add_argument("--cloud-only", action="store_true")
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser("bench-storage", help="Đo dung lượng / CPU / độ trễ lưu với từng codec nén")
+    p.add_argument("--users", type=int, default=20)
+    p.add_argument("--journal", type=int, default=200, help="Số nhật ký mỗi user")
+    p.add_argument("--mongo", action="store_true", help="Đo cả độ trễ lưu lên Mongo thật (cần secrets)")
+    p.set_defaults(func=cmd_bench_storage)
+
+    p = sub.add_parser("bench-startup", help="Đo thời gian import + lượt render đầu; vượt ngưỡng → exit 1")
+    p.add_argument("--repeat", type=int, default=3, help="Số lần đo, mỗi lần 1 tiến trình mới")
+    p.add_argument("--top", type=int, default=10, help="Số module import chậm nhất cần in")
+    p.add_argument("--max-import-ms", type=float, default=1500)
+    p.add_argument("--max-first-paint-ms", type=float, default=2500)
+    p.set_defaults(func=cmd_bench_startup)
+
+    p = sub.add_parser("ingest", help="Nạp 1 file NDJSON (check-in / nhật ký / quest) vào kho dữ liệu")
+    p.add_argument("file")
+    p.add_argument("--chunk", type=int, default=200, help="Số user mỗi lượt ghi (Mongo: 1 bulk_write)")
+    p.set_defaults(func=cmd_ingest)
+
+    p = sub.add_parser("serve-ingest", help="HTTP API nhận NDJSON của trường đối tác")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8600)
+    p.add_argument("--chunk", type=int, default=200, help="Số user mỗi lượt ghi (Mongo: 1 bulk_write)")
+    p.add_argument("--max-mb", type=float, default=32, help="Kích thước tối đa 1 lô")
+    p.set_defaults(func=cmd_serve_ingest)
+
+    p = sub.add_parser("replay-traces", help="Phát lại vết thao tác đã ghi; chậm/ghi nhiều hơn baseline → exit 1")
+    p.add_argument("paths", nargs="*", help="File .ndjson hoặc thư mục (mặc định healing_data/traces)")
+    p.add_argument("--engine", choices=("sqlite", "json"), default="sqlite", help="Storage local dùng khi phát lại")
+    p.add_argument("--baseline", help="File JSON kết quả của phiên bản trước")
+    p.add_argument("--save-baseline", help="Ghi kết quả lần này làm baseline")
+    p.add_argument("--max-regress", type=float, default=0.25, help="Cho phép p95 chậm hơn baseline bao nhiêu (0.25 = 25%%)")
+    p.add_argument("--min-delta-ms", type=float, default=20, help="Bỏ qua chênh lệch p95 nhỏ hơn mức này (nhiễu)")
+    p.set_defaults(func=cmd_replay_traces)
+    return ap
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""
+Nạp code.py qua healing_jobs.load_app() (bare mode, không cần `streamlit run`).
+DATA_DIR và engine đọc từ biến môi trường lúc import → đặt trước khi nạp: dữ liệu test nằm trong thư mục tạm,
+engine mặc định là sqlite (không cần Mongo/mạng).
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+_DATA_DIR = Path(tempfile.mkdtemp(prefix="healingizz-tests-"))
+atexit.register(shutil.rmtree, _DATA_DIR, ignore_errors=True)
+os.environ["HEALINGIZZ_DATA_DIR"] = str(_DATA_DIR)
+os.environ["HEALINGIZZ_STORAGE"] = "sqlite"
+os.environ["HEALINGIZZ_SQLITE_PATH"] = str(_DATA_DIR / "healingizz.db")
+os.environ["HEALINGIZZ_SESSION"] = "memory"
+os.environ.pop("HEALINGIZZ_TRACE", None)
+
+import healing_jobs  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    return healing_jobs.load_app()
+
+
+@pytest.fixture
+def uid():
+    """user_id riêng cho từng test (engine/pool chung cả process)."""
+    return f"t-{uuid.uuid4().hex[:12]}"
+
+
+@pytest.fixture
+def sqlite_store(app, tmp_path):
+    return app.SqliteEngine(tmp_path / "t.db")
+
+
+@pytest.fixture
+def json_store(app, tmp_path):
+    return app.JsonFileEngine(tmp_path / "users")
+
+
+@pytest.fixture
+def new_user(app):
+    """Tạo doc rỗng cho user trong `store` và trả về doc đó."""
+    def make(store, user_id, **profile):
+        data = app.init_user_state(user_id)
+        data["user_id"] = user_id
+        data["profile"].update(profile)
+        store.save(user_id, data)
+        return data
+    return make
+
+
+@pytest.fixture
+def session(app):
+    """st.session_state chạy được ở bare mode (1 phiên chung) → xóa sạch trước/sau mỗi test."""
+    app.st.session_state.clear()
+    yield app.st.session_state
+    app.st.session_state.clear()
@@ -0,0 +1,70 @@
+import pytest
+
+
+@pytest.fixture
+def breaker(app):
+    b = app._CloudBreaker(fail_threshold=2, cooldown_s=10.0, max_cooldown_s=30.0,
+                          min_timeout_s=0.5, max_timeout_s=8.0)
+    b.probes = 0
+    def probe():   # không ping Mongo thật; test tự quyết kết quả lần thử
+        b.probes += 1
+    b._probe = probe
+    return b
+
+
+def _cool_down(b):
+    b.opened_at -= b.cooldown_s + 1
+
+
+def test_opens_after_threshold(breaker):
+    assert breaker.allow() and not breaker.is_open()
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.is_open()
+    assert not breaker.allow()
+    assert breaker.probes == 0
+
+
+def test_success_resets_failure_count(breaker):
+    breaker.record_failure()
+    breaker.record_success(0.1)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_probe_closes_on_success(breaker):
+    breaker.record_failure(); breaker.record_failure()
+    _cool_down(breaker)
+    assert not breaker.allow()      # lượt gọi này vẫn bị chặn, chỉ luồng probe được thử
+    assert breaker.state == "half_open"
+    breaker.record_success(0.2)
+    assert breaker.state == "closed" and breaker.allow()
+    assert breaker.cooldown_s == breaker.base_cooldown_s
+
+
+def test_half_open_failure_reopens_with_backoff(breaker):
+    breaker.record_failure(); breaker.record_failure()
+    for expected in (20.0, 30.0, 30.0):   # cooldown x2, kẹp ở max_cooldown_s
+        _cool_down(breaker)
+        breaker.allow()
+        assert breaker.state == "half_open"
+        breaker.record_failure()
+        assert breaker.state == "open" and breaker.cooldown_s == expected
+
+
+def test_open_without_cooldown_does_not_probe(breaker):
+    breaker.record_failure(); breaker.record_failure()
+    for _ in range(3):
+        assert not breaker.allow()
+    assert breaker.state == "open"
+
+
+def test_adaptive_timeout(breaker):
+    assert breaker.timeout_s() == breaker.max_timeout_s   # chưa đo → chờ tối đa
+    for _ in range(20):
+        breaker.record_success(0.05)
+    assert breaker.timeout_s() == breaker.min_timeout_s   # mạng nhanh → kẹp ở min
+    for _ in range(50):
+        breaker.record_success(3.0)
+    assert breaker.min_timeout_s < breaker.timeout_s() <= breaker.max_timeout_s
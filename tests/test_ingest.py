@@ -0,0 +1,120 @@
+import json
+
+import pytest
+
+
+def _line(**rec):
+    return json.dumps(rec, ensure_ascii=False)
+
+
+@pytest.fixture
+def store(sqlite_store, new_user):
+    for i in range(4):
+        new_user(sqlite_store, f"u{i}", nickname=f"u{i}", cohort="10A")
+    return sqlite_store
+
+
+def _checkins(users=4, days=3):
+    return [_line(user_id=f"u{i}", type="checkin", date=f"2026-10-1{d}T07:00:00", mood=6)
+            for i in range(users) for d in range(days)]
+
+
+def _rollup_counts(store):
+    return {r["day"]: r["count"] for r in store.rollup_range("10A", "2026-10-01")}
+
+
+def test_ingest_and_rollups(app, store):
+    lines = _checkins() + [
+        _line(user_id="u0", type="journal", date="2026-10-12T21:00:00", title="Tối", content="Biết ơn cô giáo"),
+        _line(user_id="u1", type="quest", quest_type="gratitude", date="2026-10-12", gratitude=["mẹ", "bạn"]),
+    ]
+    rep = app.ingest_lines(lines, store=store)
+    assert (rep["accepted"], rep["duplicates"], rep["rejected"], rep["failed"]) == (14, 0, 0, 0)
+    assert rep["users"] == 4 and rep["retry"] is None
+    u0 = store.load("u0")["game"]
+    assert len(u0["moods"]) == 3 and u0["streak"] == 3 and len(u0["journal"]) == 1
+    u1 = store.load("u1")
+    app.ensure_search_index(u1)   # index không đi theo delta; app bù lúc user tìm
+    assert app.search_entries(u1, "ban")[0] == 1
+    assert _rollup_counts(store) == {"2026-10-10": 4, "2026-10-11": 4, "2026-10-12": 4}
+
+
+def test_resend_is_idempotent(app, store):
+    lines = _checkins()
+    app.ingest_lines(lines, store=store)
+    rep = app.ingest_lines(lines, store=store)
+    assert (rep["accepted"], rep["duplicates"], rep["users"]) == (0, 12, 0)
+    assert len(store.load("u2")["game"]["moods"]) == 3
+    assert _rollup_counts(store) == {"2026-10-10": 4, "2026-10-11": 4, "2026-10-12": 4}
+
+
+def test_duplicates_within_batch(app, store):
+    line = _line(user_id="u0", type="checkin", date="2026-10-10T07:00:00", mood=6)
+    rep = app.ingest_lines([line, line], store=store)
+    assert (rep["accepted"], rep["duplicates"]) == (1, 1)
+
+
+def test_bad_lines_do_not_stop_batch(app, store):
+    lines = ["{không phải json", _line(user_id="u0", type="checkin", date="2026-10-10", mood=11),
+             _line(user_id="ai-do", type="checkin", date="2026-10-10", mood=5), "",
+             _line(user_id="u0", type="checkin", date="2026-10-10", mood=5)]
+    rep = app.ingest_lines(lines, store=store)
+    assert (rep["lines"], rep["accepted"], rep["rejected"]) == (4, 1, 3)
+    assert [e["line"] for e in rep["errors"]] == [1, 2, 3]
+
+
+def test_failed_chunk_is_reported_and_retry_recovers(app, store, monkeypatch):
+    lines = _checkins()
+    real, calls = store.apply_deltas, []
+    def flaky(batch):
+        calls.append(len(batch))
+        if len(calls) == 2:
+            raise OSError("cloud down")
+        return real(batch)
+    monkeypatch.setattr(store, "apply_deltas", flaky)
+    rep = app.ingest_lines(lines, store=store, chunk=2)
+    assert (rep["accepted"], rep["failed"], rep["users"]) == (6, 6, 2)
+    assert rep["rollup_since"] == "2026-10-10" and "backfill-rollups --since 2026-10-10" in rep["retry"]
+    assert _rollup_counts(store) == {"2026-10-10": 2, "2026-10-11": 2, "2026-10-12": 2}   # nhóm lỗi không cộng
+
+    monkeypatch.setattr(store, "apply_deltas", real)
+    rep = app.ingest_lines(lines, store=store, chunk=2)   # gửi lại cả lô theo report["retry"]
+    assert (rep["accepted"], rep["duplicates"], rep["failed"]) == (6, 6, 0)
+    assert _rollup_counts(store) == {"2026-10-10": 4, "2026-10-11": 4, "2026-10-12": 4}
+
+
+def test_rollup_failure_fails_the_chunk(app, store, monkeypatch):
+    def broken(*a, **k):
+        raise OSError("rollup down")
+    monkeypatch.setattr(store, "rollup_inc", broken)
+    rep = app.ingest_lines(_checkins(users=1), store=store)
+    assert (rep["accepted"], rep["failed"]) == (0, 3)
+    assert rep["rollup_since"] == "2026-10-10"
+
+
+def test_concurrent_write_is_not_overwritten(app, store, monkeypatch):
+    """App/kiosk ghi cùng user giữa lúc ingest đọc và lúc ghi → vẫn còn sau ingest."""
+    real_load = store.load
+    def load_then_other_writer(user_id):
+        data = real_load(user_id)
+        other = real_load(user_id)
+        other["game"]["journal"].append({"date": "2026-10-19T21:00:00", "title": "Từ app", "content": "..."})
+        other["profile"]["bio"] = "mới"
+        store.save(user_id, other)
+        return data
+    monkeypatch.setattr(store, "load", load_then_other_writer)
+    rep = app.ingest_lines(_checkins(users=1), store=store)
+    monkeypatch.setattr(store, "load", real_load)
+    assert rep["accepted"] == 3
+    data = store.load("u0")
+    assert [j["title"] for j in data["game"]["journal"]] == ["Từ app"] and data["profile"]["bio"] == "mới"
+    assert len(data["game"]["moods"]) == 3 and data["game"]["streak"] == 3
+
+
+def test_backfilled_checkins_extend_streak(app, store):
+    app.ingest_lines([_line(user_id="u0", type="checkin", date=f"2026-10-1{d}T07:00:00", mood=6) for d in (0, 2)],
+                     store=store)
+    assert store.load("u0")["game"]["streak"] == 1
+    app.ingest_lines([_line(user_id="u0", type="checkin", date="2026-10-11T07:00:00", mood=6)], store=store)
+    game = store.load("u0")["game"]
+    assert (game["streak"], game["longest_streak"]) == (3, 3)
@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def store(app):
+    return app.get_storage()   # pool ghi qua get_storage() (sqlite trong thư mục tạm của conftest)
+
+
+@pytest.fixture
+def pool(app):
+    return app._KioskPool(max_docs=2)
+
+
+@pytest.fixture
+def student(app, store, new_user):
+    def make(user_id):
+        return new_user(store, user_id, nickname=user_id, cohort="10A")
+    return make
+
+
+def test_flush_keeps_writes_made_elsewhere(app, store, pool, student, uid):
+    student(uid)
+    pool.get(uid)
+    other = store.load(uid)   # học sinh lưu nhật ký ở phiên riêng trong lúc doc nằm trong pool
+    other["game"]["journal"].append({"date": "2026-10-19T08:00:00", "title": "x", "content": "y"})
+    store.save(uid, other)
+    pool.mutate(uid, lambda d: app._kiosk_checkin(d, 7))
+    assert uid in pool.dirty
+    assert pool.flush() == 0              # chưa đủ lô / chưa quá hạn
+    assert pool.flush(force=True) == 1 and not pool.dirty
+    game = store.load(uid)["game"]
+    assert len(game["journal"]) == 1 and len(game["moods"]) == 1 and game["streak"] == 1
+    assert pool.flush(force=True) == 0
+
+
+def test_flush_sends_only_new_records(app, store, pool, student, uid):
+    student(uid)
+    pool.mutate(uid, lambda d: app._kiosk_checkin(d, 5))
+    pool.flush(force=True)
+    pool.mutate(uid, lambda d: d["profile"].update(nickname="Mới"))
+    delta = app._kiosk_delta(pool.docs[uid], pool.marks[uid])
+    assert delta["game"]["moods"] == [] and delta["profile"] == {"nickname": "Mới"}
+    pool.flush(force=True)
+    data = store.load(uid)
+    assert len(data["game"]["moods"]) == 1 and data["profile"]["nickname"] == "Mới"
+
+
+def test_failed_flush_stays_dirty_and_resends(app, store, pool, student, uid, monkeypatch):
+    student(uid)
+    pool.mutate(uid, lambda d: app._kiosk_checkin(d, 6))
+    real = type(store).apply_delta
+    monkeypatch.setattr(type(store), "apply_delta", lambda *a, **k: (_ for _ in ()).throw(OSError("down")))
+    assert pool.flush(force=True) == 0 and uid in pool.dirty
+    monkeypatch.setattr(type(store), "apply_delta", real)
+    assert pool.flush(force=True) == 1 and not pool.dirty
+    assert len(store.load(uid)["game"]["moods"]) == 1
+
+
+def test_mutation_during_flush_stays_dirty(app, store, pool, student, uid, monkeypatch):
+    student(uid)
+    pool.mutate(uid, lambda d: app._kiosk_checkin(d, 6))
+    real = type(store).apply_delta
+    def slow(self, user_id, delta):   # lượt mutate chen vào giữa lúc đang ghi (ngoài lock)
+        pool.mutate(user_id, lambda d: d["profile"].update(bio="chen"))
+        return real(self, user_id, delta)
+    monkeypatch.setattr(type(store), "apply_delta", slow)
+    pool.flush(force=True)
+    monkeypatch.setattr(type(store), "apply_delta", real)
+    assert uid in pool.dirty
+    pool.flush(force=True)
+    assert store.load(uid)["profile"]["bio"] == "chen" and not pool.dirty
+
+
+def test_evict_drops_clean_docs_only(app, pool, student, uid):
+    ids = [f"{uid}-{i}" for i in range(3)]
+    for u in ids:
+        student(u)
+    pool.wake = threading.Event()   # luồng xả nền đang chờ Event cũ → không tiêu mất tín hiệu của test
+    for u in ids:
+        pool.mutate(u, lambda d: app._kiosk_checkin(d, 5))
+    assert len(pool.docs) == 3 and set(pool.dirty) == set(ids)   # toàn doc bẩn → tạm vượt trần, không ghi tại chỗ
+    assert pool.wake.is_set()
+    pool.flush(force=True)
+    assert len(pool.docs) == 2 and not pool.dirty
+    assert ids[0] not in pool.docs   # bỏ doc dùng lâu nhất
+
+
+def test_clean_doc_reloads_after_ttl(app, pool, student, uid):
+    student(uid)
+    first = pool.get(uid)
+    assert pool.get(uid) is first
+    pool.loaded[uid] -= app.KIOSK_DOC_TTL_S + 1
+    assert pool.get(uid) is not first
+
+
+def test_pin_lock_is_shared_and_cleared_on_success(app, pool, uid):
+    for _ in range(app.KIOSK_PIN_MAX_FAILS - 1):
+        pool.pin_failed(uid)
+    assert not pool.pin_locked(uid)
+    pool.pin_failed(uid)
+    assert pool.pin_locked(uid)
+    pool.pin_ok(uid)
+    assert not pool.pin_locked(uid)
+
+
+def test_pin_hash(app):
+    data = {"profile": {"kiosk_pin": app._kiosk_pin_hash("1234")}}
+    assert app.kiosk_pin_ok(data, "1234") and not app.kiosk_pin_ok(data, "4321")
+    assert not app.kiosk_pin_ok({"profile": {}}, "1234")
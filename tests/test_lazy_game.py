@@ -0,0 +1,111 @@
+import pytest
+
+
+def _journal(n):
+    return [{"date": f"2026-10-{d:02d}T20:00:00", "title": f"Ngày {d}", "content": "..."} for d in range(1, n + 1)]
+
+
+@pytest.fixture
+def saved(app, sqlite_store, new_user, uid):
+    data = new_user(sqlite_store, uid)
+    data["game"]["journal"] = _journal(5)
+    data["game"]["garden"] = [{"date": "2026-10-02T09:00:00", "tree_file": "tree1.png"}]
+    data["game"]["quests"] = {"q1": {"quest_id": "q1", "type": "breathing", "completed_at": "2026-10-03T08:00:00"}}
+    sqlite_store.save(uid, data)
+    return data
+
+
+def test_sections_load_on_first_touch(app, sqlite_store, saved, uid):
+    data = sqlite_store.load_lazy(uid)
+    game = data["game"]
+    assert isinstance(game, app.LazyGame)
+    assert set(game.pending) == set(app.LAZY_SECTIONS)
+    assert "journal" in game and len(game) == len(saved["game"])
+    assert len(game["journal"]) == 5
+    assert "journal" not in game.pending
+    assert game == saved["game"]   # so sánh cả dict → nạp hết
+    assert game.pending == ()
+
+
+def test_save_with_pending_sections_keeps_history(app, sqlite_store, saved, uid):
+    data = sqlite_store.load_lazy(uid)
+    data["game"]["moods"].append({"date": "2026-10-06T07:00:00", "mood": 8})
+    data["game"]["streak"] = 1
+    assert "journal" in data["game"].pending
+    sqlite_store.save(uid, data)
+    assert "journal" in data["game"].pending   # lưu không kéo mục chưa chạm về
+    back = sqlite_store.load(uid)["game"]
+    assert back["journal"] == saved["game"]["journal"] and back["quests"] == saved["game"]["quests"]
+    assert len(back["moods"]) == 1 and back["streak"] == 1
+
+
+def test_append_to_loaded_section_roundtrips(app, sqlite_store, saved, uid):
+    data = sqlite_store.load_lazy(uid)
+    data["game"]["journal"].append({"date": "2026-10-09T20:00:00", "title": "Mới", "content": "!"})
+    sqlite_store.save(uid, data)
+    assert len(sqlite_store.load(uid)["game"]["journal"]) == 6
+
+
+def test_assignment_replaces_pending_section(app):
+    game = app.LazyGame({"moods": []}, {"journal": lambda: pytest.fail("không được đọc engine")})
+    game["journal"] = []
+    assert game.pending == () and game["journal"] == []
+
+
+def test_failed_loader_keeps_section_pending(app):
+    def down():
+        raise app.CloudUnavailable("breaker open")
+    game = app.LazyGame({}, {"journal": down}, {"journal": {"items": _journal(2), "n": 9, "first": None}})
+    with pytest.raises(app.CloudUnavailable):
+        game["journal"]
+    assert game.pending == ("journal",)
+    assert len(game.peek("journal")) == 2
+    assert len(app.game_recent({"game": game}, "journal")) == 2
+
+
+def test_local_mirror_without_previous_snapshot(app, sqlite_store, saved, uid):
+    """Replica mới (chưa có file local): bản sao phải có đủ mục chờ, không phải list rỗng."""
+    data = sqlite_store.load_lazy(uid)
+    assert not app.user_file(uid).exists()
+    app._save_local(data)
+    local = app.read_snapshot(app.user_file(uid))["game"]
+    assert local["journal"] == saved["game"]["journal"] and local["garden"] == saved["game"]["garden"]
+
+
+def test_local_mirror_falls_back_to_preview(app, uid):
+    def down():
+        raise app.CloudUnavailable("breaker open")
+    game = app.LazyGame({"moods": []}, {"journal": down}, {"journal": {"items": _journal(2), "n": 9, "first": None}})
+    app._save_local({"user_id": uid, "game": game})
+    assert len(app.read_snapshot(app.user_file(uid))["game"]["journal"]) == 2
+
+
+def test_local_mirror_keeps_previous_snapshot(app, uid):
+    app._save_local({"user_id": uid, "game": {"journal": _journal(4)}})
+    game = app.LazyGame({"moods": []}, {"journal": lambda: pytest.fail("có snapshot thì không đọc engine")})
+    app._save_local({"user_id": uid, "game": game})
+    assert len(app.read_snapshot(app.user_file(uid))["game"]["journal"]) == 4
+
+
+def test_checkin_badges_do_not_load_sections(app, sqlite_store, saved, uid):
+    data = sqlite_store.load_lazy(uid)
+    data["game"]["moods"].append({"date": "2026-10-06T07:00:00", "mood": 8})
+    app.evaluate_badges(data, ("checkins", "streak"))
+    assert set(data["game"].pending) == set(app.LAZY_SECTIONS)
+    assert "checkin_1" in data["game"]["badge_ids"]
+
+
+def test_badge_totals_from_preview(app, monkeypatch):
+    """Lát cắt kiểu Mongo: tổng số và số cây hiếm lấy từ preview, không gọi loader."""
+    monkeypatch.setattr(app, "_today_utc", lambda: app.date(2026, 10, 20))
+    garden = [{"date": f"2026-10-{d:02d}T09:00:00", "tree_file": "tree1.png"} for d in range(10, 21)]
+    game = app.LazyGame({"moods": [], "quest_counts": {"gratitude": 1}, "badge_ids": []},
+                        {k: (lambda: pytest.fail("không được nạp cả mục")) for k in ("garden", "journal")},
+                        {"garden": {"items": garden, "n": 40, "first": "2026-01-01", "rare": 3},
+                         "journal": {"items": _journal(3), "n": 12, "first": "2026-01-01"}})
+    data = {"game": game}
+    assert app.progress_value(data, "plant_total") == 40
+    assert app.progress_value(data, "rare_total") == 3
+    assert app.progress_value(data, "journal_total") == 12
+    assert app._window_count(data, "plant_total", 7) == 7   # 14–20/10 nằm trong lát cắt
+    assert game.pending == ("garden", "journal")
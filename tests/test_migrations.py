@@ -0,0 +1,52 @@
+import copy
+import json
+
+
+def _legacy_doc():
+    """Doc kiểu bản đầu (chưa có schema_version): thiếu khóa, ảnh base64 trong garden, huy hiệu theo tên."""
+    return {
+        "user_id": "legacy",
+        "profile": {"nickname": "cu"},
+        "game": {
+            "streak": 2,
+            "last_checkin_date": "2026-10-02T07:00:00",
+            "moods": [{"date": "2026-10-01T07:00:00", "mood": 5}, {"date": "2026-10-02T07:00:00", "mood": 7}],
+            "garden": [{"date": "2026-10-02T07:05:00", "img": "aGVsbG8=", "rare": True}],
+            "badges": ["🏅 Check-in lần đầu", "Huy hiệu không còn trong danh mục"],
+        },
+    }
+
+
+def test_migrates_to_latest(app):
+    data = _legacy_doc()
+    assert app.migrate_user_doc(data) is True
+    game = data["game"]
+    assert data["schema_version"] == app.SCHEMA_VERSION
+    assert game["longest_streak"] == 2
+    assert "img" not in game["garden"][0] and game["garden"][0]["tree_file"] == app.RARE_FILES[-1]
+    assert game["badge_ids"] == ["checkin_1"]
+    assert set(app.init_user_state("x")["game"]) <= set(game)
+    assert data["profile"]["bio"] == ""
+
+
+def test_second_run_is_noop(app):
+    data = _legacy_doc()
+    app.migrate_user_doc(data)
+    once = copy.deepcopy(data)
+    assert app.migrate_user_doc(data) is False
+    assert json.dumps(data, sort_keys=True, default=str) == json.dumps(once, sort_keys=True, default=str)
+
+
+def test_stepwise_equals_direct(app):
+    """Dừng giữa chừng (migrate --to) rồi chạy tiếp phải ra cùng kết quả như chạy 1 lần."""
+    direct, stepwise = _legacy_doc(), _legacy_doc()
+    app.migrate_user_doc(direct)
+    for ver in sorted(app.MIGRATIONS):
+        app.migrate_user_doc(stepwise, to=ver)
+        assert stepwise["schema_version"] == ver
+    direct_json = json.dumps(direct, sort_keys=True, default=str)
+    assert json.dumps(stepwise, sort_keys=True, default=str) == direct_json
+
+
+def test_new_doc_needs_no_migration(app):
+    assert app.migrate_user_doc(app.init_user_state("fresh")) is False
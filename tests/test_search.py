@@ -0,0 +1,69 @@
+def _journal(app, entries):
+    data = app.init_user_state("s")
+    for i, (title, content) in enumerate(entries):
+        e = {"date": f"2026-10-{i + 1:02d}T20:00:00", "title": title, "content": content}
+        data["game"]["journal"].append(e)
+        app.search_index_add(data, "journal", e)
+    return data
+
+
+def _refs(hits):
+    return [h["ref"][:10] for h in hits]
+
+
+def test_fold_vi(app):
+    assert app.fold_vi("Điều Ý Nghĩa") == "dieu y nghia"
+    assert app.search_tokens("Biết ơn mẹ, 2 lần!") == ["biet", "on", "me", "2", "lan"]
+
+
+def test_diacritics_and_prefix(app):
+    data = _journal(app, [("Kỳ thi", "Lo lắng về kỳ thi"), ("Đi chơi", "Biết ơn mẹ"), ("Ngủ", "Ngủ sớm")])
+    n, hits = app.search_entries(data, "ky thi")
+    assert n == 1 and _refs(hits) == ["2026-10-01"]
+    n, hits = app.search_entries(data, "biet o")   # từ cuối khớp tiền tố
+    assert n == 1 and _refs(hits) == ["2026-10-02"]
+    assert app.search_entries(data, "") == (0, [])
+
+
+def test_all_terms_required(app):
+    data = _journal(app, [("A", "biết ơn mẹ"), ("B", "biết ơn bạn"), ("C", "mẹ nấu cơm")])
+    n, hits = app.search_entries(data, "biet on me")
+    assert n == 1 and _refs(hits) == ["2026-10-01"]
+    assert app.search_entries(data, "me khong") == (0, [])
+
+
+def test_title_boost_and_tie_order(app):
+    data = _journal(app, [("Mưa", "hôm nay trời mưa"), ("Nắng", "nhớ mưa"), ("Mưa", "hôm nay trời mưa")])
+    n, hits = app.search_entries(data, "mua")
+    assert n == 3
+    assert _refs(hits) == ["2026-10-03", "2026-10-01", "2026-10-02"]   # cùng điểm → bản ghi mới hơn trước
+    assert hits[0]["score"] == hits[1]["score"] > hits[2]["score"]
+
+
+def test_paging(app):
+    data = _journal(app, [(f"Ngày {i}", "biết ơn") for i in range(7)])
+    n, first = app.search_entries(data, "biet on", page=0, per_page=3)
+    _, last = app.search_entries(data, "biet on", page=2, per_page=3)
+    assert n == 7 and len(first) == 3 and len(last) == 1
+
+
+def test_cache_follows_appends(app):
+    data = _journal(app, [("A", "biết ơn")])
+    cache = {}
+    assert app.search_entries(data, "biet on", cache=cache)[0] == 1
+    e = {"date": "2026-10-09T20:00:00", "title": "B", "content": "biết ơn thầy"}
+    data["game"]["journal"].append(e)
+    app.search_index_add(data, "journal", e)
+    assert app.search_entries(data, "biet on", cache=cache) == app.search_entries(data, "biet on")
+    assert app.search_entries(data, "biet on", cache=cache)[0] == 2
+
+
+def test_ensure_index_backfills_old_docs(app):
+    data = _journal(app, [("A", "biết ơn")])
+    data["game"]["garden"].append({"date": "2026-10-05T09:00:00", "affirmation": "Mình đủ tốt"})
+    data["game"]["quests"]["q1"] = {"quest_id": "q1", "type": "gratitude", "completed_at": "2026-10-06T08:00:00",
+                                    "payload": {"gratitude": ["bà ngoại"]}}
+    assert app.ensure_search_index(data) == 2
+    assert app.ensure_search_index(data) == 0
+    assert [h["kind"] for h in app.search_entries(data, "ba ngoai")[1]] == ["quests"]
+    assert [h["kind"] for h in app.search_entries(data, "du tot")[1]] == ["garden"]
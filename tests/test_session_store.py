@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, app, tmp_path):
+    if request.param == "memory":
+        return app.MemorySessionStore()
+    return app.SqliteSessionStore(tmp_path / "session.db")
+
+
+def test_put_get_delete(store):
+    assert store.get("u1") is None
+    store.put("u1", {"br_state": "running", "active_quest_id": "q1"})
+    assert store.get("u1") == {"br_state": "running", "active_quest_id": "q1"}
+    store.put("u1", {"br_state": "done"})
+    assert store.get("u1") == {"br_state": "done"}
+    store.delete("u1")
+    assert store.get("u1") is None
+
+
+def test_expiry(store):
+    store.put("u1", {"tm_left": 30}, ttl_s=0.05)
+    time.sleep(0.1)
+    assert store.get("u1") is None
+
+
+def test_value_is_a_snapshot(store):
+    state = {"_hz_toasts": ["a"]}
+    store.put("u1", state)
+    state["_hz_toasts"].append("b")
+    assert store.get("u1") == {"_hz_toasts": ["a"]}
+
+
+def test_sync_and_restore_shared_keys_only(app, session, monkeypatch):
+    shared = app.MemorySessionStore()
+    monkeypatch.setattr(app, "get_session_store", lambda: shared)
+    session.update({"auth_user_id": "u9", "br_phase": "inhale", "_ui_locked": True, "user_data": {"x": 1}})
+    app.session_restore()   # store rỗng → chỉ đánh dấu đã khôi phục
+    app.session_sync()
+    assert shared.get("u9") == {"br_phase": "inhale", "_ui_locked": True}
+
+    session.clear()         # replica khác / worker vừa restart
+    session["auth_user_id"] = "u9"
+    app.session_restore()
+    assert session["br_phase"] == "inhale" and session["_ui_locked"] is True
+    assert "user_data" not in session
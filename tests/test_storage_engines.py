@@ -0,0 +1,119 @@
+import pytest
+
+
+def _doc(app, user_id):
+    data = app.init_user_state(user_id, "Lan")
+    data["user_id"] = user_id
+    game = data["game"]
+    game["moods"] = [{"date": f"2026-10-{d:02d}T07:00:00", "mood": d % 10} for d in range(1, 6)]
+    game["journal"] = [{"date": "2026-10-03T20:00:00", "title": "Hôm nay", "content": "Trời đẹp " * 200}]
+    game["garden"] = [{"date": "2026-10-04T09:00:00", "tree_file": "tree1.png", "affirmation": "Mình ổn"}]
+    game["quests"] = {"q1": {"quest_id": "q1", "type": "gratitude", "completed_at": "2026-10-05T08:00:00",
+                             "payload": {"gratitude": ["mẹ", "bạn", "trời"]}}}
+    game["streak"], game["last_checkin_date"] = 5, "2026-10-05T07:00:00"
+    return data
+
+
+@pytest.fixture(params=["sqlite", "json"])
+def store(request, sqlite_store, json_store):
+    return sqlite_store if request.param == "sqlite" else json_store
+
+
+def test_roundtrip(app, store, uid):
+    data = _doc(app, uid)
+    store.save(uid, data)
+    assert store.load(uid) == data
+    assert store.load("khong-co") is None
+    assert uid in list(store.iter_user_ids())
+
+
+def test_append_and_rewrite(app, store, uid):
+    data = _doc(app, uid)
+    store.save(uid, data)
+    data["game"]["moods"].append({"date": "2026-10-06T07:00:00", "mood": 9})      # chỉ thêm đuôi
+    store.save(uid, data)
+    assert store.load(uid)["game"]["moods"] == data["game"]["moods"]
+    data["game"]["moods"] = data["game"]["moods"][2:]                              # đầu list đổi → ghi lại
+    data["game"]["journal"] = []
+    del data["game"]["quests"]["q1"]
+    store.save(uid, data)
+    assert store.load(uid) == data
+
+
+def test_query_range(app, store, uid):
+    store.save(uid, _doc(app, uid))
+    got = store.query_range(uid, "moods", "2026-10-02", "2026-10-04")
+    assert [m["date"][:10] for m in got] == ["2026-10-02", "2026-10-03"]
+    assert [q["quest_id"] for q in store.query_range(uid, "quests", "2026-10-05", "2026-10-06")] == ["q1"]
+
+
+def test_append_entity(app, store, uid):
+    store.save(uid, _doc(app, uid))
+    store.append_entity(uid, "garden", {"date": "2026-10-06T09:00:00", "tree_file": "tree6.png"})
+    store.append_entity(uid, "quests", {"quest_id": "q2", "type": "breathing", "completed_at": "2026-10-06T10:00:00"})
+    game = store.load(uid)["game"]
+    assert [p["tree_file"] for p in game["garden"]] == ["tree1.png", "tree6.png"]
+    assert set(game["quests"]) == {"q1", "q2"}
+
+
+def test_accounts(store):
+    uid = store.create_account("lan", "hash")
+    assert store.find_account("lan")["user_id"] == uid
+    assert store.find_account("khong-co") is None
+    with pytest.raises(Exception):
+        store.create_account("lan", "hash2")
+
+
+def test_apply_delta_merges_and_is_idempotent(app, store, uid):
+    store.save(uid, _doc(app, uid))
+    other = store.load(uid)   # nơi khác ghi thêm nhật ký sau khi delta được chụp
+    other["game"]["journal"].append({"date": "2026-10-06T21:00:00", "title": "Tối", "content": "..."})
+    store.save(uid, other)
+    delta = {"game": {"moods": [{"date": "2026-10-06T07:00:00", "mood": 8}], "streak": 6,
+                      "last_checkin_date": "2026-10-06T07:00:00"},
+             "profile": {"nickname": "Lan Anh"}}
+    store.apply_delta(uid, delta)
+    store.apply_delta(uid, delta)
+    data = store.load(uid)
+    assert len(data["game"]["moods"]) == 6 and len(data["game"]["journal"]) == 2
+    assert data["game"]["streak"] == 6 and data["profile"]["nickname"] == "Lan Anh"
+
+
+def test_edit_in_place_roundtrips(app, store, uid):
+    data = _doc(app, uid)
+    store.save(uid, data)
+    data["game"]["journal"][0]["title"] = "Sửa tiêu đề"                           # cùng số dòng, cùng ngày cuối
+    data["game"]["moods"][1]["mood"] = 10
+    data["game"]["quests"]["q1"]["payload"]["gratitude"].append("thầy")
+    data["game"]["quests"]["q0"] = {"quest_id": "q0", "type": "breathing", "completed_at": "2026-10-01T08:00:00"}
+    store.save(uid, data)
+    back = store.load(uid)
+    assert back == data
+    assert list(back["game"]["quests"]) == ["q1", "q0"]   # quest sửa giữ chỗ, quest mới nối cuối
+
+
+def test_migration_rewrites_entity_rows(app, store, uid):
+    data = _doc(app, uid)
+    data["schema_version"] = 1
+    data["game"]["garden"][0]["img"] = "aGVsbG8="
+    store.save(uid, data)
+    data = store.load(uid)
+    assert app.migrate_user_doc(data) is True
+    store.save(uid, data)
+    back = store.load(uid)
+    assert back["schema_version"] == app.SCHEMA_VERSION and "img" not in back["game"]["garden"][0]
+
+
+def test_sqlite_db_without_hash_column(app, tmp_path, uid):
+    """DB tạo trước khi có cột h vẫn mở được; dòng cũ được ghi lại khi nội dung đổi."""
+    import sqlite3
+    path = tmp_path / "old.db"
+    db = sqlite3.connect(str(path))
+    db.executescript(app.SqliteEngine.SCHEMA.replace(" h TEXT,", ""))
+    db.close()
+    store = app.SqliteEngine(path)
+    data = _doc(app, uid)
+    store.save(uid, data)
+    data["game"]["journal"][0]["content"] = "ngắn"
+    store.save(uid, data)
+    assert store.load(uid) == data
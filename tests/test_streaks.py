@@ -0,0 +1,56 @@
+from datetime import date, timedelta
+
+
+def test_empty_log(app):
+    assert app.compute_streaks([]) == {"streak": 0, "longest_streak": 0, "last_checkin_date": None,
+                                       "streak_history": []}
+    assert app.compute_streaks([None, ""])["streak"] == 0
+
+
+def test_runs_duplicates_and_order(app):
+    dates = ["2026-10-05T21:00:00", "2026-10-01T07:00:00", "2026-10-02T08:00:00", "2026-10-02T20:00:00",
+             "2026-10-03T07:00:00", "2026-10-06T07:00:00", "2026-10-09T07:00:00"]
+    out = app.compute_streaks(dates)
+    assert out["streak"] == 1                         # chuỗi kết thúc ở lần check-in cuối (09)
+    assert out["longest_streak"] == 3                 # 01–03, ngày trùng chỉ tính 1 lần
+    assert out["last_checkin_date"] == "2026-10-09T00:00:00"
+    assert out["streak_history"] == [{"start": "2026-10-01", "end": "2026-10-03", "days": 3},
+                                     {"start": "2026-10-05", "end": "2026-10-06", "days": 2}]
+
+
+def test_month_boundary(app):
+    out = app.compute_streaks(["2026-09-29", "2026-09-30", "2026-10-01", "2026-10-02"])
+    assert out["streak"] == out["longest_streak"] == 4
+
+
+def test_history_is_capped(app):
+    start = date(2020, 1, 1)
+    days = [(start + timedelta(days=3 * i + k)).isoformat() for i in range(app.STREAK_HISTORY_MAX + 20) for k in (0, 1)]
+    out = app.compute_streaks(days)
+    assert len(out["streak_history"]) == app.STREAK_HISTORY_MAX   # giữ các chuỗi gần nhất
+    assert out["streak_history"][-1]["end"] == days[-1]
+
+
+def test_repair_streaks_is_idempotent(app):
+    game = {"moods": [{"date": f"2026-10-{d:02d}T07:00:00", "mood": 6} for d in (1, 2, 3, 7, 8)],
+            "streak": 9, "longest_streak": 1, "last_checkin_date": None}
+    assert app.repair_streaks(game) is True
+    assert (game["streak"], game["longest_streak"]) == (2, 3)
+    assert app.repair_streaks(game) is False
+
+
+def test_cloud_repair_keeps_archived_records():
+    import healing_jobs
+    moods = [{"date": f"2026-10-{d:02d}T07:00:00"} for d in (18, 19)]
+    doc = {"user_id": "u1", "data": {"game": {
+        "moods": moods, "streak": 40, "longest_streak": 90, "last_checkin_date": "2026-10-19T07:00:00",
+        "archive_index": {"moods": {"2026-09": {"n": 30}}}}}}
+    uid, sets, err = healing_jobs._repair_cloud_doc(doc)
+    assert (uid, err) == ("u1", "")
+    assert "data.game.streak" not in sets and "data.game.longest_streak" not in sets
+    assert sets["data.game.last_checkin_date"] == "2026-10-19T00:00:00"
+
+    del doc["data"]["game"]["archive_index"]   # không lưu kho → tính lại từ log
+    _, sets, _ = healing_jobs._repair_cloud_doc(doc)
+    assert sets["data.game.streak"] == 2 and sets["data.game.longest_streak"] == 2
+    assert healing_jobs._repair_cloud_doc({"user_id": "u2", "data": {"game": {"moods": [{"date": "hỏng"}]}}})[2]
@@ -0,0 +1,50 @@
+import pytest
+
+
+@pytest.fixture
+def writes(app, session, monkeypatch):
+    log = []
+    monkeypatch.setattr(app, "_save_user_now", lambda data: log.append(data["user_id"]))
+    return log
+
+
+def test_saves_coalesce_to_one_write_per_doc(app, writes):
+    a, b = app.init_user_state("a"), app.init_user_state("b")
+    app.uow_begin()
+    for _ in range(3):
+        app.save_user(a)
+    app.save_user(b)
+    assert writes == []
+    assert app.uow_commit() == 2
+    assert writes == ["a", "b"]
+    assert app.uow_commit() == 0   # đã đóng → không ghi lại
+
+
+def test_outside_unit_of_work_writes_immediately(app, writes):
+    app.save_user(app.init_user_state("a"))
+    assert writes == ["a"]
+
+
+def test_flush_writes_and_reopens(app, session, writes):
+    a = app.init_user_state("a")
+    app.uow_begin()
+    app.save_user(a)
+    assert app.uow_flush() == 1 and writes == ["a"]
+    assert "_uow" in session
+    app.save_user(a)
+    assert app.uow_commit() == 1 and writes == ["a", "a"]
+
+
+def test_failed_doc_does_not_drop_the_rest(app, session, monkeypatch):
+    log = []
+    def save(data):
+        if data["user_id"] == "bad":
+            raise OSError("disk full")
+        log.append(data["user_id"])
+    monkeypatch.setattr(app, "_save_user_now", save)
+    app.uow_begin()
+    for u in ("a", "bad", "c"):
+        app.save_user(app.init_user_state(u))
+    with pytest.raises(OSError):
+        app.uow_commit()
+    assert log == ["a", "c"]